@@ -0,0 +1,207 @@
+"""Admission control of the requests reaching the backend.
+
+Under a spike, letting every request start its calls at once only builds
+queues in the client and in Elastic Search, and the latency collapses for
+all. `Admission` lets a bounded number of requests in, `capacity` in all and
+at most `limit` by lane, the routes being spread in lanes by cost. A request
+finding no room waits in the queue of its lane, of `queue` requests at most,
+for `timeout` seconds at most; once its queue is full or its wait over, it is
+refused with `Overloaded`, answered by a 503 and a `Retry-After`. When room
+is made, the requests waiting in the lanes declared first are let in first,
+so that cheap lookups go before fulltext searches.
+
+`CircuitBreaker` stops calling the backend after `threshold` timeouts in a
+row: the calls are refused at once for `reset_seconds`, then a single one is
+tried, which closes the breaker when it succeeds.
+
+example:
+  >>> admission = Admission(64, {"lookup": (64, 256), "search": (8, 16)})
+  >>> async with admission.admit("search"):
+  ...     ...
+  >>> breaker = CircuitBreaker(threshold=5, reset_seconds=10)
+  >>> breaker.check()
+  >>> breaker.record(error)
+"""
+
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import math
+import time
+
+from elastic_transport import ConnectionTimeout
+
+from app.metrics import Counter, Gauge, Histogram
+
+
+ADMISSION_WAIT = Histogram(
+    "cassapi_admission_wait_seconds",
+    "Time the admitted requests waited for room, by lane.",
+    ["lane"],
+)
+ADMISSION_REJECTED = Counter(
+    "cassapi_admission_rejected_total",
+    "Requests refused, by lane and reason (queue_full, timeout or circuit_open).",
+    ["lane", "reason"],
+)
+ADMISSION_ACTIVE = Gauge(
+    "cassapi_admission_active", "Requests admitted and running, by lane.", ["lane"]
+)
+BREAKER_OPEN = Gauge(
+    "cassapi_circuit_breaker_open", "1 while the calls to the backend are refused."
+)
+
+
+class Overloaded(Exception):
+    """Refused for lack of room, to be tried again after `retry_after`
+    seconds."""
+
+    def __init__(self, reason, retry_after=1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Lane:
+    __slots__ = ("name", "limit", "queue", "active", "waiters")
+
+    def __init__(self, name, limit, queue):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self.waiters = deque()
+
+
+class Admission:
+    """At most `capacity` requests running, and `limit` by lane of `lanes`,
+    a dict of (limit, queue) by lane name, the first lanes having the
+    priority."""
+
+    def __init__(self, capacity, lanes, timeout=0.5, retry_after=1):
+        self.capacity = capacity
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.lanes = {
+            name: Lane(name, limit, queue) for name, (limit, queue) in lanes.items()
+        }
+
+    def _enter(self, lane):
+        self.active += 1
+        lane.active += 1
+        ADMISSION_ACTIVE.set(lane.active, lane=lane.name)
+
+    def _leave(self, lane):
+        self.active -= 1
+        lane.active -= 1
+        ADMISSION_ACTIVE.set(lane.active, lane=lane.name)
+        self._dispatch()
+
+    def _has_room(self, lane):
+        return self.active < self.capacity and lane.active < lane.limit
+
+    def _dispatch(self):
+        """Lets in the waiting requests there is room for, by priority."""
+        for lane in self.lanes.values():
+            while lane.waiters and self._has_room(lane):
+                waiter = lane.waiters.popleft()
+                if not waiter.done():
+                    self._enter(lane)
+                    waiter.set_result(None)
+
+    async def acquire(self, name):
+        """Waits for room in the lane `name`, raises `Overloaded` if its
+        queue is full or the wait lasts more than `timeout`."""
+        lane = self.lanes[name]
+        if not lane.waiters and self._has_room(lane):
+            self._enter(lane)
+            ADMISSION_WAIT.observe(0.0, lane=name)
+            return
+        if len(lane.waiters) >= lane.queue:
+            ADMISSION_REJECTED.inc(lane=name, reason="queue_full")
+            raise Overloaded("queue_full", self.retry_after)
+        start = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        lane.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+        except asyncio.TimeoutError:
+            self._abandon(lane, waiter)
+            ADMISSION_REJECTED.inc(lane=name, reason="timeout")
+            raise Overloaded("timeout", self.retry_after)
+        except asyncio.CancelledError:
+            self._abandon(lane, waiter)
+            raise
+        ADMISSION_WAIT.observe(time.perf_counter() - start, lane=name)
+
+    def _abandon(self, lane, waiter):
+        """Gives up `waiter`, giving back its room if it was let in
+        meanwhile."""
+        if waiter.done():
+            self._leave(lane)
+        else:
+            waiter.cancel()
+            lane.waiters.remove(waiter)
+
+    def release(self, name):
+        self._leave(self.lanes[name])
+
+    @asynccontextmanager
+    async def admit(self, name):
+        await self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+
+def timed_out(error):
+    """Whether the backend call failed with `error` on a timeout."""
+    if getattr(error, "status_code", None) == 504:
+        return True
+    return isinstance(error, (ConnectionTimeout, TimeoutError))
+
+
+class CircuitBreaker:
+    """Refuses the calls for `reset_seconds` after `threshold` timeouts in a
+    row."""
+
+    def __init__(self, threshold=5, reset_seconds=10.0):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = None
+
+    @property
+    def open(self):
+        return self.opened is not None
+
+    def check(self):
+        """Raises `Overloaded` while the breaker is open. Once
+        `reset_seconds` passed, lets a single call through to try the
+        backend again, the next ones waiting for another `reset_seconds`."""
+        if self.opened is None:
+            return
+        now = time.monotonic()
+        left = self.opened + self.reset_seconds - now
+        if left > 0:
+            ADMISSION_REJECTED.inc(lane="backend", reason="circuit_open")
+            raise Overloaded("circuit_open", max(1, math.ceil(left)))
+        self.opened = now
+
+    def record(self, error=None):
+        """Records the outcome of a call, `error` if it failed. The errors
+        other than timeouts, as a missing document, tell nothing of the
+        backend health."""
+        if error is not None:
+            if timed_out(error):
+                self.failures += 1
+                if self.opened is not None or self.failures >= self.threshold:
+                    self.opened = time.monotonic()
+                    BREAKER_OPEN.set(1)
+            return
+        self.failures = 0
+        if self.opened is not None:
+            self.opened = None
+            BREAKER_OPEN.set(0)
@@ -1,26 +1,117 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timezone
+from email.utils import format_datetime
+import functools
+import hashlib
+import itertools
 import json
+import logging
 import math
+import random
+import re
 import secrets
+import time
 from typing import Union, Annotated
+import zlib
 
-from fastapi import FastAPI, Depends, HTTPException, Response, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.routing import APIRoute
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from pydantic_settings import BaseSettings
 
-from app.es import async_client
+try:
+    import brotli
+except ImportError:  # optional, responses are only gzipped without it
+    brotli = None
+
+from app import metrics, tracing
+from app.admission import Admission, CircuitBreaker, Overloaded
+from app.backends import get_backend
+from app.cache import get_cache
+from app.indexer import DECISION_FIELDS
+from app.model import BatchSearch
+from app.profiler import MIN_INTERVAL, SamplingProfiler
 from app.services.decision import DecisionService
 
 
+logger = logging.getLogger(__name__)
+
+PARAGRAPHS = re.compile(r"(\d*):(\d*)")
+# bytes gathered before sending a part of a streamed response
+STREAM_CHUNK = 64 * 1024
+# the lane of admission of the routes calling the backend, see `Admission`
+ROUTE_LANES = {
+    "/decision/{decision_id}": "lookup",
+    "/decision/{decision_id}/cites": "lookup",
+    "/decision/{decision_id}/related": "lookup",
+    "/summary": "listing",
+    "/{code_chambre}/summary": "listing",
+    "/decision/{decision_id}/cited-by": "listing",
+    "/search": "search",
+    "/search/batch": "search",
+}
+
+
+REQUEST_LATENCY = metrics.Histogram(
+    "cassapi_http_request_duration_seconds",
+    "Duration of the requests by route, method and status.",
+    ["route", "method", "status"],
+)
+SPAN_LATENCY = metrics.Histogram(
+    "cassapi_span_duration_seconds",
+    "Time spent by the traced requests in each span, by route.",
+    ["route", "span"],
+)
+
+
 class Settings(BaseSettings):
     app_name: str = "CASS API"
     admin_password: str
     admin_user: str
-    elastic_certs_path: str
-    elastic_user: str
-    elastic_password: str
-    elastic_url: str
+    backend: str = "elasticsearch"
+    sqlite_path: str | None = None
+    elastic_certs_path: str = ""
+    elastic_user: str = ""
+    elastic_password: str = ""
+    elastic_url: str = ""
     elastic_index: str
     page_size: int = 100
+    trace_sample_rate: float = 0.0
+    slow_request_seconds: float = 0.0
+    summary_store: bool = False
+    summary_refresh_seconds: float = 60.0
+    summary_snapshot: str | None = None
+    cache_url: str = ""
+    # the larger values are not put in the shared cache
+    cache_max_value_size: int = 8 * 2**20
+    count_refresh_seconds: float = 30.0
+    decision_cache_control: str = "private, max-age=86400"
+    listing_cache_control: str = "private, max-age=300"
+    compression_minimum_size: int = 1024
+    batch_max_queries: int = 1000
+    batch_concurrency: int = 8
+    # requests running at once, 0 to let them all in
+    admission_capacity: int = 64
+    # (concurrency, queue) by lane, the first ones having the priority
+    admission_lanes: dict[str, tuple[int, int]] = {
+        "lookup": (64, 256),
+        "listing": (32, 64),
+        "search": (16, 32),
+    }
+    admission_timeout: float = 0.5
+    admission_retry_after: int = 1
+    # ES timeouts in a row opening the circuit breaker, 0 to disable it
+    breaker_threshold: int = 5
+    breaker_reset_seconds: float = 10.0
+    # connections kept open to each Elastic Search node
+    elastic_connections: int = 32
+    # a file of decision identifiers to prefetch at startup, one by line
+    prefetch_path: str | None = None
+    prefetch_count: int = 1000
+    # seconds after which the worker is ready even if not warm, 0 to wait
+    warmup_timeout: float = 60.0
 
 
 class User:
@@ -28,24 +119,560 @@ class User:
         self.__dict__ = params
 
 
+class MetricsMiddleware:
+    """Records the duration of each request under the path template of the
+    route which served it, so that the requests of a route are gathered."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status_code = 500
+        start = time.perf_counter()
+
+        async def send_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            REQUEST_LATENCY.observe(
+                time.perf_counter() - start,
+                route=_route_path(scope),
+                method=scope["method"],
+                status=status_code,
+            )
+
+
+def _route_path(scope):
+    route = scope.get("route")
+    return route.path if route else "unmatched"
+
+
+class TracingMiddleware:
+    """Traces a fraction of the requests, recording the time they spend in
+    each span (auth, backend, model, serialisation) in the metrics. The
+    requests slower than `slow_seconds` are logged, with their breakdown and
+    the `took` of ES when traced."""
+
+    def __init__(self, app, sample_rate=0.0, slow_seconds=0.0):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+
+    def _log_slow(self, scope, total, trace=None):
+        if not self.slow_seconds or total < self.slow_seconds:
+            return
+        if trace is None:
+            logger.warning(
+                "slow request %s %s: %.1fms (not traced)",
+                scope["method"],
+                scope["path"],
+                total * 1000,
+            )
+        else:
+            logger.warning(
+                "slow request %s %s: %.1fms, ES took %dms, %s",
+                scope["method"],
+                scope["path"],
+                total * 1000,
+                trace.took,
+                trace.breakdown(total),
+            )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if random.random() >= self.sample_rate:
+            start = time.perf_counter()
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                self._log_slow(scope, time.perf_counter() - start)
+
+        response_start = None
+
+        async def send_traced(message):
+            nonlocal response_start
+            if message["type"] == "http.response.start":
+                response_start = time.perf_counter()
+            await send(message)
+
+        with tracing.traced() as trace:
+            try:
+                await self.app(scope, receive, send_traced)
+            finally:
+                total = time.perf_counter() - trace.start
+                if trace.endpoint_end and response_start:
+                    trace.add("serialisation", response_start - trace.endpoint_end)
+                route = _route_path(scope)
+                for name, duration in trace.spans.items():
+                    SPAN_LATENCY.observe(duration, route=route, span=name)
+                self._log_slow(scope, total, trace)
+
+
+def _accepted_encodings(scope):
+    """The content codings accepted by the client with a non zero quality."""
+    accepted = set()
+    for name, value in scope["headers"]:
+        if name != b"accept-encoding":
+            continue
+        for item in value.decode("latin-1").split(","):
+            coding, _, params = item.strip().partition(";")
+            quality = params.strip().removeprefix("q=")
+            if coding and quality not in ("0", "0.0", "0.00", "0.000"):
+                accepted.add(coding.strip().lower())
+    return accepted
+
+
+def _vary(headers):
+    """`headers` with `Accept-Encoding` in their `Vary` header."""
+    headers = list(headers)
+    for position, (name, value) in enumerate(headers):
+        if name == b"vary":
+            if value != b"*" and b"accept-encoding" not in value.lower():
+                headers[position] = (name, value + b", Accept-Encoding")
+            return headers
+    headers.append((b"vary", b"Accept-Encoding"))
+    return headers
+
+
+class CompressionMiddleware:
+    """Compresses the responses of at least `minimum_size` bytes with brotli
+    when installed and accepted by the client, with gzip otherwise. Streamed
+    responses are compressed chunk by chunk, each one flushed to the client.
+    The ETag of a compressed response is made weak, as it is the one of the
+    uncompressed content. The responses not encoded by the application all
+    vary on `Accept-Encoding`, compressed or not, for the shared caches not
+    to serve one encoding to every client."""
+
+    def __init__(self, app, minimum_size=1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    @staticmethod
+    def _compressor(encoding):
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=4)
+            return lambda data, last: compressor.process(data) + (
+                compressor.finish() if last else compressor.flush()
+            )
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        return lambda data, last: compressor.compress(data) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        accepted = _accepted_encodings(scope)
+        if brotli is not None and "br" in accepted:
+            encoding = "br"
+        elif "gzip" in accepted:
+            encoding = "gzip"
+        else:
+            encoding = None
+        start = None
+        compress = None
+
+        def weaken(headers):
+            return [
+                (
+                    name,
+                    b"W/" + value if name == b"etag" and value[:2] != b"W/" else value,
+                )
+                for name, value in headers
+            ]
+
+        async def send_compressed(message):
+            nonlocal start, compress
+            if message["type"] == "http.response.start":
+                names = {name for name, _ in message.get("headers", ())}
+                if b"content-encoding" in names:
+                    return await send(message)
+                message["headers"] = _vary(message.get("headers", ()))
+                if encoding is None:
+                    return await send(message)
+                if message["status"] == 304:
+                    message["headers"] = weaken(message["headers"])
+                    return await send(message)
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                return await send(message)
+            body = message.get("body", b"")
+            more = message.get("more_body", False)
+            if compress is None:
+                if not more and len(body) < self.minimum_size:
+                    await send(start)
+                    start = None
+                    return await send(message)
+                compress = self._compressor(encoding)
+                headers = [
+                    (name, value)
+                    for name, value in weaken(start["headers"])
+                    if name != b"content-length"
+                ]
+                headers.append((b"content-encoding", encoding.encode()))
+                data = compress(body, not more)
+                if not more:
+                    headers.append((b"content-length", str(len(data)).encode()))
+                await send({**start, "headers": headers})
+            else:
+                data = compress(body, not more)
+            await send({"type": "http.response.body", "body": data, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
+
+
+def _overloaded_response(error):
+    return JSONResponse(
+        {"detail": "Service overloaded, try again later"},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(error.retry_after)},
+    )
+
+
+class TracedRoute(APIRoute):
+    """Route marking in the trace of the request when its endpoint returns,
+    the time left before the response starts is spent serialising. The
+    routes of `ROUTE_LANES` are served once admitted, until their response
+    is sent, streamed ones included."""
+
+    def __init__(self, path, endpoint, **kwargs):
+        @functools.wraps(endpoint)
+        async def traced_endpoint(*args, **params):
+            result = await endpoint(*args, **params)
+            tracing.mark_endpoint_end()
+            return result
+
+        super().__init__(path, traced_endpoint, **kwargs)
+        lane = ROUTE_LANES.get(path)
+        if admission is not None and lane is not None:
+            self.app = self._admitted(self.app, lane)
+
+    @staticmethod
+    def _admitted(route_app, lane):
+        async def admitted_app(scope, receive, send):
+            try:
+                await admission.acquire(lane)
+            except Overloaded as error:
+                return await _overloaded_response(error)(scope, receive, send)
+            try:
+                await route_app(scope, receive, send)
+            finally:
+                admission.release(lane)
+
+        return admitted_app
+
+
+async def refresh_summaries():
+    """Reloads the summaries held in memory when the documents change."""
+    while True:
+        await asyncio.sleep(settings.summary_refresh_seconds)
+        try:
+            if await decision_service.refresh_summaries():
+                logger.info(
+                    "summaries of generation %s loaded",
+                    decision_service.summary_store.generation,
+                )
+        except Exception:
+            logger.exception("summaries refresh failed")
+
+
+async def refresh_counts():
+    """Fetches again the cached counts before they expire."""
+    while True:
+        await asyncio.sleep(settings.count_refresh_seconds)
+        try:
+            await decision_service.refresh_counts()
+        except Exception:
+            logger.exception("counts refresh failed")
+
+
+def _prefetched():
+    """The identifiers of the decisions to prefetch, the first
+    `prefetch_count` lines of the `prefetch_path` file."""
+    try:
+        with open(settings.prefetch_path) as f:
+            lines = (line.strip() for line in f)
+            return list(itertools.islice(filter(None, lines), settings.prefetch_count))
+    except OSError:
+        logger.exception("decisions to prefetch not read")
+        return []
+
+
+async def _warm_up():
+    try:
+        await decision_service.backend.connect(settings.elastic_connections)
+    except Exception:
+        logger.exception("connections warm up failed")
+    if settings.summary_store:
+        try:
+            await decision_service.load_summaries(settings.summary_snapshot)
+        except Exception:
+            logger.exception("summaries load failed")
+    else:
+        try:
+            await decision_service.warm_counts()
+        except Exception:
+            logger.exception("counts warm up failed")
+    if settings.prefetch_path:
+        try:
+            found = await decision_service.prefetch(_prefetched())
+            logger.info("%d decisions prefetched", found)
+        except Exception:
+            logger.exception("decisions prefetch failed")
+
+
+async def warm_up(app):
+    """Opens the connections to the backend, loads the summaries or fetches
+    the counts and prefetches the most requested decisions, then marks the
+    worker ready, see `/ready`. It is marked ready after `warmup_timeout`
+    seconds at most, the warm up going on meanwhile, what is not warm yet
+    being then fetched on demand."""
+    start = time.perf_counter()
+    warming = asyncio.create_task(_warm_up())
+    try:
+        # the timeout only applies to the readiness, the warm up isn't cancelled
+        done, _ = await asyncio.wait({warming}, timeout=settings.warmup_timeout or None)
+        if not done:
+            logger.warning("warm up not done after %ss", settings.warmup_timeout)
+        app.state.ready = True
+        await warming
+    finally:
+        warming.cancel()
+    logger.info("warmed up in %.1fs", time.perf_counter() - start)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.ready = False
+    tasks = [
+        asyncio.create_task(warm_up(app)),
+        asyncio.create_task(refresh_counts()),
+    ]
+    if settings.summary_store:
+        tasks.append(asyncio.create_task(refresh_summaries()))
+    yield
+    app.state.ready = False
+    for task in tasks:
+        task.cancel()
+    await decision_service.backend.close()
+    await decision_service.cache.close()
+
+
 settings = Settings()
-app = FastAPI()
+admission = (
+    Admission(
+        settings.admission_capacity,
+        settings.admission_lanes,
+        settings.admission_timeout,
+        settings.admission_retry_after,
+    )
+    if settings.admission_capacity
+    else None
+)
+app = FastAPI(lifespan=lifespan)
+app.router.route_class = TracedRoute
+if settings.compression_minimum_size:
+    app.add_middleware(
+        CompressionMiddleware, minimum_size=settings.compression_minimum_size
+    )
+app.add_middleware(MetricsMiddleware)
+if settings.trace_sample_rate or settings.slow_request_seconds:
+    app.add_middleware(
+        TracingMiddleware,
+        sample_rate=settings.trace_sample_rate,
+        slow_seconds=settings.slow_request_seconds,
+    )
+profiler = SamplingProfiler()
 security = HTTPBasic()
-decision_service = DecisionService(settings.elastic_index)
+decision_service = DecisionService(
+    settings.elastic_index,
+    get_backend(settings.backend, settings.elastic_index, settings.sqlite_path),
+    get_cache(settings.cache_url, settings.cache_max_value_size),
+    (
+        CircuitBreaker(settings.breaker_threshold, settings.breaker_reset_seconds)
+        if settings.breaker_threshold
+        else None
+    ),
+)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request, error):
+    """The backend calls refused by the circuit breaker."""
+    return _overloaded_response(error)
+
+
+def _etag(*parts):
+    """A strong ETag for the content identified by `parts`."""
+    data = "\0".join(str(part) for part in parts).encode("utf-8")
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+def _http_date(generation):
+    """The date of a generation as an HTTP date, None if it is not one."""
+    try:
+        moment = datetime.fromisoformat(generation)
+    except (TypeError, ValueError):
+        return None
+    return format_datetime(moment.astimezone(timezone.utc), usegmt=True)
+
+
+async def _cache_headers(etag, cache_control):
+    generation = await decision_service.generation()
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    last_modified = _http_date(generation)
+    if last_modified:
+        headers["Last-Modified"] = last_modified
+    return headers
+
+
+async def _listing_headers(request):
+    """Cache headers of a listing, which changes with the generation of the
+    documents only. None when the generation is unknown."""
+    generation = await decision_service.generation()
+    if generation is None:
+        return {}
+    url = request.url
+    etag = _etag(generation, url.path, url.query, settings.page_size)
+    return await _cache_headers(etag, settings.listing_cache_control)
+
+
+async def _json_stream(head, key, items, tail=None):
+    """Streams the json of `head` with the list of `items` under `key`, the
+    items (json bytes) being sent in chunks of about `STREAM_CHUNK` bytes as
+    they come, then the members of the dict returned by `tail` if given,
+    called once the items are sent."""
+    prefix = json.dumps(head, ensure_ascii=False, separators=(",", ":"))[:-1]
+    chunk = bytearray(f'{prefix}{"," if head else ""}"{key}":['.encode())
+    first = True
+    async for item in items:
+        if not first:
+            chunk += b","
+        chunk += item
+        first = False
+        if len(chunk) >= STREAM_CHUNK:
+            yield bytes(chunk)
+            chunk.clear()
+    chunk += b"]"
+    if tail is not None:
+        members = json.dumps(tail(), ensure_ascii=False, separators=(",", ":"))
+        chunk += b"," + members[1:-1].encode()
+    chunk += b"}"
+    yield bytes(chunk)
+
+
+async def _started(items):
+    """`items` with their first one pulled already, for a failure to fetch
+    them to be raised before the response starts. The others are streamed as
+    they come."""
+    items = aiter(items)
+    try:
+        first = await anext(items)
+    except StopAsyncIteration:
+        return items
+
+    async def chained():
+        yield first
+        async for item in items:
+            yield item
+
+    return chained()
+
+
+async def _page_response(headers, decisions, total, page):
+    """A page of summaries streamed as the service yields them, then their
+    stats, the count being the one of the summaries sent. The first summary
+    is fetched before the response starts, for a failure of the backend to
+    be answered with its error rather than a truncated page."""
+    decisions = await _started(decisions)
+    count = 0
+
+    async def items():
+        nonlocal count
+        async for decision in decisions:
+            count += 1
+            yield decision.model_dump_json().encode()
+
+    def stats():
+        return {
+            "stats": {
+                "count": count,
+                "total": total,
+                "page": page or 1,
+                "page_size": settings.page_size,
+                "total_page": math.ceil(total / settings.page_size),
+            }
+        }
+
+    return StreamingResponse(
+        _json_stream({}, "decisions", items(), stats),
+        media_type="application/json",
+        headers=headers,
+    )
+
+
+def _projection(fields, paragraphs):
+    """The list of the fields and the slice of the paragraphs asked for a
+    decision, None when not given or empty."""
+    if fields is not None:
+        # an empty list asks for no projection
+        fields = [field.strip() for field in fields.split(",") if field.strip()] or None
+        unknown = set(fields or ()) - set(DECISION_FIELDS)
+        if unknown:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Unknown fields: {', '.join(sorted(unknown))}",
+            )
+    if paragraphs is not None:
+        match = PARAGRAPHS.fullmatch(paragraphs)
+        if not match:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail="paragraphs expects a start:stop range",
+            )
+        start, stop = (int(value) if value else None for value in match.groups())
+        paragraphs = slice(start, stop)
+    return fields, paragraphs
+
+
+def _decision_etag(version, fields, paragraphs, compact=False):
+    if fields is None and paragraphs is None and not compact:
+        return f'"{version}"'
+    return _etag(version, fields, paragraphs, *(["compact"] if compact else []))
+
+
+def _not_modified(request, headers):
+    """Whether the client has the content of the `ETag` of `headers`
+    already."""
+    header = request.headers.get("if-none-match")
+    if not header or "ETag" not in headers:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return "*" in tags or headers["ETag"] in tags
 
 
 def get_user(credentials: Annotated[HTTPBasicCredentials, Depends(security)]):
     """Checks if a registered user."""
-    current_username_bytes = credentials.username.encode("utf8")
-    correct_username_bytes = settings.admin_user.encode("utf8")
-    is_correct_username = secrets.compare_digest(
-        current_username_bytes, correct_username_bytes
-    )
-    current_password_bytes = credentials.password.encode("utf8")
-    correct_password_bytes = settings.admin_password.encode("utf8")
-    is_correct_password = secrets.compare_digest(
-        current_password_bytes, correct_password_bytes
-    )
+    with tracing.span("auth"):
+        current_username_bytes = credentials.username.encode("utf8")
+        correct_username_bytes = settings.admin_user.encode("utf8")
+        is_correct_username = secrets.compare_digest(
+            current_username_bytes, correct_username_bytes
+        )
+        current_password_bytes = credentials.password.encode("utf8")
+        correct_password_bytes = settings.admin_password.encode("utf8")
+        is_correct_password = secrets.compare_digest(
+            current_password_bytes, correct_password_bytes
+        )
     if not (is_correct_username and is_correct_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -66,88 +693,254 @@ def get_admin(user: Annotated[User, Depends(get_user)]):
     return user
 
 
+@app.get("/ready")
+async def ready():
+    """Whether the worker is warmed up and ready for traffic, for the load
+    balancer. It answers a 503 until then."""
+    if not getattr(app.state, "ready", False):
+        return JSONResponse(
+            {"ready": False}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+    return {"ready": True}
+
+
 @app.get("/info")
 async def info(user: Annotated[User, Depends(get_admin)]):
     """Provides information about the backend."""
     return {
         "app_name": settings.app_name,
+        "backend": settings.backend,
         "elastic_search_host": settings.elastic_url,
         "elastic_index": settings.elastic_index,
     }
 
 
+@app.get("/metrics")
+async def get_metrics(user: Annotated[User, Depends(get_admin)]):
+    """Metrics of the process in the Prometheus text format."""
+    return Response(metrics.exposition(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.post("/profiler/start")
+async def start_profiler(
+    user: Annotated[User, Depends(get_admin)],
+    interval: Annotated[float, Query(ge=MIN_INTERVAL)] = 0.005,
+):
+    """Starts sampling the event loop of this worker every `interval`
+    seconds, see `app.profiler`."""
+    if profiler.running:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="The profiler is already running",
+        )
+    profiler.start(interval)
+    return {"running": True, "interval": interval}
+
+
+@app.post("/profiler/stop")
+async def stop_profiler(user: Annotated[User, Depends(get_admin)]):
+    """Stops the profiler, its samples are kept for download."""
+    profiler.stop()
+    return {"running": False, "samples": profiler.samples}
+
+
+@app.get("/profiler")
+async def get_profile(user: Annotated[User, Depends(get_admin)]):
+    """Downloads the samples of the profiler as collapsed stacks, to be
+    turned into a flame graph."""
+    return Response(
+        profiler.collapsed(),
+        media_type="text/plain",
+        headers={"Content-Disposition": 'attachment; filename="profile.txt"'},
+    )
+
+
 @app.get("/summary")
 async def get_decision_summary(
-    user: Annotated[User, Depends(get_user)], page: int | None = None
+    request: Request,
+    user: Annotated[User, Depends(get_user)],
+    page: Annotated[int | None, Query(ge=1)] = None,
 ):
     """List of rulling for all court."""
+    headers = await _listing_headers(request)
+    if _not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     cursor = (page - 1) * settings.page_size if page else 0
-    decisions = []
     total = await decision_service.count
-    count = 0
-    total_page = math.ceil(total / settings.page_size)
-    async for decision in decision_service.get_summary(cursor, settings.page_size):
-        count += 1
-        decisions.append(dict(decision))
-    return {
-        "stats": {
-            "count": count,
-            "total": total,
-            "page": page or 1,
-            "page_size": settings.page_size,
-            "total_page": total_page,
-        },
-        "decisions": decisions,
-    }
+    decisions = decision_service.get_summary(cursor, settings.page_size)
+    return await _page_response(headers, decisions, total, page)
 
 
 @app.get("/{code_chambre}/summary")
 async def get_decision_summary_for_court(
-    code_chambre: str, user: Annotated[User, Depends(get_user)], page: int | None = None
+    code_chambre: str,
+    request: Request,
+    user: Annotated[User, Depends(get_user)],
+    page: Annotated[int | None, Query(ge=1)] = None,
 ):
     """List of rulling for a specific court."""
+    headers = await _listing_headers(request)
+    if _not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
     cursor = (page - 1) * settings.page_size if page else 0
-    decisions = []
     total = await decision_service.count_court(code_chambre)
-    count = 0
-    total_page = math.ceil(total / settings.page_size)
-    async for decision in decision_service.get_summary_for_court(
+    decisions = decision_service.get_summary_for_court(
         code_chambre, cursor, settings.page_size
-    ):
-        count += 1
-        decisions.append(dict(decision))
-    return {
-        "stats": {
-            "count": count,
-            "total": total,
-            "page": page or 1,
-            "page_size": settings.page_size,
-            "total_page": total_page,
-        },
-        "decisions": decisions,
-    }
+    )
+    return await _page_response(headers, decisions, total, page)
 
 
 @app.get("/decision/{decision_id}")
 async def get_decision(
-    decision_id, user: Annotated[User, Depends(get_user)], page: int | None = None
+    decision_id,
+    request: Request,
+    user: Annotated[User, Depends(get_user)],
+    page: int | None = None,
+    fields: str | None = None,
+    paragraphs: str | None = None,
+    compact: bool = False,
 ):
-    """Get a specific decision by its identifier."""
-    decision = await decision_service.get_decision(decision_id)
+    """Get a specific decision by its identifier, only the comma separated
+    `fields` if given and only the `paragraphs` range (`0:5`) of its
+    paragraphes, as one text with the offsets of its lines and paragraphs if
+    `compact` (see `app.compact`). Its ETag is the hash of its content stored
+    at indexing, a client which has it already is answered without fetching
+    the decision."""
+    fields, paragraphs = _projection(fields, paragraphs)
+    if "if-none-match" in request.headers:
+        version = await decision_service.get_version(decision_id)
+        if version:
+            headers = await _cache_headers(
+                _decision_etag(version, fields, paragraphs, compact),
+                settings.decision_cache_control,
+            )
+            if _not_modified(request, headers):
+                return Response(
+                    status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+                )
+    if fields is None and paragraphs is None:
+        decision, version = await decision_service.get_decision_version(
+            decision_id, compact
+        )
+        content = decision and decision.model_dump_json()
+    else:
+        decision, version = await decision_service.get_decision_part(
+            decision_id, fields, paragraphs, compact
+        )
+        content = decision and json.dumps(
+            decision, ensure_ascii=False, separators=(",", ":")
+        )
     if not decision:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Doesn't exist",
         )
-    return dict(decision)
+    headers = {}
+    if version:
+        headers = await _cache_headers(
+            _decision_etag(version, fields, paragraphs, compact),
+            settings.decision_cache_control,
+        )
+    # the model is serialised at once rather than through jsonable_encoder
+    return Response(content, media_type="application/json", headers=headers)
+
+
+@app.get("/decision/{decision_id}/cites")
+async def get_decision_citations(decision_id, user: Annotated[User, Depends(get_user)]):
+    """References cited by a specific decision."""
+    citations = await decision_service.get_citations(decision_id)
+    if not citations:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Doesn't exist",
+        )
+    return dict(citations)
+
+
+@app.get("/decision/{decision_id}/related")
+async def get_decision_related(decision_id, user: Annotated[User, Depends(get_user)]):
+    """Decisions related to a specific decision, the closest first."""
+    related = await decision_service.get_related(decision_id)
+    if not related:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Doesn't exist",
+        )
+    return dict(related)
+
+
+@app.get("/decision/{decision_id}/cited-by")
+async def get_decision_cited_by(
+    decision_id,
+    request: Request,
+    user: Annotated[User, Depends(get_user)],
+    page: Annotated[int | None, Query(ge=1)] = None,
+):
+    """List of rulling citing a specific decision."""
+    headers = await _listing_headers(request)
+    if _not_modified(request, headers):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    cursor = (page - 1) * settings.page_size if page else 0
+    total = await decision_service.count_citing(decision_id)
+    decisions = decision_service.get_citing(decision_id, cursor, settings.page_size)
+    return await _page_response(headers, decisions, total, page)
+
+
+@app.post("/search/batch")
+async def search_decision_batch(
+    batch: BatchSearch, user: Annotated[User, Depends(get_user)]
+):
+    """Runs several fulltext searches in one request. The results come in the
+    order of the queries, each one with its duration in milliseconds and its
+    results, or its error."""
+    if len(batch.queries) > settings.batch_max_queries:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"at most {settings.batch_max_queries} queries by batch",
+        )
+    items = await decision_service.search_batch(
+        batch.queries, settings.batch_concurrency
+    )
+    results = []
+    for item in items:
+        if "error" in item:
+            results.append({"took_ms": item["took"], "error": item["error"]})
+        else:
+            results.append(
+                {
+                    "took_ms": item["took"],
+                    "results": [
+                        {"score": score, "decision": decision.model_dump()}
+                        for score, decision in item["results"]
+                    ],
+                }
+            )
+    return Response(
+        json.dumps({"results": results}, ensure_ascii=False),
+        media_type="application/json",
+    )
 
 
 @app.get("/search")
 async def search_decision(
-    query: str, user: Annotated[User, Depends(get_user)], page: int | None = None
+    query: str,
+    user: Annotated[User, Depends(get_user)],
+    page: Annotated[int | None, Query(ge=1)] = None,
+    since: date | None = None,
+    until: date | None = None,
 ):
-    """Fulltext search on the content of court decision."""
-    res = []
-    async for score, dec in decision_service.fulltext_search(query):
-        res.append({"score": score, "decision": dict(dec)})
-    return {"result": res}
+    """Fulltext search on the content of court decision, rendered between
+    `since` and `until` when given (`2023-01-31`)."""
+    # the search runs before the response starts, its results are streamed
+    found = await _started(decision_service.fulltext_search(query, since, until))
+
+    async def results():
+        async for score, decision in found:
+            yield b'{"score":%s,"decision":%s}' % (
+                json.dumps(score).encode(),
+                decision.model_dump_json().encode(),
+            )
+
+    return StreamingResponse(
+        _json_stream({}, "result", results()), media_type="application/json"
+    )
@@ -0,0 +1,31 @@
+"""Storage backends the documents are indexed in and fetched from.
+
+See `app.backends.base` for the interface they implement. The
+`elasticsearch-yearly` backend splits the documents in an index by year
+behind an alias, see `YearlyElasticsearchBackend`.
+"""
+
+from app.exceptions import ConfigurationError
+
+
+BACKENDS = ("elasticsearch", "elasticsearch-yearly", "sqlite")
+
+
+def get_backend(name, index, sqlite_path=None):
+    """Returns the backend called `name` storing the documents under
+    `index`."""
+    if name == "elasticsearch":
+        from app.backends.es import ElasticsearchBackend
+
+        return ElasticsearchBackend(index)
+    elif name == "elasticsearch-yearly":
+        from app.backends.es import YearlyElasticsearchBackend
+
+        return YearlyElasticsearchBackend(index)
+    elif name == "sqlite":
+        from app.backends.sqlite import SQLiteBackend
+
+        if not sqlite_path:
+            raise ConfigurationError("No path to the SQLite database")
+        return SQLiteBackend(sqlite_path, index)
+    raise ConfigurationError(f"Unknown backend {name}, expected one of {BACKENDS}")
@@ -0,0 +1,147 @@
+"""The interface a storage backend has to implement.
+
+Documents are stored as dicts as given by `Indexer.prepare_document` and
+returned with their date as an iso formatted string, as Elastic Search does.
+Summaries are dicts with the `identifier`, `title` and `code_chambre` keys.
+Writing operations return one item per document following the ES bulk items
+shape: `{"_id": ..., "result": "created" | "updated", "status": 201 | 200}`
+or `{"_id": ..., "error": ..., "status": 4xx | 5xx}` on failure.
+"""
+
+import asyncio
+import time
+
+
+DEFAULT_SIZE = 10
+
+
+class Backend:
+    """Base class of the storage backends."""
+
+    async def setup(self):
+        """Creates the storage for the documents if it doesn't exist."""
+        raise NotImplementedError
+
+    async def drop(self):
+        """Removes the storage and all the documents."""
+        raise NotImplementedError
+
+    async def refresh(self):
+        """Makes the last written documents visible to the readers."""
+
+    async def connect(self, connections=10):
+        """Opens up to `connections` connections to the storage, kept for the
+        following calls, before the first requests come."""
+
+    async def close(self):
+        """Closes the connections opened by `connect`."""
+
+    async def put(self, identifier, document):
+        """Stores a document under `identifier`, replacing the previous
+        version if any."""
+        raise NotImplementedError
+
+    async def bulk_index(self, documents, version=None):
+        """Stores several documents at once under their `identifier`. With a
+        `version`, an integer growing with the archives the documents come
+        from, a document stored with a greater version is kept and reported
+        with the `noop` result, so that documents loaded out of order end up
+        in their last version."""
+        raise NotImplementedError
+
+    async def bulk_delete(self, identifiers):
+        """Deletes the documents stored under `identifiers`. Returns a result
+        by document found."""
+        raise NotImplementedError
+
+    async def count(self, court=None):
+        """Count of documents, for a specific court if given."""
+        raise NotImplementedError
+
+    async def count_by_court(self):
+        """Counts of documents by court, in one request."""
+        raise NotImplementedError
+
+    async def count_citing(self, target):
+        """Count of documents citing `target`."""
+        raise NotImplementedError
+
+    async def summaries(self, court=None, cursor=0, size=None):
+        """Summaries of documents sorted by date, for a specific court if
+        given."""
+        raise NotImplementedError
+
+    async def citing(self, target, cursor=0, size=None):
+        """Summaries of documents citing `target`, sorted by date."""
+        raise NotImplementedError
+
+    async def get(self, identifier, fields=None, paragraphs=None):
+        """Returns the document stored under `identifier` or None. Only
+        `fields` are returned when given, and only the `paragraphs` range
+        (a `slice`) of its paragraphes."""
+        raise NotImplementedError
+
+    async def walk_summaries(self, batch_size=1000):
+        """Yields the summaries of all the documents sorted by date, with
+        their `date`, fetching them `batch_size` at a time."""
+        raise NotImplementedError
+        yield
+
+    async def walk_fingerprints(self, batch_size=1000):
+        """Yields the (identifier, content hash) of all the documents sorted
+        by identifier, the hash None for those indexed without it, fetching
+        them `batch_size` at a time."""
+        raise NotImplementedError
+        yield
+
+    async def walk_features(self, batch_size=1000):
+        """Yields the `identifier`, `code_chambre`, `cites` and `terms` of all
+        the documents as dicts, fetching them `batch_size` at a time."""
+        raise NotImplementedError
+        yield
+
+    async def generation(self):
+        """The generation of the documents last set with `set_generation`,
+        None if never set."""
+        raise NotImplementedError
+
+    async def set_generation(self, generation):
+        """Marks the documents stored as a new generation, so that the
+        readers holding data derived from them know they have to reload."""
+        raise NotImplementedError
+
+    async def search(self, query, size=None, since=None, until=None):
+        """Fulltext search on the content of the documents, dated between
+        the dates `since` and `until` when given. Returns (score, summary)
+        pairs, the more relevant first."""
+        raise NotImplementedError
+
+    async def search_batch(self, searches, concurrency=8):
+        """Runs several searches, dicts of the `search` arguments, at most
+        `concurrency` at once. Returns for each one in order a dict with the
+        `hits` as `search` returns them or the `error`, and its duration in
+        milliseconds under `took`."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run(search):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    result = {"hits": await self.search(**search)}
+                except Exception as e:
+                    result = {"error": f"{e.__class__.__name__}: {e}"}
+                result["took"] = round((time.perf_counter() - start) * 1000, 3)
+                return result
+
+        return await asyncio.gather(*(run(search) for search in searches))
+
+    async def update_citation_counts(self):
+        """Stores on each cited decision the number of documents citing it
+        under `cited_by_count`. Returns the counts by cited identifier."""
+        raise NotImplementedError
+
+    async def update_related(self, related):
+        """Stores the identifiers of the related decisions of each document,
+        (identifier, related) pairs of `related`, under `related`. Returns
+        the count of documents updated."""
+        raise NotImplementedError
@@ -0,0 +1,646 @@
+"""Elastic Search backend, connections are provided by the `app.es` module."""
+
+import asyncio
+from datetime import date
+import itertools
+
+import elasticsearch
+
+from app.backends.base import Backend
+from app.es import async_client, close_pool, open_pool
+from app.legifrance.parser import DECISION_ID
+from app.tracing import record_took
+
+
+class ElasticsearchBackend(Backend):
+    """Stores the documents under an Elastic Search index."""
+
+    MAPPINGS = {
+        "properties": {
+            "cites": {"type": "keyword"},
+            "cited_by_count": {"type": "integer"},
+            "related": {"type": "keyword"},
+            # the most frequent words of the paragraphes, see app.related
+            "terms": {"type": "keyword", "index": False},
+            "content_hash": {"type": "keyword", "index": False},
+            # the paragraphes of the documents indexed compact, see app.compact
+            "paragraphes_text": {"type": "text"},
+            "paragraphes_offsets": {"type": "object", "enabled": False},
+        }
+    }
+    SUMMARY_FIELDS = ["title", "identifier", "code_chambre"]
+    BULK_SIZE = 500
+    MSEARCH_SIZE = 100
+    # how long a point in time is kept between two pages
+    PIT_KEEP_ALIVE = "5m"
+
+    def __init__(self, index):
+        self.index = index
+
+    @staticmethod
+    def _summary(item):
+        return {field: item["fields"][field][0] for field in item["fields"]}
+
+    @staticmethod
+    def _court_query(court):
+        return {"match": {"code_chambre": court.lower()}}
+
+    @staticmethod
+    def _part(document, paragraphs):
+        # source filtering can't take a part of an array: all the paragraphes
+        # were transferred and decoded, only the result is cut
+        if paragraphs is not None and "paragraphes" in document:
+            document["paragraphes"] = document["paragraphes"][paragraphs]
+        return document
+
+    def _write_index(self, document):
+        """The index `document` is written in."""
+        return self.index
+
+    def _search_indices(self, since, until):
+        """The indices to search for documents dated between `since` and
+        `until`, None when none can hold them."""
+        return self.index
+
+    async def _locate(self, client, identifiers):
+        """The index of each of the documents `identifiers`."""
+        return dict.fromkeys(identifiers, self.index)
+
+    async def setup(self):
+        """Creates the index with the mappings the service relies on, or adds
+        them to the index if it already exists."""
+        async with async_client() as client:
+            if await client.indices.exists(index=self.index):
+                await client.indices.put_mapping(
+                    index=self.index, properties=self.MAPPINGS["properties"]
+                )
+            else:
+                await client.indices.create(index=self.index, mappings=self.MAPPINGS)
+
+    async def drop(self):
+        async with async_client() as client:
+            await client.indices.delete(index=self.index)
+
+    async def refresh(self):
+        async with async_client() as client:
+            await client.indices.refresh(index=self.index)
+
+    async def connect(self, connections=10):
+        """Opens the client shared by the calls, then as many concurrent
+        requests as `connections` for its pool to open them."""
+        client = await open_pool(connections)
+        await asyncio.gather(
+            *(
+                client.count(index=self.index, ignore_unavailable=True)
+                for _ in range(connections)
+            )
+        )
+
+    async def close(self):
+        await close_pool()
+
+    async def put(self, identifier, document):
+        async with async_client() as client:
+            resp = await client.index(
+                index=self._write_index(document),
+                document=document,
+                id=identifier,
+            )
+        return {**resp.body, "status": resp.meta.status}
+
+    async def bulk_index(self, documents, version=None):
+        operations = []
+        for document in documents:
+            action = {
+                "_index": self._write_index(document),
+                "_id": document["identifier"],
+            }
+            if version is not None:
+                # the conflicts on a greater stored version are reported as
+                # noop, the document being already in a later version
+                action.update(version=version, version_type="external_gte")
+            operations.append({"index": action})
+            operations.append(document)
+        if not operations:
+            return []
+        async with async_client() as client:
+            resp = await client.bulk(operations=operations)
+        items = [item["index"] for item in resp["items"]]
+        if version is not None:
+            items = [
+                (
+                    {"_id": item["_id"], "result": "noop", "status": 200}
+                    if item["status"] == 409
+                    else item
+                )
+                for item in items
+            ]
+        return items
+
+    async def bulk_delete(self, identifiers):
+        async with async_client() as client:
+            locations = await self._locate(client, list(identifiers))
+            operations = [
+                {"delete": {"_index": index, "_id": identifier}}
+                for identifier, index in locations.items()
+            ]
+            if not operations:
+                return []
+            resp = await client.bulk(operations=operations)
+        return [item["delete"] for item in resp["items"]]
+
+    async def count(self, court=None):
+        async with async_client() as client:
+            resp = await client.count(
+                index=self.index,
+                query=self._court_query(court) if court else {"match_all": {}},
+            )
+        return resp["count"]
+
+    async def count_by_court(self):
+        async with async_client() as client:
+            resp = await client.search(
+                index=self.index,
+                size=0,
+                aggs={
+                    "courts": {"terms": {"field": "code_chambre.keyword", "size": 1000}}
+                },
+            )
+        record_took(resp.get("took"))
+        return {
+            bucket["key"]: bucket["doc_count"]
+            for bucket in resp["aggregations"]["courts"]["buckets"]
+        }
+
+    async def count_citing(self, target):
+        async with async_client() as client:
+            resp = await client.count(
+                index=self.index,
+                query={"term": {"cites": target}},
+            )
+        return resp["count"]
+
+    async def _summaries(self, query, cursor, size):
+        async with async_client() as client:
+            resp = await client.search(
+                index=self.index,
+                fields=self.SUMMARY_FIELDS,
+                query=query,
+                sort=[{"date": {"order": "asc", "format": "strict_date"}}],
+                size=size,
+                from_=cursor,
+                _source=False,
+            )
+        record_took(resp.get("took"))
+        return [self._summary(item) for item in resp["hits"]["hits"]]
+
+    async def summaries(self, court=None, cursor=0, size=None):
+        query = self._court_query(court) if court else {"match_all": {}}
+        return await self._summaries(query, cursor, size)
+
+    async def citing(self, target, cursor=0, size=None):
+        return await self._summaries({"term": {"cites": target}}, cursor, size)
+
+    async def walk_summaries(self, batch_size=1000):
+        # from_ can't go beyond 10000 hits, pages follow each other with
+        # search_after on a unique sort
+        sort = [
+            {"date": {"order": "asc", "format": "strict_date"}},
+            {"identifier.keyword": {"order": "asc"}},
+        ]
+        fields = [*self.SUMMARY_FIELDS, {"field": "date", "format": "strict_date"}]
+        after = None
+        async with async_client() as client:
+            while True:
+                resp = await client.search(
+                    index=self.index,
+                    fields=fields,
+                    sort=sort,
+                    size=batch_size,
+                    search_after=after,
+                    _source=False,
+                )
+                hits = resp["hits"]["hits"]
+                for item in hits:
+                    yield self._summary(item)
+                if len(hits) < batch_size:
+                    break
+                after = hits[-1]["sort"]
+
+    async def _walk(self, client, batch_size, **body):
+        """Yields the hits of a search on all the documents sorted by
+        identifier, `batch_size` at a time through a point in time that
+        keeps the pages consistent with the documents changed meanwhile."""
+        pit = await client.open_point_in_time(
+            index=self.index, keep_alive=self.PIT_KEEP_ALIVE
+        )
+        pit_id = pit["id"]
+        after = None
+        try:
+            while True:
+                resp = await client.search(
+                    pit={"id": pit_id, "keep_alive": self.PIT_KEEP_ALIVE},
+                    sort=[{"identifier.keyword": {"order": "asc"}}],
+                    size=batch_size,
+                    search_after=after,
+                    track_total_hits=False,
+                    **body,
+                )
+                pit_id = resp.get("pit_id", pit_id)
+                hits = resp["hits"]["hits"]
+                for hit in hits:
+                    yield hit
+                if len(hits) < batch_size:
+                    break
+                after = hits[-1]["sort"]
+        finally:
+            await client.close_point_in_time(id=pit_id)
+
+    async def walk_fingerprints(self, batch_size=1000):
+        # only the doc values are read
+        async with async_client() as client:
+            hits = self._walk(
+                client, batch_size, docvalue_fields=["content_hash"], _source=False
+            )
+            async for hit in hits:
+                fingerprint = hit.get("fields", {}).get("content_hash")
+                yield hit["_id"], fingerprint and fingerprint[0]
+
+    async def walk_features(self, batch_size=1000):
+        fields = ["identifier", "code_chambre", "cites", "terms"]
+        async with async_client() as client:
+            async for hit in self._walk(client, batch_size, _source=fields):
+                source = hit["_source"]
+                yield {field: source.get(field) for field in fields}
+
+    async def generation(self):
+        async with async_client() as client:
+            resp = await client.indices.get_mapping(index=self.index)
+        generations = [
+            mapping["mappings"].get("_meta", {}).get("generation")
+            for mapping in resp.body.values()
+        ]
+        return max(filter(None, generations), default=None)
+
+    async def set_generation(self, generation):
+        async with async_client() as client:
+            await client.indices.put_mapping(
+                index=self.index, meta={"generation": generation}
+            )
+
+    async def get(self, identifier, fields=None, paragraphs=None):
+        async with async_client() as client:
+            try:
+                resp = await client.get(
+                    index=self.index, id=identifier, source_includes=fields
+                )
+            except elasticsearch.NotFoundError:
+                return None
+        return self._part(resp["_source"], paragraphs)
+
+    def _search_request(self, query, size=None, since=None, until=None):
+        """The indices and the body of a fulltext search, None when no index
+        can hold the documents searched."""
+        index = self._search_indices(since, until)
+        if index is None:
+            return None
+        # a document has its paragraphes in one of the fields
+        match = {
+            "bool": {
+                "should": [
+                    {"match": {"paragraphes": {"query": query}}},
+                    {"match": {"paragraphes_text": {"query": query}}},
+                ]
+            }
+        }
+        if since or until:
+            dates = {"format": "strict_date"}
+            if since:
+                dates["gte"] = since.isoformat()
+            if until:
+                dates["lte"] = until.isoformat()
+            match = {"bool": {"must": match, "filter": {"range": {"date": dates}}}}
+        body = {"query": match, "fields": self.SUMMARY_FIELDS, "_source": False}
+        if size is not None:
+            body["size"] = size
+        return index, body
+
+    def _hits(self, resp):
+        return [(item["_score"], self._summary(item)) for item in resp["hits"]["hits"]]
+
+    async def search(self, query, size=None, since=None, until=None):
+        request = self._search_request(query, size, since, until)
+        if request is None:
+            return []
+        index, body = request
+        async with async_client() as client:
+            resp = await client.search(index=index, ignore_unavailable=True, **body)
+        record_took(resp.get("took"))
+        return self._hits(resp)
+
+    async def search_batch(self, searches, concurrency=8):
+        """Runs the searches by `MSEARCH_SIZE` in a `msearch` request, the
+        cluster running at most `concurrency` of them at once."""
+        results = [None] * len(searches)
+        for start in range(0, len(searches), self.MSEARCH_SIZE):
+            operations = []
+            positions = []
+            for position in range(start, min(start + self.MSEARCH_SIZE, len(searches))):
+                request = self._search_request(**searches[position])
+                if request is None:
+                    results[position] = {"hits": [], "took": 0}
+                    continue
+                index, body = request
+                operations += [{"index": index, "ignore_unavailable": True}, body]
+                positions.append(position)
+            if not operations:
+                continue
+            try:
+                async with async_client() as client:
+                    resp = await client.msearch(
+                        searches=operations, max_concurrent_searches=concurrency
+                    )
+            except (elasticsearch.ApiError, elasticsearch.TransportError) as e:
+                for position in positions:
+                    results[position] = {
+                        "error": f"{e.__class__.__name__}: {e}",
+                        "took": None,
+                    }
+                continue
+            record_took(resp.get("took"))
+            for position, response in zip(positions, resp["responses"]):
+                if "error" in response:
+                    error = response["error"]
+                    results[position] = {
+                        "error": f"{error.get('type')}: {error.get('reason')}",
+                        "took": response.get("took"),
+                    }
+                else:
+                    results[position] = {
+                        "hits": self._hits(response),
+                        "took": response["took"],
+                    }
+        return results
+
+    async def update_citation_counts(self):
+        counts = {}
+        async with async_client() as client:
+            await client.indices.refresh(index=self.index)
+            composite = {
+                "size": self.BULK_SIZE,
+                "sources": [{"target": {"terms": {"field": "cites"}}}],
+            }
+            while True:
+                resp = await client.search(
+                    index=self.index,
+                    size=0,
+                    aggs={"targets": {"composite": composite}},
+                )
+                targets = resp["aggregations"]["targets"]
+                for bucket in targets["buckets"]:
+                    target = bucket["key"]["target"]
+                    if DECISION_ID.match(target):
+                        counts[target] = bucket["doc_count"]
+                if not targets["buckets"] or "after_key" not in targets:
+                    break
+                composite["after"] = targets["after_key"]
+
+            operations = []
+            # the decisions no longer cited are reset
+            cited = self._walk(
+                client,
+                self.BULK_SIZE,
+                query={"range": {"cited_by_count": {"gt": 0}}},
+                _source=False,
+            )
+            async for hit in cited:
+                if hit["_id"] not in counts:
+                    operations.append(
+                        {"update": {"_index": hit["_index"], "_id": hit["_id"]}}
+                    )
+                    operations.append({"doc": {"cited_by_count": 0}})
+                    if len(operations) >= 2 * self.BULK_SIZE:
+                        await client.bulk(operations=operations)
+                        operations = []
+            locations = await self._locate(client, list(counts))
+            for target, index in locations.items():
+                operations.append({"update": {"_index": index, "_id": target}})
+                operations.append({"doc": {"cited_by_count": counts[target]}})
+                if len(operations) >= 2 * self.BULK_SIZE:
+                    # cited decisions not in the index are reported as missing
+                    # by ES, they are just ignored.
+                    await client.bulk(operations=operations)
+                    operations = []
+            if operations:
+                await client.bulk(operations=operations)
+        return counts
+
+    async def update_related(self, related):
+        updated = 0
+        related = iter(related)
+        async with async_client() as client:
+            while True:
+                batch = dict(itertools.islice(related, self.BULK_SIZE))
+                if not batch:
+                    return updated
+                operations = []
+                locations = await self._locate(client, list(batch))
+                for identifier, index in locations.items():
+                    operations.append({"update": {"_index": index, "_id": identifier}})
+                    operations.append({"doc": {"related": batch[identifier]}})
+                resp = await client.bulk(operations=operations)
+                updated += sum(item["update"]["status"] < 400 for item in resp["items"])
+
+
+class YearlyElasticsearchBackend(ElasticsearchBackend):
+    """Stores the documents in an index by year of their date,
+    `{index}-{year}`, created from a shared index template giving them the
+    mappings and the alias `index` the reads go through. The searches on a
+    range of dates only target the indices of its years, and the indices of
+    the past years, no longer written, can be force merged and made read
+    only.
+
+    A document is routed by its date: when its date changed in a later
+    archive, the copy left in the index of its former year is deleted once
+    it is written again, unless that copy is of a later version: the
+    versions are compared across the indices before writing.
+    """
+
+    def _year_index(self, year):
+        return f"{self.index}-{year}"
+
+    def _write_index(self, document):
+        value = document.get("date")
+        if not value:
+            return self._year_index("undated")
+        return self._year_index(
+            value.year if isinstance(value, date) else int(value[:4])
+        )
+
+    def _search_indices(self, since, until):
+        if since is None:
+            # without a lower bound the range filter on the alias is left to
+            # skip the shards out of it
+            return self.index
+        last = until.year if until else date.today().year
+        if last < since.year:
+            return None
+        return ",".join(self._year_index(year) for year in range(since.year, last + 1))
+
+    async def _locate(self, client, identifiers):
+        locations = {}
+        for start in range(0, len(identifiers), self.BULK_SIZE):
+            batch = identifiers[start : start + self.BULK_SIZE]
+            resp = await client.search(
+                index=self.index,
+                query={"ids": {"values": batch}},
+                size=len(batch),
+                _source=False,
+            )
+            for hit in resp["hits"]["hits"]:
+                locations[hit["_id"]] = hit["_index"]
+        return locations
+
+    async def _copies(self, identifiers):
+        """The index and version of the copies of the documents
+        `identifiers` by identifier."""
+        if not identifiers:
+            return {}
+        async with async_client() as client:
+            resp = await client.search(
+                index=self.index,
+                query={"ids": {"values": identifiers}},
+                # in one index, two when its date changed
+                size=2 * len(identifiers),
+                version=True,
+                _source=False,
+            )
+        copies = {}
+        for hit in resp["hits"]["hits"]:
+            copies.setdefault(hit["_id"], []).append((hit["_index"], hit["_version"]))
+        return copies
+
+    async def _delete_copies(self, stale, version=None):
+        """Deletes the copies `stale` given as (index, identifier), unless
+        they got a version greater than `version` meanwhile."""
+        operations = []
+        for index, identifier in stale:
+            action = {"_index": index, "_id": identifier}
+            if version is not None:
+                action.update(version=version, version_type="external_gte")
+            operations.append({"delete": action})
+        if operations:
+            async with async_client() as client:
+                await client.bulk(operations=operations)
+
+    async def put(self, identifier, document):
+        copies = await self._copies([identifier])
+        result = await super().put(identifier, document)
+        await self._delete_copies(
+            [
+                (index, identifier)
+                for index, _ in copies.get(identifier, ())
+                if index != result["_index"]
+            ]
+        )
+        return result
+
+    async def bulk_index(self, documents, version=None):
+        # the versions of ES only conflict within an index, those of the
+        # copies in the index of another year are compared here
+        copies = await self._copies([document["identifier"] for document in documents])
+        newer, stale = set(), {}
+        for document in documents:
+            identifier = document["identifier"]
+            index = self._write_index(document)
+            for other, stored in copies.get(identifier, ()):
+                if other == index:
+                    continue
+                if version is not None and stored > version:
+                    newer.add(identifier)
+                else:
+                    stale.setdefault(identifier, []).append(other)
+        written = iter(
+            await super().bulk_index(
+                [
+                    document
+                    for document in documents
+                    if document["identifier"] not in newer
+                ],
+                version,
+            )
+        )
+        items = [
+            (
+                {"_id": document["identifier"], "result": "noop", "status": 200}
+                if document["identifier"] in newer
+                else next(written)
+            )
+            for document in documents
+        ]
+        await self._delete_copies(
+            [
+                (index, item["_id"])
+                for item in items
+                if item["status"] < 400 and item.get("result") != "noop"
+                for index in stale.get(item["_id"], ())
+            ],
+            version,
+        )
+        return items
+
+    async def bulk_delete(self, identifiers):
+        # every copy, a document whose date changed may be in two indices
+        async with async_client() as client:
+            hits = self._walk(
+                client,
+                self.BULK_SIZE,
+                query={"ids": {"values": list(identifiers)}},
+                _source=False,
+            )
+            operations = [
+                {"delete": {"_index": hit["_index"], "_id": hit["_id"]}}
+                async for hit in hits
+            ]
+            if not operations:
+                return []
+            resp = await client.bulk(operations=operations)
+        return [item["delete"] for item in resp["items"]]
+
+    async def setup(self):
+        """Puts the template of the yearly indices, and creates the index of
+        the current year for the alias to exist before any document is
+        indexed."""
+        async with async_client() as client:
+            await client.indices.put_index_template(
+                name=self.index,
+                index_patterns=[f"{self.index}-*"],
+                template={"mappings": self.MAPPINGS, "aliases": {self.index: {}}},
+            )
+            if await client.indices.exists(index=self.index):
+                await client.indices.put_mapping(
+                    index=self.index, properties=self.MAPPINGS["properties"]
+                )
+            else:
+                await client.indices.create(index=self._year_index(date.today().year))
+
+    async def drop(self):
+        async with async_client() as client:
+            # deleting with a wildcard is refused by default
+            resp = await client.indices.get_alias(name=self.index)
+            await client.indices.delete(index=",".join(resp.body))
+            await client.indices.delete_index_template(name=self.index)
+
+    async def get(self, identifier, fields=None, paragraphs=None):
+        # a get can't go through an alias of several indices
+        async with async_client() as client:
+            resp = await client.search(
+                index=self.index,
+                query={"ids": {"values": [identifier]}},
+                source_includes=fields,
+                size=1,
+            )
+        hits = resp["hits"]["hits"]
+        if not hits:
+            return None
+        return self._part(hits[0]["_source"], paragraphs)
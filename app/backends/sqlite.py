@@ -0,0 +1,499 @@
+"""Embedded backend storing the documents in a SQLite database, no outside
+service needed.
+
+The fulltext search relies on an FTS5 table ranked with bm25. Summaries are
+read through an index on (date, identifier) and the position reached by the
+last pages served is kept, so that walking through the pages seeks to the
+next key instead of skipping `cursor` rows (keyset pagination).
+
+Queries are run in the default executor, each thread having its own
+connection to the database which is opened in WAL mode so that readers
+don't wait for writers.
+"""
+
+import asyncio
+from datetime import date, timedelta
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from app.backends.base import Backend, DEFAULT_SIZE
+from app.compact import OFFSETS_FIELD, TEXT_FIELD
+from app.legifrance.parser import DECISION_ID
+
+
+# the terms of a query, split like the FTS tokenizer splits the paragraphes
+TERM = re.compile(r"[\w'’]+")
+
+
+def quote(name):
+    """Quotes `name` to be used as an identifier in a SQL statement."""
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _default(obj):
+    if isinstance(obj, date):
+        return obj.isoformat()
+    raise TypeError(f"{obj.__class__.__name__} is not JSON serializable")
+
+
+def _isoformat(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+class SQLiteBackend(Backend):
+    """Stores the documents in the tables prefixed by `index` of the SQLite
+    database under `path`."""
+
+    # The FTS tokenizer keeps apostrophes and diacritics like the ES standard
+    # analyzer does, so that both backends find the same documents.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS {docs} (
+            rowid INTEGER PRIMARY KEY,
+            identifier TEXT NOT NULL UNIQUE,
+            date TEXT,
+            code_chambre TEXT,
+            title TEXT,
+            cited_by_count INTEGER NOT NULL DEFAULT 0,
+            paragraphes TEXT NOT NULL,
+            source TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS {by_date} ON {docs} (date, identifier);
+        CREATE INDEX IF NOT EXISTS {by_court}
+            ON {docs} (code_chambre COLLATE NOCASE, date, identifier);
+        CREATE TABLE IF NOT EXISTS {cites} (
+            target TEXT NOT NULL,
+            rowid INTEGER NOT NULL,
+            PRIMARY KEY (target, rowid)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS {versions} (
+            identifier TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS {meta} (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+            paragraphes, content={content}, content_rowid=rowid,
+            tokenize="unicode61 remove_diacritics 0 tokenchars '''’'"
+        );
+    """
+    MAX_ANCHORS = 1024
+
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self.docs = quote(index)
+        self.fts = quote(f"{index}_fts")
+        self.cites = quote(f"{index}_cites")
+        self.meta = quote(f"{index}_meta")
+        self.versions = quote(f"{index}_versions")
+        self._local = threading.local()
+        self._anchors = {}
+        self._anchors_lock = threading.Lock()
+        self._generation = None
+
+    @property
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args))
+
+    def _current_generation(self):
+        """Changes each time a connection commits in the database."""
+        try:
+            wal = os.stat(f"{self.path}-wal").st_mtime_ns
+        except FileNotFoundError:
+            wal = None
+        return (os.stat(self.path).st_mtime_ns, wal)
+
+    def _setup(self):
+        with self._connection as connection:
+            connection.executescript(
+                self.SCHEMA.format(
+                    docs=self.docs,
+                    fts=self.fts,
+                    cites=self.cites,
+                    meta=self.meta,
+                    versions=self.versions,
+                    by_date=quote(f"{self.index}_by_date"),
+                    by_court=quote(f"{self.index}_by_court"),
+                    content="'" + self.index.replace("'", "''") + "'",
+                )
+            )
+
+    async def setup(self):
+        await self._run(self._setup)
+
+    def _drop(self):
+        with self._connection as connection:
+            for table in (self.fts, self.cites, self.meta, self.versions, self.docs):
+                connection.execute(f"DROP TABLE IF EXISTS {table}")
+
+    async def drop(self):
+        await self._run(self._drop)
+
+    def _index(self, connection, identifier, document, version=None):
+        if version is not None:
+            stored = connection.execute(
+                f"SELECT version FROM {self.versions} WHERE identifier = ?",
+                (identifier,),
+            ).fetchone()
+            if stored and stored[0] > version:
+                return {"_id": identifier, "result": "noop", "status": 200}
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.versions} (identifier, version) "
+                "VALUES (?, ?)",
+                (identifier, version),
+            )
+        source = dict(document)
+        if TEXT_FIELD in source:
+            # the text of the compact paragraphes, their offsets stay in source
+            paragraphes = source.pop(TEXT_FIELD)
+        else:
+            paragraphes = json.dumps(source.pop("paragraphes", []), ensure_ascii=False)
+        row = (
+            _isoformat(source.get("date")),
+            source.get("code_chambre"),
+            source.get("title"),
+            paragraphes,
+            json.dumps(source, ensure_ascii=False, default=_default),
+        )
+        previous = connection.execute(
+            f"SELECT rowid, paragraphes FROM {self.docs} WHERE identifier = ?",
+            (identifier,),
+        ).fetchone()
+        if previous:
+            rowid, previous_paragraphes = previous
+            connection.execute(
+                f"INSERT INTO {self.fts} ({self.fts}, rowid, paragraphes) "
+                "VALUES ('delete', ?, ?)",
+                (rowid, previous_paragraphes),
+            )
+            connection.execute(
+                f"UPDATE {self.docs} SET date = ?, code_chambre = ?, title = ?, "
+                "paragraphes = ?, source = ? WHERE rowid = ?",
+                (*row, rowid),
+            )
+            connection.execute(f"DELETE FROM {self.cites} WHERE rowid = ?", (rowid,))
+            result = {"_id": identifier, "result": "updated", "status": 200}
+        else:
+            rowid = connection.execute(
+                f"INSERT INTO {self.docs} "
+                "(identifier, date, code_chambre, title, paragraphes, source) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (identifier, *row),
+            ).lastrowid
+            result = {"_id": identifier, "result": "created", "status": 201}
+        connection.execute(
+            f"INSERT INTO {self.fts} (rowid, paragraphes) VALUES (?, ?)",
+            (rowid, paragraphes),
+        )
+        connection.executemany(
+            f"INSERT OR IGNORE INTO {self.cites} (target, rowid) VALUES (?, ?)",
+            [(target, rowid) for target in document.get("cites", [])],
+        )
+        return result
+
+    def _put(self, identifier, document):
+        with self._connection as connection:
+            return self._index(connection, identifier, document)
+
+    def _bulk_index(self, documents, version=None):
+        with self._connection as connection:
+            return [
+                self._index(connection, document["identifier"], document, version)
+                for document in documents
+            ]
+
+    async def put(self, identifier, document):
+        return await self._run(self._put, identifier, document)
+
+    def _bulk_delete(self, identifiers):
+        results = []
+        with self._connection as connection:
+            for identifier in identifiers:
+                row = connection.execute(
+                    f"SELECT rowid, paragraphes FROM {self.docs} WHERE identifier = ?",
+                    (identifier,),
+                ).fetchone()
+                if row is None:
+                    continue
+                connection.execute(
+                    f"INSERT INTO {self.fts} ({self.fts}, rowid, paragraphes) "
+                    "VALUES ('delete', ?, ?)",
+                    row,
+                )
+                connection.execute(f"DELETE FROM {self.cites} WHERE rowid = ?", row[:1])
+                connection.execute(f"DELETE FROM {self.docs} WHERE rowid = ?", row[:1])
+                connection.execute(
+                    f"DELETE FROM {self.versions} WHERE identifier = ?", (identifier,)
+                )
+                results.append({"_id": identifier, "result": "deleted", "status": 200})
+        return results
+
+    async def bulk_delete(self, identifiers):
+        return await self._run(self._bulk_delete, list(identifiers))
+
+    async def bulk_index(self, documents, version=None):
+        return await self._run(self._bulk_index, documents, version)
+
+    def _fetch(self, sql, params):
+        return self._connection.execute(sql, params).fetchall()
+
+    async def count(self, court=None):
+        if court:
+            sql = f"SELECT count(*) FROM {self.docs} WHERE code_chambre = ? COLLATE NOCASE"
+            params = (court,)
+        else:
+            sql, params = f"SELECT count(*) FROM {self.docs}", ()
+        return (await self._run(self._fetch, sql, params))[0][0]
+
+    async def count_by_court(self):
+        sql = f"SELECT code_chambre, count(*) FROM {self.docs} GROUP BY code_chambre"
+        return dict(await self._run(self._fetch, sql, ()))
+
+    async def count_citing(self, target):
+        sql = f"SELECT count(*) FROM {self.cites} WHERE target = ?"
+        return (await self._run(self._fetch, sql, (target,)))[0][0]
+
+    def _summaries(self, court, cursor, size):
+        generation = self._current_generation()
+        with self._anchors_lock:
+            if generation != self._generation:
+                self._anchors = {}
+                self._generation = generation
+            anchor = self._anchors.get((court, cursor))
+        where, params = [], []
+        if court:
+            where.append("code_chambre = ? COLLATE NOCASE")
+            params.append(court)
+        if anchor:
+            where.append("(date, identifier) > (?, ?)")
+            params += anchor
+        rows = self._fetch(
+            f"SELECT identifier, title, code_chambre, date FROM {self.docs} "
+            + (f"WHERE {' AND '.join(where)} " if where else "")
+            + "ORDER BY date, identifier LIMIT ? OFFSET ?",
+            (*params, size, 0 if anchor else cursor),
+        )
+        if rows:
+            with self._anchors_lock:
+                if len(self._anchors) >= self.MAX_ANCHORS:
+                    self._anchors.pop(next(iter(self._anchors)))
+                self._anchors[(court, cursor + len(rows))] = (rows[-1][3], rows[-1][0])
+        return [
+            {"identifier": identifier, "title": title, "code_chambre": code_chambre}
+            for identifier, title, code_chambre, _ in rows
+        ]
+
+    async def summaries(self, court=None, cursor=0, size=None):
+        size = DEFAULT_SIZE if size is None else size
+        return await self._run(self._summaries, court, cursor, size)
+
+    async def citing(self, target, cursor=0, size=None):
+        rows = await self._run(
+            self._fetch,
+            f"SELECT d.identifier, d.title, d.code_chambre FROM {self.cites} c "
+            f"JOIN {self.docs} d ON d.rowid = c.rowid WHERE c.target = ? "
+            "ORDER BY d.date, d.identifier LIMIT ? OFFSET ?",
+            (target, DEFAULT_SIZE if size is None else size, cursor),
+        )
+        return [
+            {"identifier": identifier, "title": title, "code_chambre": code_chambre}
+            for identifier, title, code_chambre in rows
+        ]
+
+    async def walk_summaries(self, batch_size=1000):
+        after = ("", "")
+        while True:
+            rows = await self._run(
+                self._fetch,
+                f"SELECT identifier, title, code_chambre, date FROM {self.docs} "
+                "WHERE (date, identifier) > (?, ?) "
+                "ORDER BY date, identifier LIMIT ?",
+                (*after, batch_size),
+            )
+            for identifier, title, code_chambre, date in rows:
+                yield {
+                    "identifier": identifier,
+                    "title": title,
+                    "code_chambre": code_chambre,
+                    "date": date[:10],
+                }
+            if len(rows) < batch_size:
+                break
+            after = (rows[-1][3], rows[-1][0])
+
+    async def walk_fingerprints(self, batch_size=1000):
+        after = ""
+        while True:
+            rows = await self._run(
+                self._fetch,
+                f"SELECT identifier, json_extract(source, '$.content_hash') "
+                f"FROM {self.docs} WHERE identifier > ? "
+                "ORDER BY identifier LIMIT ?",
+                (after, batch_size),
+            )
+            for row in rows:
+                yield row
+            if len(rows) < batch_size:
+                break
+            after = rows[-1][0]
+
+    async def walk_features(self, batch_size=1000):
+        after = ""
+        while True:
+            rows = await self._run(
+                self._fetch,
+                "SELECT identifier, code_chambre, json_extract(source, '$.cites'), "
+                f"json_extract(source, '$.terms') FROM {self.docs} "
+                "WHERE identifier > ? ORDER BY identifier LIMIT ?",
+                (after, batch_size),
+            )
+            for identifier, code_chambre, cites, terms in rows:
+                yield {
+                    "identifier": identifier,
+                    "code_chambre": code_chambre,
+                    "cites": json.loads(cites) if cites else [],
+                    "terms": json.loads(terms) if terms else [],
+                }
+            if len(rows) < batch_size:
+                break
+            after = rows[-1][0]
+
+    async def generation(self):
+        rows = await self._run(
+            self._fetch,
+            f"SELECT value FROM {self.meta} WHERE key = 'generation'",
+            (),
+        )
+        return rows[0][0] if rows else None
+
+    def _set_generation(self, generation):
+        with self._connection as connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO {self.meta} (key, value) "
+                "VALUES ('generation', ?)",
+                (generation,),
+            )
+
+    async def set_generation(self, generation):
+        await self._run(self._set_generation, generation)
+
+    def _get(self, identifier, fields, paragraphs):
+        with_paragraphes = fields is None or bool(
+            {"paragraphes", TEXT_FIELD} & set(fields)
+        )
+        column, params = ", paragraphes ", (identifier,)
+        if with_paragraphes and paragraphs is not None:
+            # only the asked paragraphs are read out of the json array, the
+            # text of the compact ones is cut by the service
+            start, stop, _ = paragraphs.indices(2**31)
+            column = (
+                f", CASE WHEN json_type(source, '$.{OFFSETS_FIELD}') IS NULL "
+                "THEN (SELECT json_group_array(json(value)) FROM "
+                "(SELECT value FROM json_each(paragraphes) "
+                "WHERE key >= ? AND key < ? ORDER BY key)) "
+                "ELSE paragraphes END "
+            )
+            params = (start, stop, identifier)
+        row = self._connection.execute(
+            f"SELECT source, cited_by_count"
+            + (column if with_paragraphes else " ")
+            + f"FROM {self.docs} WHERE identifier = ?",
+            params,
+        ).fetchone()
+        if row is None:
+            return None
+        document = json.loads(row[0])
+        if row[1]:
+            document["cited_by_count"] = row[1]
+        if with_paragraphes:
+            if OFFSETS_FIELD in document:
+                document[TEXT_FIELD] = row[2]
+            else:
+                document["paragraphes"] = json.loads(row[2])
+        if fields is not None:
+            document = {k: v for k, v in document.items() if k in fields}
+        return document
+
+    async def get(self, identifier, fields=None, paragraphs=None):
+        return await self._run(self._get, identifier, fields, paragraphs)
+
+    async def search(self, query, size=None, since=None, until=None):
+        terms = TERM.findall(query)
+        if not terms:
+            return []
+        # the dates are stored with their time
+        dates = ""
+        params = [" OR ".join(f'"{term}"' for term in terms)]
+        if since:
+            dates += " AND d.date >= ?"
+            params.append(since.isoformat())
+        if until:
+            dates += " AND d.date < ?"
+            params.append((until + timedelta(days=1)).isoformat())
+        rows = await self._run(
+            self._fetch,
+            f"SELECT d.identifier, d.title, d.code_chambre, -{self.fts}.rank "
+            f"FROM {self.fts} JOIN {self.docs} d ON d.rowid = {self.fts}.rowid "
+            f"WHERE {self.fts} MATCH ?{dates} ORDER BY {self.fts}.rank LIMIT ?",
+            (*params, DEFAULT_SIZE if size is None else size),
+        )
+        return [
+            (
+                score,
+                {
+                    "identifier": identifier,
+                    "title": title,
+                    "code_chambre": code_chambre,
+                },
+            )
+            for identifier, title, code_chambre, score in rows
+        ]
+
+    def _update_citation_counts(self):
+        with self._connection as connection:
+            counts = {
+                target: count
+                for target, count in connection.execute(
+                    f"SELECT target, count(*) FROM {self.cites} GROUP BY target"
+                )
+                if DECISION_ID.match(target)
+            }
+            connection.execute(f"UPDATE {self.docs} SET cited_by_count = 0")
+            connection.executemany(
+                f"UPDATE {self.docs} SET cited_by_count = ? WHERE identifier = ?",
+                [(count, target) for target, count in counts.items()],
+            )
+        return counts
+
+    async def update_citation_counts(self):
+        return await self._run(self._update_citation_counts)
+
+    def _update_related(self, related):
+        with self._connection as connection:
+            return connection.executemany(
+                f"UPDATE {self.docs} SET source = json_set(source, '$.related', "
+                "json(?)) WHERE identifier = ?",
+                (
+                    (json.dumps(identifiers), identifier)
+                    for identifier, identifiers in related
+                ),
+            ).rowcount
+
+    async def update_related(self, related):
+        return await self._run(self._update_related, related)
@@ -0,0 +1,159 @@
+"""Benchmarks of the project and the tools they share.
+
+Each benchmark is a script run as a module from the project root, it prints a
+report of the measures taken and can save them as a JSON baseline later runs
+are compared with, see `compare`.
+
+example:
+  $ python -m app.benchmarks.ingest --size 2000 --save-baseline ingest.json
+  $ python -m app.benchmarks.ingest --size 2000 --baseline ingest.json
+"""
+
+from contextlib import contextmanager
+import json
+import math
+import resource
+import sys
+import time
+
+
+def percentile(values, point):
+    """The `point` percentile of `values` (nearest rank)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(point / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def peak_rss():
+    """Peak resident set size of the process so far, in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Stage:
+    """Measures of a stage: the latency of each of its operations, the count
+    of documents and bytes processed and its overall duration."""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.docs = 0
+        self.bytes = 0
+        self.duration = 0.0
+        self.peak_rss = 0
+
+    @contextmanager
+    def measure(self, docs=0, size=0):
+        """Times the operation run in the block, processing `docs` documents
+        of `size` bytes."""
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        self.latencies.append(elapsed)
+        self.duration += elapsed
+        self.docs += docs
+        self.bytes += size
+        self.peak_rss = peak_rss()
+
+    def report(self):
+        """The measures as a dict, latencies in milliseconds."""
+        duration = self.duration or float("nan")
+        return {
+            "operations": len(self.latencies),
+            "docs": self.docs,
+            "seconds": round(self.duration, 4),
+            "docs_per_sec": round(self.docs / duration, 1),
+            "mb_per_sec": round(self.bytes / 2**20 / duration, 2),
+            "p50_ms": _ms(percentile(self.latencies, 50)),
+            "p95_ms": _ms(percentile(self.latencies, 95)),
+            "p99_ms": _ms(percentile(self.latencies, 99)),
+            "peak_rss_mb": round(self.peak_rss / 2**20, 1),
+        }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def print_report(report, file=sys.stdout):
+    """Prints a report given as a dict of measures by stage."""
+    columns = {name: max(len(name) + 2, 10) for name in next(iter(report.values()))}
+    first = max(len(stage) for stage in report) + 2
+    print(
+        "stage".ljust(first) + "".join(name.rjust(w) for name, w in columns.items()),
+        file=file,
+    )
+    for stage, measures in report.items():
+        print(
+            stage.ljust(first)
+            + "".join(str(measures[name]).rjust(w) for name, w in columns.items()),
+            file=file,
+        )
+
+
+def save_baseline(path, report):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+# measures in which a higher value is better, the others are better lower
+HIGHER_IS_BETTER = {"docs_per_sec", "mb_per_sec", "requests_per_sec"}
+
+
+def compare(report, baseline, measures, tolerance=0.1):
+    """Compares the `measures` of each stage of `report` with the baseline.
+    Returns the regressions, the measures worse than the baseline by more
+    than `tolerance` (a ratio), as (stage, measure, baseline, value) tuples.
+    """
+    regressions = []
+    for stage, values in report.items():
+        reference = baseline.get(stage)
+        if not reference:
+            continue
+        for measure in measures:
+            base, value = reference.get(measure), values.get(measure)
+            if not base or value is None or math.isnan(value):
+                continue
+            if measure in HIGHER_IS_BETTER:
+                worse = value < base * (1 - tolerance)
+            else:
+                worse = value > base * (1 + tolerance)
+            if worse:
+                regressions.append((stage, measure, base, value))
+    return regressions
+
+
+def add_baseline_arguments(parser):
+    """Adds the options of the baseline to the argument `parser` of a
+    benchmark, see `check_baseline`."""
+    parser.add_argument("--baseline", help="a JSON report to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="the ratio by which a measure can be worse than the baseline",
+    )
+    parser.add_argument("--save-baseline", help="where to save the report")
+
+
+def check_baseline(args, report, measures):
+    """Saves the report when asked by `args` and compares its `measures` with
+    the baseline given if any, exiting with 1 on regressions."""
+    if args.save_baseline:
+        save_baseline(args.save_baseline, report)
+    if args.baseline:
+        regressions = compare(
+            report, load_baseline(args.baseline), measures, args.tolerance
+        )
+        for stage, measure, base, value in regressions:
+            print(f"⚠ REGRESSION: {stage} {measure} {value} (baseline {base})")
+        if regressions:
+            sys.exit(1)
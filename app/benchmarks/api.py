@@ -0,0 +1,324 @@
+"""Load benchmark of the API endpoints.
+
+A synthetic corpus (see `corpus`) is indexed in the in memory stand-in of
+Elastic Search, or in another backend, and the endpoints `/summary`,
+`/{code_chambre}/summary`, `/decision/{id}` and `/search` are driven each in
+turn at increasing concurrency levels. The requests go through the ASGI
+interface of the application in process, or to a running server when an url
+is given. For each endpoint and level the report gives the throughput, the
+latency percentiles and the error rate.
+
+A second report splits the latency of one request (median of sequential
+requests) into:
+    - auth: the credentials check (`get_user`),
+    - service: the endpoint function, calls to the backend and models build,
+    - serialisation: the encoding of the payload into the JSON response,
+      for the streamed listings it includes the fetch of the items after
+      the first one, which are serialised as the service yields them,
+    - framework: the remaining time, spent in routing, dependencies and
+      request/response handling.
+
+A latency can be injected on the calls to the stand-in to get closer to a
+real cluster, see `app.es_memory`.
+
+example:
+  $ python -m app.benchmarks.api --size 5000 --concurrency 1,8,32 --latency 0.002
+  $ python -m app.benchmarks.api --endpoints summary,search --baseline api.json
+"""
+
+import asyncio
+import base64
+import itertools
+import os
+import random
+import time
+
+import httpx
+
+from app.benchmarks import percentile
+
+
+QUERIES = [
+    "cassation",
+    "contrat de travail",
+    "prescription",
+    "licenciement pour faute grave",
+    "article 2224 du code civil",
+    "assurance",
+]
+MEASURES = ("requests_per_sec", "p95_ms", "error_rate", "total_ms")
+
+
+def requests_by_endpoint(identifiers, courts, pages):
+    """Functions giving a random request path for each endpoint."""
+    return {
+        "summary": lambda: f"/summary?page={random.randint(1, pages)}",
+        "court_summary": lambda: f"/{random.choice(courts)}/summary",
+        "decision": lambda: f"/decision/{random.choice(identifiers)}",
+        "search": lambda: f"/search?query={random.choice(QUERIES)}",
+    }
+
+
+async def drive(client, path_for, concurrency, requests):
+    """Sends `requests` requests from `concurrency` concurrent workers.
+    Returns the measures of the run."""
+    latencies = []
+    errors = 0
+    counter = itertools.count()
+
+    async def worker():
+        nonlocal errors
+        while next(counter) < requests:
+            start = time.perf_counter()
+            try:
+                resp = await client.get(path_for())
+                failed = resp.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            latencies.append(time.perf_counter() - start)
+            errors += failed
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - start
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4),
+        "requests_per_sec": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def _median_ms(values):
+    return round(percentile(values, 50) * 1000, 3)
+
+
+async def overhead(main, client, credentials, endpoint, path, repeat):
+    """Splits the latency of the request on `path` of `endpoint`, see the
+    module documentation."""
+    from fastapi import Request, Response
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse, StreamingResponse
+    from fastapi.security import HTTPBasicCredentials
+
+    url = httpx.URL(path)
+    params = dict(url.params)
+    page = int(params["page"]) if "page" in params else None
+    segments = url.path.strip("/").split("/")
+    request = Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": url.path,
+            "query_string": url.query,
+            "headers": [],
+        }
+    )
+    handlers = {
+        "summary": lambda user: main.get_decision_summary(request, user, page),
+        "court_summary": lambda user: main.get_decision_summary_for_court(
+            segments[0], request, user, page
+        ),
+        "decision": lambda user: main.get_decision(segments[1], request, user),
+        "search": lambda user: main.search_decision(params.get("query"), user),
+    }
+
+    async def serialise(payload):
+        if isinstance(payload, StreamingResponse):
+            return b"".join([chunk async for chunk in payload.body_iterator])
+        if isinstance(payload, Response):
+            return payload.body
+        return JSONResponse(jsonable_encoder(payload)).body
+
+    timings = {"auth": [], "service": [], "serialisation": [], "total": []}
+    user = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        user = main.get_user(HTTPBasicCredentials(**credentials))
+        timings["auth"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        payload = await handlers[endpoint](user)
+        timings["service"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await serialise(payload)
+        timings["serialisation"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await client.get(path)
+        timings["total"].append(time.perf_counter() - start)
+    res = {f"{name}_ms": _median_ms(values) for name, values in timings.items()}
+    res["framework_ms"] = round(
+        res["total_ms"] - res["auth_ms"] - res["service_ms"] - res["serialisation_ms"],
+        3,
+    )
+    return res
+
+
+def load_corpus(backend, size, batch_size=500):
+    """Indexes a synthetic corpus of `size` documents. Returns the
+    identifiers and the courts of the documents."""
+    from app.benchmarks.corpus import synthetic_parsers
+    from app.indexer import Indexer
+
+    loop = asyncio.get_event_loop()
+    parsers = synthetic_parsers(size)
+    indexer = Indexer(backend.index, backend)
+    loop.run_until_complete(indexer.setup())
+    for start in range(0, size, batch_size):
+        loop.run_until_complete(indexer.bulk_index(parsers[start : start + batch_size]))
+    loop.run_until_complete(backend.refresh())
+    identifiers = [parser.identifier for parser in parsers]
+    courts = sorted({parser.code_chambre for parser in parsers})
+    return identifiers, courts
+
+
+def index_exists(backend):
+    """Whether the index of `backend` exists, the count of its documents
+    failing otherwise."""
+    try:
+        asyncio.get_event_loop().run_until_complete(backend.count())
+    except Exception:
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import tempfile
+
+    from app.backends import BACKENDS
+    from app.benchmarks import add_baseline_arguments, check_baseline, print_report
+    from app.benchmarks.ingest import new_index
+
+    parser = ArgumentParser(description="Load benchmark of the API endpoints")
+    parser.add_argument(
+        "--size", type=int, default=2000, help="the number of documents"
+    )
+    parser.add_argument(
+        "--endpoints",
+        default="summary,court_summary,decision,search",
+        help="comma separated endpoints to drive",
+    )
+    parser.add_argument(
+        "--concurrency",
+        default="1,4,16,64",
+        help="comma separated concurrency levels",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=500, help="requests by endpoint and level"
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=50,
+        help="sequential requests by endpoint to split the latency",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="median latency in seconds injected on the stand-in calls",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="elasticsearch",
+        help="the backend where documents are indexed",
+    )
+    parser.add_argument(
+        "--url",
+        help="the url of a running server to drive instead of the application "
+        "in process, it must use the elasticsearch backend and the --index "
+        "the documents are loaded in",
+    )
+    parser.add_argument(
+        "--index",
+        help="the name of the new index the documents are loaded in, a random "
+        "one by default, it is dropped at the end and must not exist",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="seed of the random requests"
+    )
+    add_baseline_arguments(parser)
+
+    args = parser.parse_args()
+    if args.url and args.backend == "sqlite":
+        parser.error("--url needs an elasticsearch backend")
+    random.seed(args.seed)
+    tmp = tempfile.mkdtemp(prefix="bench-api-")
+    # the documents only go to an index and a database of their own, which
+    # are dropped at the end
+    index = args.index or new_index()
+    # the settings are read when the application is imported
+    os.environ.setdefault("ELASTIC_URL", f"memory://bench?latency={args.latency}")
+    os.environ["ELASTIC_INDEX"] = index
+    os.environ["BACKEND"] = args.backend
+    os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.db")
+    os.environ.setdefault("ADMIN_USER", "bench")
+    os.environ.setdefault("ADMIN_PASSWORD", "bench")
+    credentials = {
+        "username": os.environ["ADMIN_USER"],
+        "password": os.environ["ADMIN_PASSWORD"],
+    }
+    from app.api import main
+
+    loop = asyncio.get_event_loop()
+    backend = main.decision_service.backend
+    if index_exists(backend):
+        os.rmdir(tmp)
+        parser.error(f"the index {index} already exists")
+    print(f"documents loaded in the index {index}")
+    identifiers, courts = load_corpus(backend, args.size)
+    pages = -(-args.size // main.settings.page_size)
+    paths = requests_by_endpoint(identifiers, courts, pages)
+    auth = base64.b64encode(
+        f"{credentials['username']}:{credentials['password']}".encode()
+    ).decode()
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app),
+            base_url="http://bench",
+            timeout=60,
+        )
+    client.headers["Authorization"] = f"Basic {auth}"
+
+    load = {}
+    breakdown = {}
+    try:
+        for endpoint in args.endpoints.split(","):
+            for level in (int(c) for c in args.concurrency.split(",")):
+                load[f"{endpoint} c{level}"] = loop.run_until_complete(
+                    drive(client, paths[endpoint], level, args.requests)
+                )
+            if not args.url:
+                breakdown[endpoint] = loop.run_until_complete(
+                    overhead(
+                        main,
+                        client,
+                        credentials,
+                        endpoint,
+                        paths[endpoint](),
+                        args.repeat,
+                    )
+                )
+    finally:
+        loop.run_until_complete(client.aclose())
+        loop.run_until_complete(backend.drop())
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+    print(f"{args.size} documents, {args.backend} backend")
+    print_report(load)
+    if breakdown:
+        print()
+        print_report(breakdown)
+    report = {**load, **{f"{name} overhead": v for name, v in breakdown.items()}}
+    check_baseline(args, report, MEASURES)
@@ -0,0 +1,91 @@
+"""Builds synthetic Legifrance corpora from the samples of the test data.
+
+The samples are copied as many times as needed, each copy being given a new
+identifier and a new date so that all documents are distinct. Documents are
+packed into tar archives laid out like the DILA ones: `CASS_<timestamp>.tar.gz`
+holding a `<timestamp>` directory with the xml tree, the archives following
+each other in chronological order.
+"""
+
+from datetime import date, timedelta
+import io
+import os
+import re
+import tarfile
+from xml.dom import minidom
+
+from app.legifrance.files import get_files
+from app.legifrance.parser import Parser
+
+
+SAMPLES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "tests", "test_data", "full_tree"
+)
+
+DATE_DEC = re.compile(r"<DATE_DEC>\d{4}-\d{2}-\d{2}</DATE_DEC>")
+FIRST_DATE = date(2000, 1, 3)
+
+
+def load_samples(path=SAMPLES_DIR):
+    """Returns the content of the xml files under `path` with the identifier
+    of the document each one holds."""
+    samples = []
+    for fpath in sorted(get_files(path)):
+        with open(fpath, encoding="utf-8") as f:
+            content = f.read()
+        samples.append((os.path.basename(fpath)[:-4], content))
+    return samples
+
+
+def synthetic_document(samples, number):
+    """The `number`th document of the corpus, as an (identifier, xml) pair."""
+    original, content = samples[number % len(samples)]
+    identifier = f"JURITEXT{900000000000 + number:012}"
+    day = FIRST_DATE + timedelta(days=number // 10)
+    content = content.replace(original, identifier)
+    content = DATE_DEC.sub(f"<DATE_DEC>{day.isoformat()}</DATE_DEC>", content, 1)
+    return identifier, content
+
+
+def synthetic_parsers(size, samples=None):
+    """Parsers of the `size` first documents of the corpus, for the
+    benchmarks starting from the parsed documents."""
+    samples = samples or load_samples()
+    return [
+        Parser(minidom.parseString(synthetic_document(samples, number)[1]))
+        for number in range(size)
+    ]
+
+
+def document_path(identifier):
+    """Path of a document in an archive, as legifrance does: the digits of
+    the identifier split by pairs."""
+    digits = identifier[8:]
+    pairs = [digits[i : i + 2] for i in range(0, 10, 2)]
+    return os.path.join("juri", "cass", "global", "JURI", "TEXT", *pairs, identifier)
+
+
+def build_corpus(path, size, archives=1, samples=None):
+    """Writes a corpus of `size` documents split into `archives` tar files
+    under `path`. Returns the names of the archives in chronological order
+    and the total size of the xml documents in bytes."""
+    samples = samples or load_samples()
+    names = []
+    total = 0
+    per_archive = -(-size // archives)
+    for archive in range(archives):
+        timestamp = f"{20240101 + archive:08}-200000"
+        name = f"CASS_{timestamp}.tar.gz"
+        with tarfile.open(os.path.join(path, name), mode="w:gz") as tar:
+            first = archive * per_archive
+            for number in range(first, min(first + per_archive, size)):
+                identifier, content = synthetic_document(samples, number)
+                data = content.encode("utf-8")
+                info = tarfile.TarInfo(
+                    os.path.join(timestamp, document_path(identifier) + ".xml")
+                )
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+                total += len(data)
+        names.append(name)
+    return names, total
@@ -0,0 +1,221 @@
+"""Benchmark of the ingestion of a synthetic corpus (see `corpus`).
+
+The archives are served by a local http server and go through each stage of
+the loading script on its own:
+    - download: `Loader.download` of each archive,
+    - extract: `Loader.extract` of each archive,
+    - get_files: listing of the xml files of each extracted directory,
+    - parse: `Parser.from_file` of each document,
+    - prepare: `Indexer.prepare_document` of each document,
+    - index: `Indexer.bulk_index` of the documents by batches,
+then end to end as the script does it (`Loader.process_targets`,
+`Loader.bulk_index` and the citation counts) in a new index.
+
+The report gives for each stage the docs/sec, MB/sec, the latency
+percentiles of its operations and the peak RSS of the process once it is
+done. The documents are indexed in Elastic Search, or the in memory stand-in
+when no cluster is configured, unless another backend is chosen.
+
+example:
+  $ python -m app.benchmarks.ingest --size 5000 --archives 10
+  $ python -m app.benchmarks.ingest --backend sqlite --baseline ingest.json
+"""
+
+import asyncio
+import os
+from random import randint
+import shutil
+import tempfile
+
+from aiohttp import web
+
+from app.backends import BACKENDS, get_backend
+from app.benchmarks import (
+    Stage,
+    add_baseline_arguments,
+    check_baseline,
+    print_report,
+)
+from app.benchmarks.corpus import build_corpus
+from app.indexer import Indexer
+from app.legifrance.files import get_files
+from app.legifrance.parser import Parser
+from app.scripts.initscript import Loader
+
+
+STAGES = ("download", "extract", "get_files", "parse", "prepare", "index")
+MEASURES = ("docs_per_sec", "mb_per_sec", "p95_ms")
+
+
+async def serve(path):
+    """Serves the archives under `path` with an index page listing them like
+    the DILA one. Returns the runner and the url of the site."""
+    names = sorted(name for name in os.listdir(path) if name.endswith(".tar.gz"))
+
+    async def listing(request):
+        links = "".join(f'<a href="{name}">{name}</a>\n' for name in names)
+        return web.Response(text=f"<html><body>{links}</body></html>")
+
+    async def archive(request):
+        name = request.match_info["name"]
+        if name not in names:
+            raise web.HTTPNotFound()
+        with open(os.path.join(path, name), "rb") as f:
+            body = f.read()
+        # served as is, a static route would set a gzip content encoding the
+        # client would decode
+        return web.Response(body=body, content_type="application/gzip")
+
+    app = web.Application()
+    app.router.add_get("/", listing)
+    app.router.add_get("/{name}", archive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def new_index():
+    return "bench-" + "".join(chr(randint(97, 122)) for _ in range(10))
+
+
+def run_stages(url, archives, working_dir, backend, batch_size):
+    """Runs each stage on its own, returns the measures by stage."""
+    loop = asyncio.get_event_loop()
+    stages = {name: Stage(name) for name in STAGES}
+    loader = Loader(url, working_dir, backend.index, backend)
+
+    for name in archives:
+        with stages["download"].measure():
+            loop.run_until_complete(loader.download(name))
+        stages["download"].bytes += os.path.getsize(os.path.join(working_dir, name))
+
+    for name in archives:
+        size = os.path.getsize(os.path.join(working_dir, name))
+        with stages["extract"].measure(size=size):
+            loader.extract(name)
+
+    files = []
+    for directory in sorted(os.listdir(working_dir)):
+        with stages["get_files"].measure():
+            found = list(get_files(os.path.join(working_dir, directory)))
+        stages["get_files"].docs += len(found)
+        files += found
+    sizes = {fpath: os.path.getsize(fpath) for fpath in files}
+    for stage in ("download", "extract"):
+        stages[stage].docs = len(files)
+
+    parsers = []
+    for fpath in files:
+        with stages["parse"].measure(docs=1, size=sizes[fpath]):
+            parsers.append(Parser.from_file(fpath))
+
+    for parser, fpath in zip(parsers, files):
+        with stages["prepare"].measure(docs=1, size=sizes[fpath]):
+            Indexer.prepare_document(parser)
+
+    indexer = Indexer(backend.index, backend)
+    loop.run_until_complete(indexer.setup())
+    try:
+        for start in range(0, len(parsers), batch_size):
+            batch = parsers[start : start + batch_size]
+            size = sum(sizes[fpath] for fpath in files[start : start + batch_size])
+            with stages["index"].measure(docs=len(batch), size=size):
+                results = loop.run_until_complete(indexer.bulk_index(batch))
+            errors = [result for result in results if result["status"] >= 400]
+            if errors:
+                raise RuntimeError(f"{len(errors)} documents not indexed: {errors[0]}")
+    finally:
+        loop.run_until_complete(backend.drop())
+    return {name: stage.report() for name, stage in stages.items()}
+
+
+def run_end_to_end(url, working_dir, backend, total_bytes):
+    """Runs the loading as the script does, returns its measures."""
+    loop = asyncio.get_event_loop()
+    stage = Stage("end_to_end")
+    loader = Loader(url, working_dir, backend.index, backend)
+    indexer = Indexer(backend.index, backend)
+    loop.run_until_complete(indexer.setup())
+    try:
+        with stage.measure(size=total_bytes):
+            targets = loop.run_until_complete(loader.list_targets())
+            loop.run_until_complete(loader.process_targets(targets))
+            results = loader.bulk_index()
+            loop.run_until_complete(indexer.update_citation_counts())
+        stage.docs = sum(1 for items in results.values() for item in items if item)
+    finally:
+        loop.run_until_complete(backend.drop())
+    return stage.report()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from contextlib import redirect_stdout
+
+    parser = ArgumentParser(
+        description="Benchmark the ingestion of a synthetic corpus, stage by "
+        "stage and end to end"
+    )
+    parser.add_argument(
+        "--size", type=int, default=1000, help="the number of documents"
+    )
+    parser.add_argument(
+        "--archives", type=int, default=4, help="the number of tar archives"
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=500, help="documents by bulk request"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="elasticsearch",
+        help="the backend where documents are indexed",
+    )
+    parser.add_argument(
+        "--sqlite-path",
+        help="the SQLite database file used by the sqlite backend",
+    )
+    add_baseline_arguments(parser)
+    parser.add_argument(
+        "--skip-end-to-end", action="store_true", help="run only the stages"
+    )
+
+    args = parser.parse_args()
+    # without cluster configured the in memory stand-in is used
+    os.environ.setdefault("ELASTIC_URL", "memory://bench")
+    loop = asyncio.get_event_loop()
+    tmp = tempfile.mkdtemp(prefix="bench-ingest-")
+    try:
+        corpus = os.path.join(tmp, "corpus")
+        os.mkdir(corpus)
+        archives, total_bytes = build_corpus(corpus, args.size, args.archives)
+        print(
+            f"{args.size} documents, {total_bytes / 2**20:.1f} MB "
+            f"in {len(archives)} archives"
+        )
+        runner, url = loop.run_until_complete(serve(corpus))
+        sqlite_path = args.sqlite_path or os.path.join(tmp, "bench.db")
+
+        working_dir = os.path.join(tmp, "stages")
+        os.mkdir(working_dir)
+        backend = get_backend(args.backend, new_index(), sqlite_path)
+        report = run_stages(url, archives, working_dir, backend, args.batch_size)
+
+        if not args.skip_end_to_end:
+            working_dir = os.path.join(tmp, "end_to_end")
+            os.mkdir(working_dir)
+            backend = get_backend(args.backend, new_index(), sqlite_path)
+            # the loader reports its progress, not wanted here
+            with redirect_stdout(open(os.devnull, "w")):
+                report["end_to_end"] = run_end_to_end(
+                    url, working_dir, backend, total_bytes
+                )
+        loop.run_until_complete(runner.cleanup())
+    finally:
+        shutil.rmtree(tmp)
+
+    print_report(report)
+    check_baseline(args, report, MEASURES)
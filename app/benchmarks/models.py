@@ -0,0 +1,125 @@
+"""Microbenchmark of the building and serialisation of the models.
+
+The documents are validated when indexed, the models can then be built from
+the backend without validation (`model_construct`). This benchmark measures
+the hits by second of both ways, with validation and without, on a page of
+summaries and on a decision with many paragraphes, and the serialisation of
+the models into JSON: through `jsonable_encoder` as FastAPI does for the
+dicts returned by the endpoints, and with `model_dump_json` as the api does
+now.
+
+Validation runs in pydantic-core while `model_construct` sets the fields in
+Python: the latter only pays off for the decisions, whose validation walks
+all the paragraphes, the summaries are faster to validate.
+
+example:
+  $ python -m app.benchmarks.models --page-size 100 --paragraphs 2000
+  $ python -m app.benchmarks.models --save-baseline models.json
+"""
+
+import json
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.benchmarks import Stage
+from app.benchmarks.corpus import synthetic_parsers
+from app.indexer import DECISION_FIELDS, Indexer
+from app.model import Decision, DecisionSummary
+
+
+MEASURES = ("docs_per_sec", "p95_ms")
+
+
+def documents(page_size, paragraphs):
+    """A page of summaries and a decision of `paragraphs` paragraphes, as the
+    backend returns them."""
+    prepared = [
+        Indexer.prepare_document(parser) for parser in synthetic_parsers(page_size)
+    ]
+    page = [
+        {field: document[field] for field in ("title", "identifier", "code_chambre")}
+        for document in prepared
+    ]
+    decision = {field: prepared[0][field] for field in DECISION_FIELDS}
+    source = [
+        paragraph for document in prepared for paragraph in document["paragraphes"]
+    ]
+    decision["paragraphes"] = [
+        source[number % len(source)] for number in range(paragraphs)
+    ]
+    return page, decision
+
+
+def run(page, decision, repeat):
+    """Builds and serialises the page and the decision `repeat` times each
+    way. Returns the report by stage, a page counting as `len(page)` hits."""
+    stages = {}
+
+    def measure(name, func, hits):
+        stage = stages[name] = Stage(name)
+        for _ in range(repeat):
+            with stage.measure(docs=hits):
+                func()
+
+    measure(
+        "page validated", lambda: [DecisionSummary(**item) for item in page], len(page)
+    )
+    measure(
+        "page constructed",
+        lambda: [DecisionSummary.model_construct(**item) for item in page],
+        len(page),
+    )
+    models = [DecisionSummary.model_construct(**item) for item in page]
+    measure(
+        "page jsonable_encoder",
+        lambda: JSONResponse(jsonable_encoder([dict(model) for model in models])).body,
+        len(page),
+    )
+    measure(
+        "page model_dump_json",
+        lambda: b"["
+        + b",".join(model.model_dump_json().encode() for model in models)
+        + b"]",
+        len(page),
+    )
+    measure("decision validated", lambda: Decision(**decision), 1)
+    measure("decision constructed", lambda: Decision.model_construct(**decision), 1)
+    model = Decision.model_construct(**decision)
+    measure(
+        "decision jsonable_encoder",
+        lambda: JSONResponse(jsonable_encoder(dict(model))).body,
+        1,
+    )
+    measure("decision model_dump_json", lambda: model.model_dump_json().encode(), 1)
+    return {name: stage.report() for name, stage in stages.items()}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    from app.benchmarks import add_baseline_arguments, check_baseline, print_report
+
+    parser = ArgumentParser(description="Benchmark the building of the models")
+    parser.add_argument(
+        "--page-size", type=int, default=100, help="the summaries of a page"
+    )
+    parser.add_argument(
+        "--paragraphs",
+        type=int,
+        default=2000,
+        help="the paragraphes of the large decision",
+    )
+    parser.add_argument("--repeat", type=int, default=500, help="the builds by stage")
+    add_baseline_arguments(parser)
+
+    args = parser.parse_args()
+    page, decision = documents(args.page_size, args.paragraphs)
+    size = len(json.dumps(decision, ensure_ascii=False).encode())
+    print(
+        f"page of {len(page)} summaries, decision of {args.paragraphs} "
+        f"paragraphes ({size / 2**20:.1f} MB)"
+    )
+    report = run(page, decision, args.repeat)
+    print_report(report)
+    check_baseline(args, report, MEASURES)
@@ -0,0 +1,120 @@
+"""Benchmark of the layouts of the paragraphes, see `app.compact`.
+
+A decision of many paragraphes is taken in both layouts: nested lists of
+lines, as indexed by default, and compact, one text with the offsets of its
+lines. For each one this benchmark measures the size of its json in the
+source and the memory held by the objects loaded from it, then the hits by
+second of the loading of the source, of the materialisation of the nested
+lists out of the compact layout (whole and a part of five paragraphs), and
+of the serialisation of the models the api returns.
+
+example:
+  $ python -m app.benchmarks.paragraphs --paragraphs 2000
+  $ python -m app.benchmarks.paragraphs --save-baseline paragraphs.json
+"""
+
+import json
+import tracemalloc
+
+from app.benchmarks import Stage
+from app.benchmarks.models import documents
+from app.compact import CompactParagraphs, compact_document
+from app.model import CompactDecision, Decision
+
+
+MEASURES = ("docs_per_sec", "p95_ms", "source_kb", "memory_kb")
+
+
+def sources(paragraphs):
+    """The json of a decision of `paragraphs` paragraphes in both layouts,
+    as stored in the backend."""
+    _, decision = documents(1, paragraphs)
+    nested = json.dumps(decision, ensure_ascii=False).encode()
+    compact = json.dumps(compact_document(dict(decision)), ensure_ascii=False).encode()
+    return nested, compact
+
+
+def _traced_size(load):
+    """The memory held by the objects returned by `load`."""
+    tracemalloc.start()
+    try:
+        result = load()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def memory(nested, compact):
+    """The size of the sources and of the objects loaded from them, in
+    kilobytes."""
+    return {
+        "memory nested": {
+            "source_kb": round(len(nested) / 1024, 1),
+            "memory_kb": round(_traced_size(lambda: json.loads(nested)) / 1024, 1),
+        },
+        "memory compact": {
+            "source_kb": round(len(compact) / 1024, 1),
+            "memory_kb": round(_traced_size(lambda: json.loads(compact)) / 1024, 1),
+        },
+    }
+
+
+def _models(nested, compact):
+    decision = json.loads(nested)
+    document = json.loads(compact)
+    paragraphs = CompactParagraphs.from_document(document)
+    return (
+        Decision.model_construct(**decision),
+        CompactDecision.model_construct(**document, paragraphes=paragraphs.model()),
+        paragraphs,
+    )
+
+
+def run(nested, compact, repeat):
+    """Loads, materialises and serialises the decision `repeat` times in each
+    layout. Returns the report by stage."""
+    stages = {}
+
+    def measure(name, func, size=0):
+        stage = stages[name] = Stage(name)
+        for _ in range(repeat):
+            with stage.measure(docs=1, size=size):
+                func()
+
+    measure("load nested", lambda: json.loads(nested), len(nested))
+    measure("load compact", lambda: json.loads(compact), len(compact))
+    decision, compact_decision, paragraphs = _models(nested, compact)
+    measure("materialise all", paragraphs.nested)
+    measure("materialise part", lambda: paragraphs.nested(slice(10, 15)))
+    measure("dump nested", lambda: decision.model_dump_json().encode())
+    measure("dump compact", lambda: compact_decision.model_dump_json().encode())
+    return {name: stage.report() for name, stage in stages.items()}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    from app.benchmarks import add_baseline_arguments, check_baseline, print_report
+
+    parser = ArgumentParser(description="Benchmark the layouts of the paragraphes")
+    parser.add_argument(
+        "--paragraphs",
+        type=int,
+        default=2000,
+        help="the paragraphes of the decision",
+    )
+    parser.add_argument("--repeat", type=int, default=200, help="the runs by stage")
+    add_baseline_arguments(parser)
+
+    args = parser.parse_args()
+    nested, compact = sources(args.paragraphs)
+    print(f"decision of {args.paragraphs} paragraphes")
+    sizes = memory(nested, compact)
+    print_report(sizes)
+    print()
+    report = run(nested, compact, args.repeat)
+    print_report(report)
+    report.update(sizes)
+    check_baseline(args, report, MEASURES)
@@ -0,0 +1,208 @@
+"""Bulk indexing adapting to what the backend sustains.
+
+`AdaptiveBulk` sends the documents in bulk requests whose size and number in
+flight follow the answers of the backend, AIMD style as TCP does: both grow a
+step at a time while the requests are fast and accepted, and are halved when
+items are rejected (429 of an overloaded Elastic Search), when a request
+fails on a timeout or when it takes longer than `target_latency`.
+
+The items rejected or lost with a failed request are not errors yet: they go
+to a retry queue and are sent again after a delay growing exponentially with
+their attempts, with jitter so that the retries don't come back at once. An
+item is reported as failed once `max_attempts` are spent, or at once when
+the backend answers with an error that retrying doesn't fix (an invalid
+document by instance).
+
+example:
+  >>> bulk = AdaptiveBulk(backend, batch_size=200)
+  >>> results = await bulk.index(documents)
+"""
+
+import asyncio
+from collections import deque
+import heapq
+import itertools
+import logging
+import random
+import time
+
+from elastic_transport import TransportError
+
+from app.indexer import INDEX_LATENCY
+from app.metrics import Counter, Gauge
+
+
+logger = logging.getLogger(__name__)
+
+# statuses of the items and requests worth sending again
+RETRYABLE = {429, 502, 503, 504}
+
+BULK_RETRIES = Counter(
+    "cassapi_bulk_retries_total",
+    "Bulk items sent again, by reason (rejected or failed request).",
+    ["reason"],
+)
+BULK_BATCH_SIZE = Gauge(
+    "cassapi_bulk_batch_size", "Current size of the adaptive bulk requests."
+)
+BULK_CONCURRENCY = Gauge(
+    "cassapi_bulk_concurrency", "Current bulk requests allowed in flight."
+)
+
+
+def retryable(error):
+    """Whether the request failing with `error` may succeed if sent again."""
+    status = getattr(error, "status_code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE
+    return isinstance(error, (TransportError, TimeoutError, ConnectionError))
+
+
+class AIMD:
+    """A value between bounds increased by `step` and decreased by
+    `factor`."""
+
+    def __init__(self, value, minimum, maximum, step, factor=0.5):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+        self.factor = factor
+        self.value = max(minimum, min(value, maximum))
+
+    def increase(self):
+        self.value = min(self.value + self.step, self.maximum)
+
+    def decrease(self):
+        self.value = max(int(self.value * self.factor), self.minimum)
+
+
+class AdaptiveBulk:
+    """Indexes documents on `backend` with bulk requests of adaptive size and
+    concurrency, retrying the rejected items, see the module documentation.
+    """
+
+    def __init__(
+        self,
+        backend,
+        batch_size=500,
+        concurrency=2,
+        min_batch_size=10,
+        max_batch_size=5000,
+        max_concurrency=16,
+        target_latency=2.0,
+        max_attempts=8,
+        base_delay=0.5,
+        max_delay=30.0,
+    ):
+        self.backend = backend
+        self.batch_size = AIMD(
+            batch_size, min_batch_size, max_batch_size, step=max(min_batch_size, 50)
+        )
+        self.concurrency = AIMD(concurrency, 1, max_concurrency, step=1)
+        self.target_latency = target_latency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.requests = 0
+        self.retries = 0
+
+    def _backoff(self, attempts):
+        """The delay before the attempt following `attempts`, "full jitter"
+        between half and the whole exponential delay."""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _adapt(self, latency, rejected):
+        if rejected or latency > self.target_latency:
+            self.batch_size.decrease()
+            self.concurrency.decrease()
+        else:
+            self.batch_size.increase()
+            self.concurrency.increase()
+        BULK_BATCH_SIZE.set(self.batch_size.value)
+        BULK_CONCURRENCY.set(self.concurrency.value)
+
+    async def _send(self, documents, version):
+        """One bulk request, returns its items and whether it failed on an
+        error worth retrying."""
+        start = time.perf_counter()
+        try:
+            with INDEX_LATENCY.time(operation="bulk"):
+                items = await self.backend.bulk_index(documents, version)
+        except Exception as e:
+            failed = retryable(e)
+            if not failed:
+                logger.exception("bulk request failed")
+            error = {
+                "status": getattr(e, "status_code", None) or 500,
+                "error": f"{e.__class__.__name__}: {e}",
+            }
+            items = [
+                {"_id": document.get("identifier"), **error} for document in documents
+            ]
+        else:
+            failed = False
+        self.requests += 1
+        return items, failed, time.perf_counter() - start
+
+    async def index(self, documents, version=None):
+        """Indexes `documents`, returns the result of each one in the same
+        order, as `Backend.bulk_index` gives them with `version`."""
+        results = [None] * len(documents)
+        attempts = [0] * len(documents)
+        pending = deque(range(len(documents)))
+        # (time the item can be sent again, order, position)
+        retries = []
+        order = itertools.count()
+        in_flight = {}
+
+        def next_batch():
+            # the retries due go before the documents not sent yet
+            now = time.monotonic()
+            positions = []
+            while retries and retries[0][0] <= now:
+                if len(positions) >= self.batch_size.value:
+                    return positions
+                positions.append(heapq.heappop(retries)[2])
+            while pending and len(positions) < self.batch_size.value:
+                positions.append(pending.popleft())
+            return positions
+
+        while pending or retries or in_flight:
+            while len(in_flight) < self.concurrency.value:
+                positions = next_batch()
+                if not positions:
+                    break
+                task = asyncio.create_task(
+                    self._send([documents[position] for position in positions], version)
+                )
+                in_flight[task] = positions
+            if retries and len(in_flight) < self.concurrency.value:
+                timeout = max(retries[0][0] - time.monotonic(), 0)
+            else:
+                # without a free slot a retry due can't be sent anyway
+                timeout = None
+            if not in_flight:
+                await asyncio.sleep(timeout)
+                continue
+            done, _ = await asyncio.wait(
+                in_flight, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                positions = in_flight.pop(task)
+                items, failed, latency = task.result()
+                rejected = 0
+                for position, item in zip(positions, items):
+                    attempts[position] += 1
+                    if (failed or item["status"] in RETRYABLE) and attempts[
+                        position
+                    ] < self.max_attempts:
+                        rejected += 1
+                        BULK_RETRIES.inc(reason="failed" if failed else "rejected")
+                        ready = time.monotonic() + self._backoff(attempts[position])
+                        heapq.heappush(retries, (ready, next(order), position))
+                    else:
+                        results[position] = item
+                self.retries += rejected
+                self._adapt(latency, rejected)
+        return results
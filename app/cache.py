@@ -0,0 +1,217 @@
+"""Caches of the api, shared by its workers or local to a process.
+
+The counts and the recently fetched decisions are kept in a cache with a
+time to live. Without configuration each worker keeps its own in a
+`LocalCache`. With several uvicorn workers they can share one instead: a
+cache server, run once on the host, keeps the entries in memory and the
+workers reach it with a `SocketCache` through a unix socket, so that a count
+fetched by one worker serves all the others.
+
+The server speaks json lines: each request is an object with an `op` (`get`,
+`set` or `add`) a `key`, for the writes a `value` and a `ttl` in seconds, and
+an `id`, each response an object with the `id` of its request and the
+`value` read or whether it was written. A line can't exceed `LINE_LIMIT`
+bytes, the values larger than `max_value_size` are not cached.
+
+Usage (from project root):
+  $ python -m app.cache /run/cassapi/cache.sock &
+  $ CACHE_URL=unix:///run/cassapi/cache.sock uvicorn app.api.main:app --workers 4
+"""
+
+import asyncio
+from collections import OrderedDict
+import itertools
+import json
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+UNIX_SCHEME = "unix://"
+# the longest json line read, well above the largest decisions
+LINE_LIMIT = 64 * 2**20
+
+
+class LocalCache:
+    """Entries in the memory of the process, the least recently used ones
+    are dropped beyond `max_entries`."""
+
+    shared = False
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return True
+
+    def _add(self, key, value, ttl):
+        if self._get(key) is not None:
+            return False
+        return self._set(key, value, ttl)
+
+    async def get(self, key):
+        """The value of `key`, None when missing or expired."""
+        return self._get(key)
+
+    async def set(self, key, value, ttl):
+        """Sets `key` to `value` for `ttl` seconds."""
+        return self._set(key, value, ttl)
+
+    async def add(self, key, value, ttl):
+        """Sets `key` only if missing, returns whether it was set. Used as a
+        lock between workers."""
+        return self._add(key, value, ttl)
+
+    async def close(self):
+        pass
+
+
+class SocketCache:
+    """Client of a cache server listening on a unix socket. The cache being
+    an optimisation, a failing server is reported as a missing entry rather
+    than an error and the connection is opened again on the next call. The
+    values of more than `max_value_size` bytes as json are not cached."""
+
+    shared = True
+
+    def __init__(self, path, timeout=1.0, max_value_size=8 * 2**20):
+        self.path = path
+        self.timeout = timeout
+        self.max_value_size = max_value_size
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+        self._ids = itertools.count()
+
+    async def _request(self, request):
+        request["id"] = next(self._ids)
+        message = json.dumps(request).encode()
+        if "value" in request and len(message) > self.max_value_size:
+            # not worth the memory of the server, fetched again when asked
+            return {}
+        async with self._lock:
+            try:
+                if self._writer is None:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_unix_connection(self.path, limit=LINE_LIMIT),
+                        self.timeout,
+                    )
+                self._writer.write(message + b"\n")
+                line = await asyncio.wait_for(self._reader.readline(), self.timeout)
+                if not line:
+                    raise ConnectionError("connection closed by the cache server")
+                response = json.loads(line)
+                if response.get("id") != request["id"]:
+                    raise ValueError("response of another request")
+                return response
+            except (OSError, asyncio.TimeoutError, ValueError):
+                logger.warning("cache server %s unavailable", self.path, exc_info=True)
+                await self._close()
+                return {}
+            except BaseException:
+                # cancelled between the request and its response, which
+                # would otherwise be read as the response of the next one
+                await self._close()
+                raise
+
+    async def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def get(self, key):
+        response = await self._request({"op": "get", "key": key})
+        return response.get("value")
+
+    async def set(self, key, value, ttl):
+        response = await self._request(
+            {"op": "set", "key": key, "value": value, "ttl": ttl}
+        )
+        return response.get("done", False)
+
+    async def add(self, key, value, ttl):
+        response = await self._request(
+            {"op": "add", "key": key, "value": value, "ttl": ttl}
+        )
+        return response.get("done", False)
+
+    async def close(self):
+        async with self._lock:
+            await self._close()
+
+
+def get_cache(url=None, max_value_size=8 * 2**20):
+    """The cache at `url`, a `unix://` socket of a cache server, a local one
+    when not given."""
+    if not url:
+        return LocalCache()
+    if url.startswith(UNIX_SCHEME):
+        return SocketCache(url[len(UNIX_SCHEME) :], max_value_size=max_value_size)
+    raise ValueError(f"unsupported cache url {url}")
+
+
+async def serve(path, max_entries=100000):
+    """Runs a cache server on the unix socket `path`, returns the
+    `asyncio.Server`."""
+    cache = LocalCache(max_entries)
+
+    async def handle(reader, writer):
+        try:
+            while line := await reader.readline():
+                request = json.loads(line)
+                op, key = request["op"], request["key"]
+                if op == "get":
+                    response = {"value": cache._get(key)}
+                elif op in ("set", "add"):
+                    method = cache._set if op == "set" else cache._add
+                    response = {"done": method(key, request["value"], request["ttl"])}
+                else:
+                    response = {"error": f"unknown operation {op}"}
+                response["id"] = request.get("id")
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, ValueError, KeyError):
+            logger.warning("cache client dropped", exc_info=True)
+        finally:
+            writer.close()
+
+    return await asyncio.start_unix_server(handle, path, limit=LINE_LIMIT)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="Runs the cache shared by the api workers")
+    parser.add_argument("path", help="the unix socket the server listens on")
+    parser.add_argument(
+        "--max-entries",
+        type=int,
+        default=100000,
+        help="how many entries are kept at most",
+    )
+    args = parser.parse_args()
+
+    async def main():
+        server = await serve(args.path, args.max_entries)
+        async with server:
+            await server.serve_forever()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
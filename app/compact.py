@@ -0,0 +1,138 @@
+"""Compact layout of the paragraphes of a decision.
+
+The parser gives the paragraphes as lists of lines, which the models and
+the json of `_source` keep as such: thousands of small strings and lists by
+decision. `CompactParagraphs` holds them instead as one text, the lines
+joined by a newline, with the offset in the text where each line ends and
+the count of lines where each paragraph ends. The nested lists are only
+built for the part asked by `nested`.
+
+The documents indexed compact (`Indexer(compact=True)`) store the text under
+`paragraphes_text`, searched in place of `paragraphes`, and the offsets
+under `paragraphes_offsets`, kept in the source only. Both layouts can live
+in the same index, `paragraphes` gives the paragraphes of a document in the
+layout asked whichever it was stored in.
+
+example:
+  >>> compact = CompactParagraphs.from_nested([["a", "bc"], ["d"]])
+  >>> compact.text, compact.lines, compact.paragraphs
+  ('a\\nbc\\nd', [1, 4, 6], [2, 3])
+  >>> compact.nested(slice(1, 2))
+  [['d']]
+"""
+
+from app.model import CompactParagraphesModel
+
+TEXT_FIELD = "paragraphes_text"
+OFFSETS_FIELD = "paragraphes_offsets"
+
+
+class CompactParagraphs:
+    """Paragraphes as a `text` with the end offset of each of its `lines`
+    and the end line of each of its `paragraphs`."""
+
+    __slots__ = ("text", "lines", "paragraphs")
+
+    def __init__(self, text, lines, paragraphs):
+        self.text = text
+        self.lines = lines
+        self.paragraphs = paragraphs
+
+    @classmethod
+    def from_nested(cls, paragraphes):
+        lines = []
+        paragraphs = []
+        offset = -1
+        for paragraph in paragraphes:
+            for line in paragraph:
+                offset += len(line) + 1
+                lines.append(offset)
+            paragraphs.append(len(lines))
+        text = "\n".join(line for paragraph in paragraphes for line in paragraph)
+        return cls(text, lines, paragraphs)
+
+    @classmethod
+    def from_document(cls, document):
+        """The paragraphes of a document indexed compact, popped out of it.
+        None if it was not."""
+        offsets = document.pop(OFFSETS_FIELD, None)
+        text = document.pop(TEXT_FIELD, None)
+        if offsets is None or text is None:
+            return None
+        return cls(text, offsets["lines"], offsets["paragraphs"])
+
+    def to_document(self):
+        """The fields of the document indexed compact."""
+        return {
+            TEXT_FIELD: self.text,
+            OFFSETS_FIELD: {"lines": self.lines, "paragraphs": self.paragraphs},
+        }
+
+    def __len__(self):
+        return len(self.paragraphs)
+
+    def _bounds(self, part):
+        """The first and last lines of the paragraphs of `part`."""
+        start, stop, _ = part.indices(len(self.paragraphs))
+        stop = max(start, stop)
+        first = self.paragraphs[start - 1] if start else 0
+        last = self.paragraphs[stop - 1] if stop else 0
+        return start, stop, first, last
+
+    def _start(self, line):
+        return self.lines[line - 1] + 1 if line else 0
+
+    def nested(self, part=None):
+        """The paragraphes of `part` (a `slice`), all of them if not given,
+        as lists of lines."""
+        start, stop, first, _ = self._bounds(part or slice(None))
+        text, lines = self.text, self.lines
+        paragraphes = []
+        begin = self._start(first)
+        line = first
+        for end in self.paragraphs[start:stop]:
+            paragraph = []
+            while line < end:
+                paragraph.append(text[begin : lines[line]])
+                begin = lines[line] + 1
+                line += 1
+            paragraphes.append(paragraph)
+        return paragraphes
+
+    def part(self, part):
+        """The paragraphes of `part` (a `slice`) alone."""
+        start, stop, first, last = self._bounds(part)
+        begin = self._start(first)
+        end = self.lines[last - 1] if last > first else begin
+        return CompactParagraphs(
+            self.text[begin:end],
+            [offset - begin for offset in self.lines[first:last]],
+            [line - first for line in self.paragraphs[start:stop]],
+        )
+
+    def model(self):
+        return CompactParagraphesModel.model_construct(
+            text=self.text, lines=self.lines, paragraphs=self.paragraphs
+        )
+
+
+def compact_document(document):
+    """Replaces the paragraphes of `document` by their compact fields."""
+    document.update(
+        CompactParagraphs.from_nested(document.pop("paragraphes")).to_document()
+    )
+    return document
+
+
+def paragraphes(document, part=None, compact=False):
+    """The paragraphes of `document`, popping the compact fields out of it:
+    the `CompactParagraphesModel` model if `compact`, lists of lines otherwise.
+    Only the `part` range (a `slice`) of the compact fields is taken, the
+    nested paragraphes being already cut by the backends."""
+    stored = CompactParagraphs.from_document(document)
+    if stored is None:
+        nested = document.get("paragraphes", [])
+        return CompactParagraphs.from_nested(nested).model() if compact else nested
+    if part is not None:
+        stored = stored.part(part)
+    return stored.model() if compact else stored.nested()
@@ -8,7 +8,15 @@ from elasticsearch import AsyncElasticsearch, Elasticsearch
 from app.exceptions import ConfigurationError
 
 
+# the urls of the in memory stand-in, imported only when used
+MEMORY_SCHEME = "memory://"
+
+
 def get_config_from_env():
+    url = os.environ.get("ELASTIC_URL", "")
+    if url.startswith(MEMORY_SCHEME):
+        # the in memory stand-in needs no credentials, see `app.es_memory`
+        return {"url": url}
     try:
         return {
             "passwd": os.environ["ELASTIC_PASSWORD"],
@@ -20,18 +28,58 @@ def get_config_from_env():
         raise ConfigurationError("No ES configuration in the environment")
 
 
+# the event loop and the client shared by `async_client` once `open_pool`
+# was called on it
+_pool = None
+
+
+def _new_async_client(**kwargs):
+    config = get_config_from_env()
+    if config["url"].startswith(MEMORY_SCHEME):
+        from app.es_memory import AsyncMemoryElasticsearch
+
+        return AsyncMemoryElasticsearch(config["url"], **kwargs)
+    return AsyncElasticsearch(
+        config["url"],
+        ca_certs=config["ca_certs"],
+        basic_auth=(config["user"], config["passwd"]),
+        **kwargs,
+    )
+
+
+async def open_pool(connections=10):
+    """Opens a client shared by the `async_client` calls made on the running
+    event loop, keeping up to `connections` connections to each node, and
+    returns it."""
+    global _pool
+    await close_pool()
+    client = _new_async_client(connections_per_node=connections)
+    _pool = (asyncio.get_running_loop(), client)
+    return client
+
+
+async def close_pool():
+    """Closes the client opened by `open_pool`."""
+    global _pool
+    if _pool is not None:
+        _, client = _pool
+        _pool = None
+        await client.close()
+
+
 @asynccontextmanager
 async def async_client():
     """Context manager providing an async client for ES provided
     that ELASTIC_USER, ELASTIC_PASSWORD, ELASTIC_CERTS_PATH and
     ELASTIC_URL are set in the environment.
+    An ELASTIC_URL starting with "memory://" gives the in memory stand-in.
+    The client opened by `open_pool` is given when there is one, its
+    connections are kept open, a client of its own otherwise.
     """
-    config = get_config_from_env()
-    client = AsyncElasticsearch(
-        config["url"],
-        ca_certs=config["ca_certs"],
-        basic_auth=(config["user"], config["passwd"]),
-    )
+    if _pool is not None and _pool[0] is asyncio.get_running_loop():
+        yield _pool[1]
+        return
+    client = _new_async_client()
     try:
         yield client
     finally:
@@ -45,6 +93,10 @@ def get_client(config=None):
     environment.
     """
     config = config or get_config_from_env()
+    if config["url"].startswith(MEMORY_SCHEME):
+        from app.es_memory import MemoryElasticsearch
+
+        return MemoryElasticsearch(config["url"])
     return Elasticsearch(
         config["url"],
         ca_certs=config["ca_certs"],
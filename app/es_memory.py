@@ -0,0 +1,1422 @@
+"""In memory stand-in for Elastic Search, for tests and benchmarks.
+
+`MemoryElasticsearch` and `AsyncMemoryElasticsearch` implement the subset of
+the client API the project uses (`index`, `bulk`, `get`, `mget`, `count`,
+`search`, `msearch`, points in time and the `indices` management calls, index
+templates and aliases included) on documents kept in memory, and answer with
+the same response and error types as the real clients. A point in time only
+keeps which documents existed when opened, not their content then.
+
+Queries supported are `match_all`, `match` (scored with BM25 on text
+fields), `term`, `terms`, `prefix`, `range`, `ids`, `exists` and `bool`.
+Searches can be sorted, paginated with `from_` or `search_after`, return
+`fields` or `docvalue_fields` and run `terms` and `composite` aggregations.
+Text is analyzed like the standard analyzer does: lowercased words,
+apostrophes kept.
+
+The clients are returned by `app.es` when `ELASTIC_URL` uses the `memory://`
+scheme. The clients given the same url share the same documents, the query
+string of the url sets a latency injected on each call:
+    - `latency`: the median latency in seconds (0 by default),
+    - `jitter`: the sigma of the log-normal distribution of the latencies
+      (0.5 by default), giving the long tail of a real cluster.
+Bulk items can be rejected with a 429 like an overloaded cluster does:
+    - `reject`: the probability an item is rejected (0 by default),
+    - `capacity`: how many bulk items can be processed at once, by all the
+      clients of the url, the items beyond are rejected (no limit by
+      default).
+
+example:
+  $ ELASTIC_URL="memory://bench?latency=0.002" pytest app
+"""
+
+import asyncio
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+import fnmatch
+import json
+import math
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+import uuid
+
+import elasticsearch
+from elastic_transport import (
+    ApiResponseMeta,
+    HeadApiResponse,
+    HttpHeaders,
+    NodeConfig,
+    ObjectApiResponse,
+)
+from elasticsearch.serializer import JsonSerializer
+
+from app.es import MEMORY_SCHEME
+
+
+MAX_RESULT_WINDOW = 10000
+# BM25 parameters, as set by default in ES
+K1 = 1.2
+B = 0.75
+
+TOKEN = re.compile(r"\w+(?:['’]\w+)*")
+DATE = re.compile(r"^\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?")
+
+_serializer = JsonSerializer()
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def analyze(text):
+    """Splits a text into lowercased tokens."""
+    return TOKEN.findall(text.lower())
+
+
+def parse_date(value):
+    """Returns a date given as iso string or epoch millis as epoch millis."""
+    if isinstance(value, (int, float)):
+        return int(value)
+    date = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return int(date.timestamp() * 1000)
+
+
+def format_date(millis, fmt=None):
+    """Formats epoch millis as ES does for the given format."""
+    date = datetime.fromtimestamp(millis / 1000, tz=timezone.utc)
+    if fmt in ("strict_date", "date", "yyyy-MM-dd"):
+        return date.strftime("%Y-%m-%d")
+    if fmt == "epoch_millis":
+        return str(millis)
+    return date.strftime("%Y-%m-%dT%H:%M:%S.") + f"{date.microsecond // 1000:03}Z"
+
+
+def leaves(value, path):
+    """Values found under a dotted `path` of a source, nested lists being
+    flattened."""
+    values = [value]
+    for name in path.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and name in value:
+                found.append(value[name])
+        values = list(_flatten(found))
+    return [value for value in values if value is not None]
+
+
+def _flatten(values):
+    for value in values:
+        if isinstance(value, list):
+            yield from _flatten(value)
+        else:
+            yield value
+
+
+def _meta(status, duration=0.0):
+    return ApiResponseMeta(
+        status=status,
+        http_version="1.1",
+        headers=HttpHeaders({"x-elastic-product": "Elasticsearch"}),
+        duration=duration,
+        node=NodeConfig("memory", "localhost", 9200),
+    )
+
+
+def _error(cls, status, kind, reason):
+    body = {"error": {"type": kind, "reason": reason}, "status": status}
+    return cls(message=kind, meta=_meta(status), body=body)
+
+
+class Document:
+    """A document as stored, with its analyzed fields."""
+
+    __slots__ = ("id", "source", "version", "seq", "terms", "lengths", "values")
+
+    def __init__(self, id, source, version, seq):
+        self.id = id
+        self.source = source
+        self.version = version
+        self.seq = seq
+        self.terms = {}
+        self.lengths = {}
+        self.values = {}
+
+
+class Index:
+    """The documents of an index with their mapping and inverted index."""
+
+    def __init__(self, name, mappings=None):
+        self.name = name
+        self.properties = {}
+        # the objects kept in the source only
+        self.disabled = set()
+        self.meta = {}
+        self.aliases = set()
+        self.settings = {}
+        self.docs = {}
+        self.seq = 0
+        self.postings = defaultdict(lambda: defaultdict(set))
+        self.total_lengths = Counter()
+        if mappings:
+            self.put_mapping(mappings.get("properties", {}), mappings.get("_meta"))
+
+    def put_mapping(self, properties, meta=None, prefix=""):
+        for name, spec in properties.items():
+            path = prefix + name
+            if "properties" in spec:
+                self.put_mapping(spec["properties"], prefix=f"{path}.")
+                continue
+            self.properties[path] = spec.get("type", "object")
+            if spec.get("enabled") is False:
+                self.disabled.add(path)
+            for sub, subspec in spec.get("fields", {}).items():
+                self.properties[f"{path}.{sub}"] = subspec.get("type", "keyword")
+        if meta is not None:
+            self.meta = meta
+
+    @property
+    def mappings(self):
+        properties = {}
+        for path, kind in self.properties.items():
+            parent, _, sub = path.rpartition(".")
+            if parent in self.properties:
+                properties[parent].setdefault("fields", {})[sub] = {"type": kind}
+            else:
+                properties[path] = {"type": kind}
+        mappings = {"properties": properties}
+        if self.meta:
+            mappings["_meta"] = self.meta
+        return mappings
+
+    def _map(self, value, prefix=""):
+        """Dynamic mapping of the fields not mapped yet."""
+        for name, item in value.items():
+            path = prefix + name
+            if path in self.disabled:
+                continue
+            if isinstance(item, list):
+                item = next(_flatten(item), None)
+            if item is None or path in self.properties:
+                if isinstance(item, dict):
+                    self._map(item, f"{path}.")
+                continue
+            if isinstance(item, dict):
+                self._map(item, f"{path}.")
+            elif isinstance(item, bool):
+                self.properties[path] = "boolean"
+            elif isinstance(item, int):
+                self.properties[path] = "long"
+            elif isinstance(item, float):
+                self.properties[path] = "float"
+            elif DATE.match(item):
+                self.properties[path] = "date"
+            else:
+                self.properties[path] = "text"
+                self.properties[f"{path}.keyword"] = "keyword"
+
+    def _unindex(self, doc):
+        for field, terms in doc.terms.items():
+            for term in terms:
+                self.postings[field][term].discard(doc.id)
+            self.total_lengths[field] -= doc.lengths[field]
+        for field, values in doc.values.items():
+            if self.properties.get(field) == "keyword":
+                for value in values:
+                    self.postings[field][value].discard(doc.id)
+
+    def _analyze(self, doc):
+        for field, kind in self.properties.items():
+            if field.endswith(".keyword") and field[:-8] in self.properties:
+                values = [
+                    value
+                    for value in leaves(doc.source, field[:-8])
+                    if isinstance(value, str) and len(value) <= 256
+                ]
+            else:
+                values = leaves(doc.source, field)
+            if not values:
+                continue
+            if kind == "text":
+                tokens = [token for value in values for token in analyze(str(value))]
+                doc.terms[field] = Counter(tokens)
+                doc.lengths[field] = len(tokens)
+                self.total_lengths[field] += len(tokens)
+                for term in doc.terms[field]:
+                    self.postings[field][term].add(doc.id)
+            elif kind == "keyword":
+                doc.values[field] = [str(value) for value in values]
+                for value in doc.values[field]:
+                    self.postings[field][value].add(doc.id)
+            elif kind == "date":
+                doc.values[field] = [parse_date(value) for value in values]
+            elif kind != "object":
+                doc.values[field] = values
+
+    def put(self, id, source, version=None):
+        self._map(source)
+        previous = self.docs.pop(id, None)
+        if previous:
+            self._unindex(previous)
+        self.seq += 1
+        if version is None:
+            version = previous.version + 1 if previous else 1
+        doc = Document(id, source, version, self.seq)
+        self._analyze(doc)
+        self.docs[id] = doc
+        return doc, previous is None
+
+    def delete(self, id):
+        doc = self.docs.pop(id, None)
+        if doc:
+            self._unindex(doc)
+        return doc
+
+    def kind(self, field):
+        return self.properties.get(field)
+
+
+class Store:
+    """Indices shared by the clients given the same url."""
+
+    def __init__(self):
+        self.indices = {}
+        self.lock = threading.RLock()
+        # bulk items being processed, see `MemoryElasticsearch.bulk`
+        self.bulk_items = 0
+        # index templates by name: (index patterns, template)
+        self.templates = {}
+        # points in time by id: (index expression, ids by index name)
+        self.pits = {}
+
+    def resolve(self, index, missing_ok=False):
+        """Indices targeted by an index expression (names, aliases and
+        wildcards, comma separated)."""
+        names = index if isinstance(index, (list, tuple)) else index.split(",")
+        found = []
+        for name in names:
+            if name in ("_all", "*"):
+                found += self.indices.values()
+                continue
+            pattern = re.compile(
+                "^" + ".*".join(re.escape(part) for part in name.split("*")) + "$"
+            )
+            matching = [
+                idx
+                for idx in self.indices.values()
+                if pattern.match(idx.name) or any(pattern.match(a) for a in idx.aliases)
+            ]
+            if not matching and "*" not in name and not missing_ok:
+                raise _error(
+                    elasticsearch.NotFoundError,
+                    404,
+                    "index_not_found_exception",
+                    f"no such index [{name}]",
+                )
+            found += matching
+        return list(dict.fromkeys(found))
+
+    def create(self, name, mappings=None, aliases=None):
+        """Creates the index `name` with the mappings and aliases of the
+        templates matching its name, then the ones given."""
+        properties = {}
+        meta = None
+        names = set()
+        for patterns, template in self.templates.values():
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns):
+                properties.update(template.get("mappings", {}).get("properties", {}))
+                meta = template.get("mappings", {}).get("_meta", meta)
+                names.update(template.get("aliases") or {})
+        if mappings:
+            properties.update(mappings.get("properties", {}))
+            meta = mappings.get("_meta", meta)
+        idx = self.indices[name] = Index(
+            name, {"properties": properties, "_meta": meta}
+        )
+        idx.aliases.update(names, aliases or {})
+        return idx
+
+    def get_or_create(self, name):
+        targets = [idx for idx in self.indices.values() if name in idx.aliases]
+        if targets:
+            return targets[0]
+        if name not in self.indices:
+            self.create(name)
+        return self.indices[name]
+
+
+def get_store(name):
+    with _stores_lock:
+        if name not in _stores:
+            _stores[name] = Store()
+        return _stores[name]
+
+
+def _score_bm25(index, field, terms, ids=None):
+    """BM25 scores on a text field of the documents having one of `terms`."""
+    postings = index.postings.get(field, {})
+    total = len(index.docs)
+    average = index.total_lengths[field] / total if total else 0
+    scores = defaultdict(float)
+    for term, count in Counter(terms).items():
+        matching = postings.get(term, ())
+        if not matching:
+            continue
+        idf = math.log(1 + (total - len(matching) + 0.5) / (len(matching) + 0.5))
+        for id in matching:
+            if ids is not None and id not in ids:
+                continue
+            doc = index.docs[id]
+            tf = doc.terms[field][term]
+            norm = K1 * (1 - B + B * doc.lengths[field] / average)
+            scores[id] += count * idf * tf * (K1 + 1) / (tf + norm)
+    return scores
+
+
+def _field_query(query):
+    ((field, params),) = query.items()
+    return field, params
+
+
+def _matches_value(index, doc, field, value):
+    kind = index.kind(field)
+    if kind == "text":
+        return value.lower() in doc.terms.get(field, ())
+    values = doc.values.get(field, ())
+    if kind == "date":
+        return parse_date(value) in values
+    if kind == "keyword":
+        return str(value) in values
+    return value in values
+
+
+def evaluate(index, query):
+    """Returns the scores by id of the documents of `index` matching the
+    `query`."""
+    if not query:
+        query = {"match_all": {}}
+    ((kind, params),) = query.items()
+    if kind == "match_all":
+        return {id: params.get("boost", 1.0) for id in index.docs}
+    if kind == "match_none":
+        return {}
+    if kind == "ids":
+        return {id: 1.0 for id in params["values"] if id in index.docs}
+    if kind == "bool":
+        return _evaluate_bool(index, params)
+    field, params = _field_query(params)
+    if kind == "exists":
+        field = params
+        return {
+            id: 1.0
+            for id, doc in index.docs.items()
+            if field in doc.terms or field in doc.values
+        }
+    if not isinstance(params, dict) or kind == "range":
+        params = {"value" if kind != "match" else "query": params}
+    if kind == "match":
+        text = params["query"]
+        if index.kind(field) != "text":
+            return evaluate(index, {"term": {field: text}})
+        terms = analyze(str(text))
+        scores = _score_bm25(index, field, terms)
+        if params.get("operator", "or").lower() == "and":
+            scores = {
+                id: score
+                for id, score in scores.items()
+                if all(term in index.docs[id].terms[field] for term in terms)
+            }
+        return dict(scores)
+    if kind == "term":
+        value = params["value"]
+        if index.kind(field) == "keyword":
+            return {id: 1.0 for id in index.postings[field].get(str(value), ())}
+        return {
+            id: 1.0
+            for id, doc in index.docs.items()
+            if _matches_value(index, doc, field, value)
+        }
+    if kind == "terms":
+        scores = {}
+        for value in params["value"]:
+            scores.update(evaluate(index, {"term": {field: value}}))
+        return scores
+    if kind == "prefix":
+        value = str(params["value"])
+        if index.kind(field) == "text":
+            value = value.lower()
+            return {
+                id: 1.0
+                for id, doc in index.docs.items()
+                if any(term.startswith(value) for term in doc.terms.get(field, ()))
+            }
+        return {
+            id: 1.0
+            for id, doc in index.docs.items()
+            if any(str(v).startswith(value) for v in doc.values.get(field, ()))
+        }
+    if kind == "range":
+        bounds = params["value"]
+        convert = parse_date if index.kind(field) == "date" else (lambda v: v)
+        checks = []
+        for op, check in (
+            ("gte", lambda v, b: v >= b),
+            ("gt", lambda v, b: v > b),
+            ("lte", lambda v, b: v <= b),
+            ("lt", lambda v, b: v < b),
+        ):
+            if bounds.get(op) is not None:
+                checks.append((check, convert(bounds[op])))
+        return {
+            id: 1.0
+            for id, doc in index.docs.items()
+            if any(
+                all(check(value, bound) for check, bound in checks)
+                for value in doc.values.get(field, ())
+            )
+        }
+    raise _error(
+        elasticsearch.BadRequestError,
+        400,
+        "parsing_exception",
+        f"unknown query [{kind}]",
+    )
+
+
+def _evaluate_bool(index, params):
+    def clauses(name):
+        value = params.get(name, [])
+        return value if isinstance(value, list) else [value]
+
+    scores = None
+    for clause in clauses("must"):
+        found = evaluate(index, clause)
+        if scores is None:
+            scores = found
+        else:
+            scores = {id: scores[id] + found[id] for id in scores if id in found}
+    for clause in clauses("filter"):
+        found = evaluate(index, clause)
+        if scores is None:
+            scores = {id: 0.0 for id in found}
+        else:
+            scores = {id: score for id, score in scores.items() if id in found}
+    should = [evaluate(index, clause) for clause in clauses("should")]
+    if should:
+        required = params.get("minimum_should_match", 0 if scores is not None else 1)
+        matched = Counter(id for found in should for id in found)
+        if scores is None:
+            scores = {id: 0.0 for id in matched}
+        scores = {
+            id: score + sum(found.get(id, 0.0) for found in should)
+            for id, score in scores.items()
+            if matched[id] >= int(required)
+        }
+    if scores is None:
+        scores = {id: 1.0 for id in index.docs}
+    for clause in clauses("must_not"):
+        excluded = evaluate(index, clause)
+        scores = {id: score for id, score in scores.items() if id not in excluded}
+    return scores
+
+
+class _Reversed:
+    """Inverts the order of a value for the descending sorts."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def _sort_specs(sort):
+    specs = []
+    for item in sort if isinstance(sort, list) else [sort]:
+        if isinstance(item, str):
+            field, params = item, {}
+        else:
+            field, params = _field_query(item)
+        if isinstance(params, str):
+            params = {"order": params}
+        default = "desc" if field == "_score" else "asc"
+        specs.append((field, params.get("order", default), params.get("format")))
+    return specs
+
+
+def _sort_value(index, hit, field, fmt):
+    index_, doc, score = hit
+    if field == "_score":
+        return score
+    if field in ("_doc", "_shard_doc"):
+        return doc.seq
+    values = doc.values.get(field)
+    if values is None and field in doc.terms:
+        values = sorted(doc.terms[field])
+    if not values:
+        return None
+    value = min(values)
+    return value
+
+
+def _format_sort_value(index, field, value, fmt):
+    if value is not None and index.kind(field) == "date" and fmt:
+        return format_date(value, fmt)
+    return value
+
+
+def _key(value, order):
+    # missing values are sorted last whatever the order
+    if value is None:
+        return (1, 0)
+    return (0, _Reversed(value) if order == "desc" else value)
+
+
+def _source_filter(source, includes=None, excludes=None):
+    def keep(path):
+        if includes and not any(
+            path == inc or path.startswith(f"{inc}.") or inc.startswith(f"{path}.")
+            for inc in includes
+        ):
+            return False
+        return not (excludes and path in excludes)
+
+    def walk(value, prefix=""):
+        res = {}
+        for name, item in value.items():
+            path = prefix + name
+            if not keep(path):
+                continue
+            if isinstance(item, dict):
+                item = walk(item, f"{path}.")
+            res[name] = item
+        return res
+
+    return walk(source)
+
+
+def _as_list(value):
+    if value is None or isinstance(value, list):
+        return value
+    return value.split(",") if isinstance(value, str) else [value]
+
+
+class MemoryElasticsearch:
+    """Synchronous in memory stand-in for `elasticsearch.Elasticsearch`."""
+
+    def __init__(self, url=f"{MEMORY_SCHEME}default", **kwargs):
+        parts = urlsplit(url)
+        options = {k: v[-1] for k, v in parse_qs(parts.query).items()}
+        self.store = get_store(parts.netloc + parts.path)
+        self.latency = float(options.get("latency", 0))
+        self.jitter = float(options.get("jitter", 0.5))
+        self.reject = float(options.get("reject", 0))
+        self.capacity = int(options.get("capacity", 0))
+        self.indices = _Indices(self)
+
+    def _delay(self):
+        """Draws the latency injected on a call."""
+        if not self.latency:
+            return 0.0
+        return random.lognormvariate(math.log(self.latency), self.jitter)
+
+    def _wait(self, delay):
+        if delay:
+            time.sleep(delay)
+
+    def _call(self, method, *args, **kwargs):
+        start = time.perf_counter()
+        delay = self._delay()
+        with self.store.lock:
+            body, status = method(*args, **kwargs)
+        took = time.perf_counter() - start + delay
+        if isinstance(body, dict) and "took" in body:
+            body["took"] = int(took * 1000)
+        return ObjectApiResponse(body=body, meta=_meta(status, took)), delay
+
+    def _response(self, method, *args, **kwargs):
+        resp, delay = self._call(method, *args, **kwargs)
+        self._wait(delay)
+        return resp
+
+    def info(self, **kwargs):
+        return self._response(
+            lambda: (
+                {
+                    "name": "memory",
+                    "cluster_name": "memory",
+                    "version": {"number": elasticsearch.__versionstr__},
+                    "tagline": "You Know, for Search",
+                },
+                200,
+            )
+        )
+
+    def close(self):
+        pass
+
+    # documents
+
+    @staticmethod
+    def _check_version(idx, id, version, version_type):
+        """Raises the conflict of an external `version` lower than the one
+        stored."""
+        previous = idx.docs.get(id)
+        if previous and (
+            previous.version > version
+            or (version_type == "external" and previous.version == version)
+        ):
+            raise _error(
+                elasticsearch.ConflictError,
+                409,
+                "version_conflict_engine_exception",
+                f"[{id}]: version conflict, current version "
+                f"[{previous.version}] is higher than the one provided "
+                f"[{version}]",
+            )
+
+    def _index(self, index, document, id=None, version=None, version_type=None):
+        idx = self.store.get_or_create(index)
+        id = id or uuid.uuid4().hex
+        if version_type in ("external", "external_gte"):
+            self._check_version(idx, id, version, version_type)
+        else:
+            version = None
+        doc, created = idx.put(id, json.loads(_serializer.dumps(document)), version)
+        return (
+            {
+                "_index": idx.name,
+                "_id": id,
+                "_version": doc.version,
+                "result": "created" if created else "updated",
+                "_shards": {"total": 1, "successful": 1, "failed": 0},
+                "_seq_no": doc.seq,
+                "_primary_term": 1,
+            },
+            201 if created else 200,
+        )
+
+    def index(self, index, document=None, id=None, body=None, **kwargs):
+        return self._response(
+            self._index,
+            index,
+            document or body,
+            id,
+            kwargs.get("version"),
+            kwargs.get("version_type"),
+        )
+
+    def _get_doc(
+        self, index, id, source=None, source_includes=None, source_excludes=None
+    ):
+        targets = self.store.resolve(index)
+        for idx in targets:
+            doc = idx.docs.get(id)
+            if doc is not None:
+                break
+        else:
+            return None, {"_index": index, "_id": id, "found": False}
+        hit = {
+            "_index": idx.name,
+            "_id": id,
+            "_version": doc.version,
+            "_seq_no": doc.seq,
+            "_primary_term": 1,
+            "found": True,
+        }
+        if source is not False:
+            includes = _as_list(source_includes) or (
+                _as_list(source) if source not in (None, True) else None
+            )
+            hit["_source"] = _source_filter(
+                doc.source, includes, _as_list(source_excludes)
+            )
+        return doc, hit
+
+    def _get(self, index, id, source=None, source_includes=None, source_excludes=None):
+        doc, hit = self._get_doc(index, id, source, source_includes, source_excludes)
+        if doc is None:
+            raise _error(
+                elasticsearch.NotFoundError, 404, "not_found", f"[{id}] not found"
+            )
+        return hit, 200
+
+    def get(
+        self,
+        index,
+        id,
+        source=None,
+        source_includes=None,
+        source_excludes=None,
+        **kwargs,
+    ):
+        try:
+            return self._response(
+                self._get, index, id, source, source_includes, source_excludes
+            )
+        except elasticsearch.NotFoundError:
+            self._wait(self._delay())
+            raise
+
+    def _mget(self, index=None, docs=None, ids=None, **kwargs):
+        if docs is None:
+            docs = [{"_id": id} for id in ids or []]
+        found = []
+        for spec in docs:
+            _, hit = self._get_doc(
+                spec.get("_index", index),
+                spec["_id"],
+                spec.get("_source", kwargs.get("source")),
+                kwargs.get("source_includes"),
+                kwargs.get("source_excludes"),
+            )
+            found.append(hit)
+        return {"docs": found}, 200
+
+    def mget(self, index=None, docs=None, ids=None, body=None, **kwargs):
+        if body:
+            docs, ids = body.get("docs", docs), body.get("ids", ids)
+        return self._response(self._mget, index, docs, ids, **kwargs)
+
+    def _delete(self, index, id, version=None, version_type=None, **kwargs):
+        idx = self.store.indices.get(index) or self.store.get_or_create(index)
+        if version_type in ("external", "external_gte"):
+            self._check_version(idx, id, version, version_type)
+        doc = idx.delete(id)
+        if doc is None:
+            raise _error(
+                elasticsearch.NotFoundError, 404, "not_found", f"[{id}] not found"
+            )
+        return {"_index": idx.name, "_id": id, "result": "deleted"}, 200
+
+    def delete(self, index, id, **kwargs):
+        return self._response(self._delete, index, id, **kwargs)
+
+    def _bulk(self, operations, index=None, **kwargs):
+        operations = list(operations)
+        items = []
+        errors = False
+        position = 0
+        while position < len(operations):
+            ((action, meta),) = operations[position].items()
+            position += 1
+            name = meta.get("_index", index)
+            id = meta.get("_id")
+            if action != "delete":
+                document = operations[position]
+                position += 1
+            if random.random() < self.reject or (
+                self.capacity and self.store.bulk_items >= self.capacity
+            ):
+                errors = True
+                items.append(
+                    {
+                        action: {
+                            "_index": name,
+                            "_id": id,
+                            "status": 429,
+                            "error": {
+                                "type": "es_rejected_execution_exception",
+                                "reason": "rejected execution of bulk item",
+                            },
+                        }
+                    }
+                )
+                continue
+            self.store.bulk_items += 1
+            try:
+                if action == "delete":
+                    body, status = self._delete(
+                        name, id, meta.get("version"), meta.get("version_type")
+                    )
+                else:
+                    if action == "update":
+                        idx = self.store.get_or_create(name)
+                        doc = idx.docs.get(id)
+                        if doc is None:
+                            raise _error(
+                                elasticsearch.NotFoundError,
+                                404,
+                                "document_missing_exception",
+                                f"[{id}]: document missing",
+                            )
+                        source = dict(doc.source)
+                        source.update(json.loads(_serializer.dumps(document["doc"])))
+                        idx.put(id, source)
+                        body, status = {
+                            "_index": idx.name,
+                            "_id": id,
+                            "result": "updated",
+                        }, 200
+                    elif (
+                        action == "create" and id in self.store.get_or_create(name).docs
+                    ):
+                        raise _error(
+                            elasticsearch.ConflictError,
+                            409,
+                            "version_conflict_engine_exception",
+                            f"[{id}]: version conflict, document already exists",
+                        )
+                    else:
+                        body, status = self._index(
+                            name,
+                            document,
+                            id,
+                            meta.get("version"),
+                            meta.get("version_type"),
+                        )
+                items.append({action: {**body, "status": status}})
+            except elasticsearch.ApiError as e:
+                errors = True
+                items.append(
+                    {
+                        action: {
+                            "_index": name,
+                            "_id": id,
+                            "status": e.meta.status,
+                            "error": e.body["error"],
+                        }
+                    }
+                )
+        return {"took": 0, "errors": errors, "items": items}, 200
+
+    def _release(self, resp):
+        """Ends the processing of the items of a bulk response."""
+        processed = sum(
+            1
+            for item in resp["items"]
+            for value in item.values()
+            if value["status"] != 429
+        )
+        with self.store.lock:
+            self.store.bulk_items -= processed
+
+    def bulk(self, operations=None, index=None, body=None, **kwargs):
+        resp, delay = self._call(self._bulk, operations or body, index)
+        try:
+            self._wait(delay)
+        finally:
+            self._release(resp)
+        return resp
+
+    # searches
+
+    def _hits(self, index, query, ignore_unavailable=False):
+        hits = []
+        for idx in self.store.resolve(index, missing_ok=ignore_unavailable):
+            scores = evaluate(idx, query)
+            hits += [
+                (idx, idx.docs[id], score)
+                for id, score in sorted(
+                    scores.items(), key=lambda i: idx.docs[i[0]].seq
+                )
+            ]
+        return hits
+
+    def _count(self, index=None, query=None, ignore_unavailable=False, **kwargs):
+        return {
+            "count": len(self._hits(index or "_all", query, ignore_unavailable)),
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+        }, 200
+
+    def count(self, index=None, query=None, body=None, **kwargs):
+        if body:
+            query = body.get("query", query)
+        return self._response(
+            self._count, index, query, kwargs.get("ignore_unavailable", False)
+        )
+
+    def _fields(self, idx, doc, fields):
+        res = {}
+        for spec in fields:
+            if isinstance(spec, str):
+                spec = {"field": spec}
+            field = spec["field"]
+            names = (
+                [
+                    f
+                    for f in idx.properties
+                    if re.match(field.replace("*", ".*") + "$", f)
+                ]
+                if "*" in field
+                else [field]
+            )
+            for name in names:
+                values = leaves(doc.source, name)
+                if not values:
+                    continue
+                if idx.kind(name) == "date":
+                    values = [
+                        format_date(parse_date(v), spec.get("format")) for v in values
+                    ]
+                res[name] = values
+        return res
+
+    def _aggregate(self, hits, aggs):
+        res = {}
+        for name, spec in aggs.items():
+            ((kind, params),) = (
+                (k, v) for k, v in spec.items() if k not in ("aggs", "aggregations")
+            )
+            if kind == "terms":
+                counts = Counter(
+                    value
+                    for idx, doc, _ in hits
+                    for value in set(doc.values.get(params["field"], ()))
+                )
+                ordered = sorted(counts.items(), key=lambda i: (-i[1], i[0]))
+                res[name] = {
+                    "doc_count_error_upper_bound": 0,
+                    "sum_other_doc_count": sum(
+                        c for _, c in ordered[params.get("size", 10) :]
+                    ),
+                    "buckets": [
+                        {"key": key, "doc_count": count}
+                        for key, count in ordered[: params.get("size", 10)]
+                    ],
+                }
+            elif kind == "composite":
+                sources = [_field_query(source) for source in params["sources"]]
+                counts = Counter()
+                for idx, doc, _ in hits:
+                    keys = [[]]
+                    for _, spec in sources:
+                        _, source = _field_query(spec)
+                        values = set(doc.values.get(source["field"], ()))
+                        keys = [key + [value] for key in keys for value in values]
+                    counts.update(tuple(key) for key in keys)
+                ordered = sorted(counts.items())
+                after = params.get("after")
+                if after:
+                    after = tuple(after[name] for name, _ in sources)
+                    ordered = [item for item in ordered if item[0] > after]
+                buckets = [
+                    {
+                        "key": {name: value for (name, _), value in zip(sources, key)},
+                        "doc_count": count,
+                    }
+                    for key, count in ordered[: params.get("size", 10)]
+                ]
+                res[name] = {"buckets": buckets}
+                if buckets:
+                    res[name]["after_key"] = buckets[-1]["key"]
+            else:
+                raise _error(
+                    elasticsearch.BadRequestError,
+                    400,
+                    "parsing_exception",
+                    f"unknown aggregation type [{kind}]",
+                )
+        return res
+
+    def _search(
+        self,
+        index=None,
+        query=None,
+        sort=None,
+        size=None,
+        from_=None,
+        search_after=None,
+        fields=None,
+        source=None,
+        source_includes=None,
+        source_excludes=None,
+        aggs=None,
+        track_scores=False,
+        ignore_unavailable=False,
+        pit=None,
+        docvalue_fields=None,
+        version=False,
+        **kwargs,
+    ):
+        if pit is not None:
+            index, snapshot = self._point_in_time(pit["id"])
+        hits = self._hits(index or "_all", query, ignore_unavailable)
+        if pit is not None:
+            hits = [hit for hit in hits if hit[1].id in snapshot.get(hit[0].name, ())]
+        size = 10 if size is None else size
+        from_ = from_ or 0
+        if from_ + size > MAX_RESULT_WINDOW:
+            raise _error(
+                elasticsearch.BadRequestError,
+                400,
+                "illegal_argument_exception",
+                f"Result window is too large, from + size must be less than or "
+                f"equal to: [{MAX_RESULT_WINDOW}]",
+            )
+        specs = _sort_specs(sort) if sort else [("_score", "desc", None)]
+        keyed = [
+            (hit, [_sort_value(hit[0], hit, field, fmt) for field, _, fmt in specs])
+            for hit in hits
+        ]
+        keyed.sort(
+            key=lambda item: [
+                _key(value, order) for value, (_, order, _) in zip(item[1], specs)
+            ]
+        )
+        if search_after is not None:
+            after = [
+                (
+                    parse_date(value)
+                    if hits
+                    and hits[0][0].kind(field) == "date"
+                    and isinstance(value, str)
+                    else value
+                )
+                for value, (field, _, _) in zip(search_after, specs)
+            ]
+            after_key = [
+                _key(value, order) for value, (_, order, _) in zip(after, specs)
+            ]
+            keyed = [
+                item
+                for item in keyed
+                if [_key(value, order) for value, (_, order, _) in zip(item[1], specs)]
+                > after_key
+            ]
+        page = keyed[from_ : from_ + size]
+        scored = not sort or track_scores or any(f == "_score" for f, _, _ in specs)
+        includes = _as_list(source_includes) or (
+            _as_list(source) if source not in (None, True, False) else None
+        )
+        res_hits = []
+        for (idx, doc, score), values in page:
+            hit = {
+                "_index": idx.name,
+                "_id": doc.id,
+                "_score": score if scored else None,
+            }
+            if version:
+                hit["_version"] = doc.version
+            if source is not False:
+                hit["_source"] = _source_filter(
+                    doc.source, includes, _as_list(source_excludes)
+                )
+            if fields or docvalue_fields:
+                hit["fields"] = self._fields(
+                    idx, doc, (fields or []) + (docvalue_fields or [])
+                )
+            if sort:
+                hit["sort"] = [
+                    _format_sort_value(idx, field, value, fmt)
+                    for value, (field, _, fmt) in zip(values, specs)
+                ]
+            res_hits.append(hit)
+        body = {
+            "took": 0,
+            "timed_out": False,
+            "_shards": {"total": 1, "successful": 1, "skipped": 0, "failed": 0},
+            "hits": {
+                "total": {"value": len(hits), "relation": "eq"},
+                "max_score": (
+                    max((hit["_score"] or 0 for hit in res_hits), default=None)
+                    if scored
+                    else None
+                ),
+                "hits": res_hits,
+            },
+        }
+        if aggs:
+            body["aggregations"] = self._aggregate(hits, aggs)
+        if pit is not None:
+            body["pit_id"] = pit["id"]
+        return body, 200
+
+    @staticmethod
+    def _search_kwargs(body, kwargs):
+        if body:
+            kwargs = {**body, **kwargs}
+        if "from" in kwargs:
+            kwargs["from_"] = kwargs.pop("from")
+        if "_source" in kwargs:
+            kwargs["source"] = kwargs.pop("_source")
+        if "aggregations" in kwargs:
+            kwargs["aggs"] = kwargs.pop("aggregations")
+        return kwargs
+
+    def search(self, index=None, body=None, **kwargs):
+        return self._response(self._search, index, **self._search_kwargs(body, kwargs))
+
+    def _msearch(self, searches, index=None, **kwargs):
+        searches = list(searches)
+        responses = []
+        for header, body in zip(searches[::2], searches[1::2]):
+            try:
+                resp, status = self._search(
+                    header.get("index", index),
+                    ignore_unavailable=header.get("ignore_unavailable", False),
+                    **self._search_kwargs(body, {}),
+                )
+                responses.append({**resp, "status": status})
+            except elasticsearch.ApiError as e:
+                responses.append({**e.body, "status": e.meta.status})
+        return {"took": 0, "responses": responses}, 200
+
+    def msearch(self, searches=None, index=None, body=None, **kwargs):
+        return self._response(self._msearch, searches or body, index)
+
+    # points in time
+
+    def _point_in_time(self, id):
+        if id not in self.store.pits:
+            raise _error(
+                elasticsearch.NotFoundError,
+                404,
+                "search_context_missing_exception",
+                "No search context found for id",
+            )
+        return self.store.pits[id]
+
+    def _open_point_in_time(self, index, **kwargs):
+        snapshot = {
+            idx.name: set(idx.docs)
+            for idx in self.store.resolve(index, missing_ok=True)
+        }
+        id = uuid.uuid4().hex
+        self.store.pits[id] = (index, snapshot)
+        return {"id": id}, 200
+
+    def _close_point_in_time(self, id):
+        found = self.store.pits.pop(id, None) is not None
+        return {"succeeded": True, "num_freed": int(found)}, 200
+
+    def open_point_in_time(self, index, keep_alive=None, **kwargs):
+        return self._response(self._open_point_in_time, index)
+
+    def close_point_in_time(self, id=None, body=None, **kwargs):
+        return self._response(self._close_point_in_time, id or body["id"])
+
+
+class _Indices:
+    """The `indices` namespace of the client."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def _create(self, index, mappings=None, settings=None, aliases=None, **kwargs):
+        store = self.client.store
+        if index in store.indices:
+            raise _error(
+                elasticsearch.BadRequestError,
+                400,
+                "resource_already_exists_exception",
+                f"index [{index}] already exists",
+            )
+        store.create(index, mappings, aliases).settings = settings or {}
+        return {"acknowledged": True, "shards_acknowledged": True, "index": index}, 200
+
+    def create(self, index, **kwargs):
+        return self.client._response(self._create, index, **kwargs)
+
+    def exists(self, index, **kwargs):
+        found = bool(self.client.store.resolve(index, missing_ok=True))
+        self.client._wait(self.client._delay())
+        return HeadApiResponse(meta=_meta(200 if found else 404))
+
+    def _delete(self, index, **kwargs):
+        for idx in self.client.store.resolve(index):
+            del self.client.store.indices[idx.name]
+        return {"acknowledged": True}, 200
+
+    def delete(self, index, **kwargs):
+        return self.client._response(self._delete, index)
+
+    def _put_mapping(self, index, properties=None, meta=None, **kwargs):
+        for idx in self.client.store.resolve(index):
+            idx.put_mapping(properties or {}, meta)
+            for doc in list(idx.docs.values()):
+                idx.put(doc.id, doc.source, doc.version)
+        return {"acknowledged": True}, 200
+
+    def put_mapping(self, index, properties=None, meta=None, **kwargs):
+        return self.client._response(self._put_mapping, index, properties, meta)
+
+    def _get_mapping(self, index=None, **kwargs):
+        return {
+            idx.name: {"mappings": idx.mappings}
+            for idx in self.client.store.resolve(index or "_all")
+        }, 200
+
+    def get_mapping(self, index=None, **kwargs):
+        return self.client._response(self._get_mapping, index)
+
+    def refresh(self, index=None, **kwargs):
+        # documents are searchable as soon as they are indexed
+        return self.client._response(
+            lambda: ({"_shards": {"total": 1, "successful": 1, "failed": 0}}, 200)
+        )
+
+    def _put_index_template(self, name, index_patterns, template=None, **kwargs):
+        patterns = _as_list(index_patterns)
+        self.client.store.templates[name] = (patterns, template or {})
+        return {"acknowledged": True}, 200
+
+    def put_index_template(self, name, index_patterns=None, template=None, **kwargs):
+        return self.client._response(
+            self._put_index_template, name, index_patterns, template
+        )
+
+    def _delete_index_template(self, name, **kwargs):
+        if self.client.store.templates.pop(name, None) is None:
+            raise _error(
+                elasticsearch.NotFoundError,
+                404,
+                "resource_not_found_exception",
+                f"index template matching [{name}] not found",
+            )
+        return {"acknowledged": True}, 200
+
+    def delete_index_template(self, name, **kwargs):
+        return self.client._response(self._delete_index_template, name)
+
+    def _get_alias(self, index=None, name=None, **kwargs):
+        indices = self.client.store.resolve(index or "_all")
+        if name is not None:
+            indices = [idx for idx in indices if name in idx.aliases]
+            if not indices:
+                raise _error(
+                    elasticsearch.NotFoundError,
+                    404,
+                    "aliases_not_found_exception",
+                    f"alias [{name}] missing",
+                )
+        return {
+            idx.name: {
+                "aliases": {alias: {} for alias in idx.aliases if name in (None, alias)}
+            }
+            for idx in indices
+        }, 200
+
+    def get_alias(self, index=None, name=None, **kwargs):
+        return self.client._response(self._get_alias, index, name)
+
+
+class AsyncMemoryElasticsearch(MemoryElasticsearch):
+    """Asynchronous in memory stand-in for `elasticsearch.AsyncElasticsearch`.
+    Calls are processed synchronously, only the injected latency is awaited.
+    """
+
+    def __init__(self, url=f"{MEMORY_SCHEME}default", **kwargs):
+        super().__init__(url, **kwargs)
+        self.indices = _AsyncIndices(self)
+
+    async def _async_response(self, method, *args, **kwargs):
+        try:
+            resp, delay = self._call(method, *args, **kwargs)
+        except elasticsearch.ApiError:
+            await asyncio.sleep(self._delay())
+            raise
+        await asyncio.sleep(delay)
+        return resp
+
+    async def info(self, **kwargs):
+        return super().info()
+
+    async def close(self):
+        pass
+
+    async def index(self, index, document=None, id=None, body=None, **kwargs):
+        return await self._async_response(
+            self._index,
+            index,
+            document or body,
+            id,
+            kwargs.get("version"),
+            kwargs.get("version_type"),
+        )
+
+    async def get(
+        self,
+        index,
+        id,
+        source=None,
+        source_includes=None,
+        source_excludes=None,
+        **kwargs,
+    ):
+        return await self._async_response(
+            self._get, index, id, source, source_includes, source_excludes
+        )
+
+    async def mget(self, index=None, docs=None, ids=None, body=None, **kwargs):
+        if body:
+            docs, ids = body.get("docs", docs), body.get("ids", ids)
+        return await self._async_response(self._mget, index, docs, ids, **kwargs)
+
+    async def delete(self, index, id, **kwargs):
+        return await self._async_response(self._delete, index, id, **kwargs)
+
+    async def bulk(self, operations=None, index=None, body=None, **kwargs):
+        resp, delay = self._call(self._bulk, operations or body, index)
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            self._release(resp)
+        return resp
+
+    async def count(self, index=None, query=None, body=None, **kwargs):
+        if body:
+            query = body.get("query", query)
+        return await self._async_response(
+            self._count, index, query, kwargs.get("ignore_unavailable", False)
+        )
+
+    async def search(self, index=None, body=None, **kwargs):
+        return await self._async_response(
+            self._search, index, **self._search_kwargs(body, kwargs)
+        )
+
+    async def msearch(self, searches=None, index=None, body=None, **kwargs):
+        return await self._async_response(self._msearch, searches or body, index)
+
+    async def open_point_in_time(self, index, keep_alive=None, **kwargs):
+        return await self._async_response(self._open_point_in_time, index)
+
+    async def close_point_in_time(self, id=None, body=None, **kwargs):
+        return await self._async_response(self._close_point_in_time, id or body["id"])
+
+
+class _AsyncIndices(_Indices):
+    async def create(self, index, **kwargs):
+        return await self.client._async_response(self._create, index, **kwargs)
+
+    async def exists(self, index, **kwargs):
+        found = bool(self.client.store.resolve(index, missing_ok=True))
+        await asyncio.sleep(self.client._delay())
+        return HeadApiResponse(meta=_meta(200 if found else 404))
+
+    async def delete(self, index, **kwargs):
+        return await self.client._async_response(self._delete, index)
+
+    async def put_mapping(self, index, properties=None, meta=None, **kwargs):
+        return await self.client._async_response(
+            self._put_mapping, index, properties, meta
+        )
+
+    async def get_mapping(self, index=None, **kwargs):
+        return await self.client._async_response(self._get_mapping, index)
+
+    async def refresh(self, index=None, **kwargs):
+        return await self.client._async_response(
+            lambda: ({"_shards": {"total": 1, "successful": 1, "failed": 0}}, 200)
+        )
+
+    async def put_index_template(
+        self, name, index_patterns=None, template=None, **kwargs
+    ):
+        return await self.client._async_response(
+            self._put_index_template, name, index_patterns, template
+        )
+
+    async def delete_index_template(self, name, **kwargs):
+        return await self.client._async_response(self._delete_index_template, name)
+
+    async def get_alias(self, index=None, name=None, **kwargs):
+        return await self.client._async_response(self._get_alias, index, name)
@@ -1,18 +1,99 @@
-from app.es import async_client
+from datetime import datetime
+import hashlib
+import json
+
+from app.backends.es import ElasticsearchBackend
+from app.compact import compact_document
+from app.legifrance.parser import LEGIFRANCE_ID
+from app.metrics import Counter, Histogram
+from app.model import Decision, DecisionSummary
+from app.related import RelatedDecisions, document_terms
+
+
+INDEXED = Counter(
+    "cassapi_indexed_documents_total",
+    "Documents sent to the backend, by result (created, updated or error).",
+    ["result"],
+)
+INDEX_LATENCY = Histogram(
+    "cassapi_index_duration_seconds",
+    "Duration of the indexing requests, by operation (one or bulk).",
+    ["operation"],
+)
+
+
+def _count_results(results):
+    for result in results:
+        INDEXED.inc(result=result.get("result") if result["status"] < 400 else "error")
+    return results
+
+
+def normalise_reference(reference):
+    """Normalises a free text reference (ex: "Article 1131 du code civil.")
+    so that the same reference found in different documents gives the same
+    keyword."""
+    return " ".join(reference.split()).strip(" .,;").lower()
+
+
+# the fields of a document served by `/decision/{id}`
+DECISION_FIELDS = (
+    "title",
+    "identifier",
+    "numero",
+    "paragraphes",
+    "chambre",
+    "code_chambre",
+)
+
+
+def content_hash(document):
+    """Hash of the served content of a document, stored with it under
+    `content_hash` so that the api can tell if a client has it already."""
+    content = {field: document.get(field) for field in DECISION_FIELDS}
+    data = json.dumps(content, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
 
 
 class Indexer:
     """Utility class for indexing a document from legifrance under
-    a specific index.
+    a specific index, in Elastic Search unless another backend is given.
+    The paragraphes are indexed `compact` if asked, see `app.compact`.
     """
 
-    def __init__(self, index):
+    def __init__(self, index, backend=None, compact=False):
         self.index = index
+        self.backend = backend or ElasticsearchBackend(index)
+        self.compact = compact
+
+    async def setup(self):
+        """Creates the index in the backend if needed, see `Backend.setup`."""
+        await self.backend.setup()
 
     @staticmethod
-    def prepare_document(parser):
-        """Takes a parser instance and prepare the document for indexing."""
-        return {
+    def citation_targets(parser):
+        """Normalises the links of a document into a list of keyword targets.
+        A link to a legifrance document gives its identifiers, other links
+        give one normalised reference for each ';' separated part of their
+        text.
+        """
+        targets = []
+        for link in parser.citations:
+            ids = [link[name] for name in ("id", "cidtexte") if link.get(name)]
+            ids += LEGIFRANCE_ID.findall(link["texte"])
+            if ids:
+                targets += ids
+            else:
+                targets += [
+                    normalise_reference(ref) for ref in link["texte"].split(";")
+                ]
+        return list(dict.fromkeys(target for target in targets if target))
+
+    @staticmethod
+    def prepare_document(parser, compact=False):
+        """Takes a parser instance and prepare the document for indexing, its
+        paragraphes `compact` if asked. Raises a `pydantic.ValidationError`
+        if it doesn't give valid models."""
+        document = {
             "identifier": parser.identifier,
             "numero": parser.numero,
             "title": parser.title,
@@ -24,15 +105,75 @@ class Indexer:
             "arret": parser.num_arrêt,
             "pourvoi": parser.num_pourvoi,
             "liens": parser.liens,
+            "cites": Indexer.citation_targets(parser),
+            "terms": document_terms(parser.paragraphes),
         }
+        Indexer.validate_document(document)
+        # the hash of the nested paragraphes, the same in both layouts
+        document["content_hash"] = content_hash(document)
+        if compact:
+            compact_document(document)
+        return document
+
+    @staticmethod
+    def validate_document(document):
+        """Checks that the document gives valid models, the api builds them
+        without validation. Raises a `pydantic.ValidationError` otherwise."""
+        Decision.model_validate({field: document[field] for field in DECISION_FIELDS})
+        DecisionSummary.model_validate(document)
 
     async def index_doc(self, parser):
-        """Indexes a document using `parser.identifier` as id."""
-        document = Indexer.prepare_document(parser)
-        async with async_client() as client:
-            resp = await client.index(
-                index=self.index,
-                document=document,
-                id=parser.identifier,
-            )
-        return resp
+        """Indexes a document using `parser.identifier` as id. Returns the
+        result as a dict with the `result` ("created" or "updated") and
+        `status` keys."""
+        document = Indexer.prepare_document(parser, self.compact)
+        with INDEX_LATENCY.time(operation="one"):
+            result = await self.backend.put(parser.identifier, document)
+        return _count_results([result])[0]
+
+    async def bulk_index(self, parsers):
+        """Indexes several documents at once, returns a result by document."""
+        return await self.index_documents(
+            [Indexer.prepare_document(parser, self.compact) for parser in parsers]
+        )
+
+    async def index_documents(self, documents, bulk=None, version=None):
+        """Indexes documents given by `prepare_document`, in one bulk request
+        or through `bulk`, an `app.bulk.AdaptiveBulk` sending them in as
+        many as the backend sustains. Returns a result by document, see
+        `Backend.bulk_index` for the `version`."""
+        if bulk is not None:
+            return _count_results(await bulk.index(documents, version))
+        with INDEX_LATENCY.time(operation="bulk"):
+            results = await self.backend.bulk_index(documents, version)
+        return _count_results(results)
+
+    async def update_citation_counts(self):
+        """Stores on each cited decision the number of indexed decisions
+        citing it under `cited_by_count`. Meant to be run once the documents
+        are loaded, returns the counts by cited identifier.
+        """
+        return await self.backend.update_citation_counts()
+
+    async def update_related(self, size=10, batch_size=1000):
+        """Stores on each indexed decision the identifiers of its `size`
+        related decisions under `related`, see `app.related`. Meant to be
+        run once the documents are loaded, returns the count of decisions
+        updated."""
+        related = RelatedDecisions(size)
+        async for features in self.backend.walk_features(batch_size):
+            related.add(**features)
+        return await self.backend.update_related(related.compute())
+
+    @staticmethod
+    def next_generation():
+        """A new generation, for the data derived from the documents to be
+        prepared with it before `new_generation` sets it."""
+        return datetime.now().isoformat()
+
+    async def new_generation(self, generation=None):
+        """Marks the documents indexed as a new generation, `generation` if
+        given, to be run once a loading is done. Returns the generation."""
+        generation = generation or Indexer.next_generation()
+        await self.backend.set_generation(generation)
+        return generation
@@ -0,0 +1,179 @@
+"""Ledger of the archives shared by the loading workers.
+
+With `--ledger` several `initscript` processes, on one host or on hosts
+sharing the working directory, split the archives between them: each worker
+claims an archive from the ledger, a SQLite database on the shared
+filesystem, for a lease it renews while processing it, and records its
+report once done. The lease of a worker that crashed expires and the archive
+is claimed again by another one. An archive failing, or whose lease
+expired, `max_attempts` times is given up and reported as failed.
+
+The leases rely on the clocks of the hosts being synchronised, within a
+small part of their time to live.
+
+example:
+  >>> ledger = Ledger("work/ledger.db")
+  >>> ledger.add(["CASS_20240101-200918.tar.gz"])
+  >>> target = ledger.claim("host-1234", ttl=60)
+  >>> ledger.renew(target, "host-1234", ttl=60)
+  >>> ledger.complete(target, "host-1234", report)
+"""
+
+import json
+import sqlite3
+import time
+
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class Ledger:
+    """The archives to load and their state, in the SQLite database
+    `path`."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS tasks (
+            name TEXT PRIMARY KEY,
+            state TEXT NOT NULL DEFAULT 'pending',
+            owner TEXT,
+            expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            report TEXT,
+            error TEXT
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path, max_attempts=3, timeout=30.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        # isolation_level None: the transactions are opened explicitly, with
+        # BEGIN IMMEDIATE to take the write lock before reading the leases
+        self._connection = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        self._connection.executescript(self.SCHEMA)
+
+    def close(self):
+        self._connection.close()
+
+    def _write(self, sql, params=()):
+        return self._connection.execute(sql, params).rowcount
+
+    def add(self, names):
+        """Adds the archives not known yet, the loading of a ledger reused
+        being finished again once they are processed."""
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            added = self._connection.executemany(
+                "INSERT OR IGNORE INTO tasks (name) VALUES (?)",
+                [(name,) for name in names],
+            ).rowcount
+            if added:
+                self._write("DELETE FROM meta WHERE key = 'finished'")
+        finally:
+            self._connection.execute("COMMIT")
+
+    def claim(self, owner, ttl):
+        """Leases to `owner` for `ttl` seconds the oldest archive pending or
+        whose lease expired. Returns its name, None if there is none."""
+        now = time.time()
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            # the workers crashing on an archive spend its attempts as well
+            self._write(
+                "UPDATE tasks SET state = ?, owner = NULL, expires = NULL, "
+                "error = 'lease expired' "
+                "WHERE state = ? AND expires < ? AND attempts >= ?",
+                (FAILED, LEASED, now, self.max_attempts),
+            )
+            row = self._connection.execute(
+                "SELECT name FROM tasks WHERE state = ? "
+                "OR (state = ? AND expires < ? AND attempts < ?) "
+                "ORDER BY name LIMIT 1",
+                (PENDING, LEASED, now, self.max_attempts),
+            ).fetchone()
+            if row is None:
+                return None
+            self._write(
+                "UPDATE tasks SET state = ?, owner = ?, expires = ?, "
+                "attempts = attempts + 1 WHERE name = ?",
+                (LEASED, owner, now + ttl, row[0]),
+            )
+            return row[0]
+        finally:
+            self._connection.execute("COMMIT")
+
+    def renew(self, name, owner, ttl):
+        """Extends the lease of `owner` on `name`, returns False when it was
+        lost, claimed by another worker after it expired."""
+        return bool(
+            self._write(
+                "UPDATE tasks SET expires = ? "
+                "WHERE name = ? AND owner = ? AND state = ?",
+                (time.time() + ttl, name, owner, LEASED),
+            )
+        )
+
+    def complete(self, name, owner, report):
+        """Records the report of `name`, returns False when the lease of
+        `owner` was lost."""
+        return bool(
+            self._write(
+                "UPDATE tasks SET state = ?, report = ?, expires = NULL "
+                "WHERE name = ? AND owner = ? AND state = ?",
+                (DONE, json.dumps(report), name, owner, LEASED),
+            )
+        )
+
+    def release(self, name, owner, error):
+        """Gives back `name` after a failure, to be claimed again unless its
+        attempts are spent."""
+        return bool(
+            self._write(
+                "UPDATE tasks SET state = CASE WHEN attempts >= ? THEN ? ELSE ? "
+                "END, owner = NULL, expires = NULL, error = ? "
+                "WHERE name = ? AND owner = ? AND state = ?",
+                (self.max_attempts, FAILED, PENDING, error, name, owner, LEASED),
+            )
+        )
+
+    def remaining(self):
+        """The archives pending or being processed."""
+        return self._connection.execute(
+            "SELECT count(*) FROM tasks WHERE state IN (?, ?)", (PENDING, LEASED)
+        ).fetchone()[0]
+
+    def finish(self, owner):
+        """Returns True to the one worker that ends the loading, once all the
+        archives are processed."""
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            if self.remaining():
+                return False
+            return bool(
+                self._write(
+                    "INSERT OR IGNORE INTO meta (key, value) VALUES ('finished', ?)",
+                    (owner,),
+                )
+            )
+        finally:
+            self._connection.execute("COMMIT")
+
+    def reports(self):
+        """The reports of the archives done by name, the failed ones with
+        their error."""
+        rows = self._connection.execute(
+            "SELECT name, state, report, error FROM tasks ORDER BY name"
+        )
+        return {
+            name: json.loads(report) if state == DONE else {"error": error}
+            for name, state, report, error in rows
+            if state in (DONE, FAILED)
+        }
@@ -3,49 +3,126 @@
 Allows you to browse a file tree and validate documents into if executed
 directly by providing the path to the directory.
 
+The validation parses the files on all the cores, each one being parsed and
+prepared for indexing as the loading does, and aggregates the results: the
+counts, the errors by class with sample paths and the percentiles of the
+parse time. The report is printed as JSON or written to `--report`, the
+failing files can be listed in `--failed` to be checked again.
+
 example:
-  $ python app/legifrance/files.py app/tests/test_data/full_tree
+  $ python -m app.legifrance.files app/tests/test_data/full_tree
+  $ python -m app.legifrance.files /data/extract --report report.json \\
+    --failed failed.txt
+  $ python -m app.legifrance.files $(cat failed.txt)
 """
 
+import concurrent.futures
 import os
+import time
 
 
 def get_files(path):
     """Return generator on xml files under a path."""
-    for p, _, files in os.walk(path):
-        if files:
-            for f in files:
-                if f.endswith(".xml"):
-                    yield os.path.join(p, f)
+    directories = [path]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    directories.append(entry.path)
+                elif entry.name.endswith(".xml"):
+                    yield entry.path
+
+
+def validate_file(fpath):
+    """Parse and prepare the document of `fpath`. Returns the parse time in
+    seconds, and the error class and message if it failed."""
+    from app.indexer import Indexer
+    from app.legifrance.parser import Parser
+
+    start = time.perf_counter()
+    try:
+        parser = Parser.from_file(fpath)
+        elapsed = time.perf_counter() - start
+        Indexer.prepare_document(parser)
+    except Exception as e:
+        exc = e.__class__
+        return time.perf_counter() - start, f"{exc.__module__}.{exc.__name__}", str(e)
+    return elapsed, None, None
+
+
+def validate(paths, workers=None, samples=5, chunksize=64):
+    """Validates the xml files under `paths`, directories or files, on
+    `workers` processes, all the cores by default. Returns the report and
+    the failing files."""
+    from app.benchmarks import percentile
+
+    files = [
+        fpath
+        for path in paths
+        for fpath in (get_files(path) if os.path.isdir(path) else [path])
+    ]
+    times = []
+    errors = {}
+    failed = []
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = pool.map(validate_file, files, chunksize=chunksize)
+        for fpath, (elapsed, error, message) in zip(files, results):
+            times.append(elapsed)
+            if error is None:
+                continue
+            failed.append(fpath)
+            entry = errors.setdefault(error, {"count": 0, "samples": []})
+            entry["count"] += 1
+            if len(entry["samples"]) < samples:
+                entry["samples"].append({"path": fpath, "message": message[:500]})
+    duration = time.perf_counter() - start
+    report = {
+        "processed": len(files),
+        "valid": len(files) - len(failed),
+        "invalid": len(failed),
+        "duration_s": round(duration, 3),
+        "files_per_sec": round(len(files) / duration, 1) if duration else None,
+        "parse_ms": {
+            f"p{point}": round(percentile(times, point) * 1000, 3) if times else None
+            for point in (50, 95, 99, 100)
+        },
+        "errors": dict(
+            sorted(errors.items(), key=lambda item: item[1]["count"], reverse=True)
+        ),
+    }
+    return report, failed
 
 
 if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import json
     import sys
-    from parser import Parser, InvalidDocument
-
-    path = sys.argv[1]
-    valid = 0
-    invalid = 0
-    processed = 0
-    for fpath in get_files(path):
-        print(fpath)
-
-        processed += 1
-        try:
-            p = Parser.from_file(fpath)
-            print(p.date.strftime("%c"), p.identifier, p.numero)
-            print(p.title)
-            print(p.chambre)
-            print("\n".join(p.liens))
-            print(f"{' '.join(p.texte[:9])}...")
-        except Exception as e:
-            exc = e.__class__
-            print(
-                f"⚠ ERROR: {fpath}: {exc.__module__} {exc.__name__} {e}",
-                file=sys.stderr,
-            )
-            invalid += 1
-        else:
-            valid += 1
-        print()
-    print(f"{processed} processed files, {valid} OK, {invalid} with error.")
+
+    parser = ArgumentParser(description="Validate the legifrance xml files")
+    parser.add_argument("paths", nargs="+", help="the directories or files to validate")
+    parser.add_argument(
+        "--workers", type=int, help="the processes parsing, one by core by default"
+    )
+    parser.add_argument(
+        "--samples", type=int, default=5, help="sample paths kept by error class"
+    )
+    parser.add_argument("--report", help="where to write the JSON report")
+    parser.add_argument("--failed", help="where to list the failing files")
+
+    args = parser.parse_args()
+    report, failed = validate(args.paths, args.workers, args.samples)
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.failed:
+        with open(args.failed, "w") as f:
+            f.writelines(f"{fpath}\n" for fpath in failed)
+    print(
+        f"{report['processed']} processed files, {report['valid']} OK, "
+        f"{report['invalid']} with error.",
+        file=sys.stderr,
+    )
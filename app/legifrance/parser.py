@@ -16,6 +16,12 @@ from xml.dom import minidom
 from xml.dom import Node
 
 
+# identifiers of legifrance documents (decisions, codes, articles...)
+LEGIFRANCE_ID = re.compile(r"\b[A-Z]{4}(?:TEXT|ARTI|SCTA)\d{12}\b")
+# identifiers of court decisions, the documents we index
+DECISION_ID = re.compile(r"^[A-Z]{4}TEXT\d{12}$")
+
+
 def clean(dom):
     """Unprettify xml dom in order to process it"""
     return minidom.parseString("".join(dom.toxml().strip("\n").split("\n")))
@@ -198,6 +204,22 @@ class Parser:
             else:
                 return []
 
+    @property
+    def citations(self):
+        """Returns the "LIEN" tags as a list of dict holding their non empty
+        attributes (`id`, `cidtexte`, `typelien`...) and their content under
+        the "texte" key."""
+        res = []
+        for node in self.dom.getElementsByTagName("LIEN"):
+            link = {name: value for name, value in node.attributes.items() if value}
+            link["texte"] = "".join(
+                child.nodeValue
+                for child in node.childNodes
+                if child.nodeType == Node.TEXT_NODE
+            ).strip()
+            res.append(link)
+        return res
+
     @property
     def sommaire(self):
         """Returns content of the so called "SOMMAIRE" tag as dict."""
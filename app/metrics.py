@@ -0,0 +1,192 @@
+"""Metrics of the application exposed in the Prometheus text format.
+
+Counters, gauges and histograms are declared at module level where they are
+recorded, they register themselves in `REGISTRY` which `exposition` turns
+into the text served by the `/metrics` endpoint or written by the loading
+script. Recording only takes a lock and a few additions so that it can stay
+on under load. Each process has its own registry: with several workers each
+one reports its own values.
+
+example:
+  >>> REQUESTS = Counter("requests_total", "Requests served.", ["route"])
+  >>> REQUESTS.inc(route="/summary")
+  >>> LATENCY = Histogram("latency_seconds", "Latency.", ["route"])
+  >>> with LATENCY.time(route="/summary"):
+  ...     ...
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+
+# from 1ms to 10s, as the default buckets of the Prometheus clients
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Registry:
+    """The metrics collected by the exposition."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+
+    def exposition(self):
+        """The metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if labels.keys() != set(self.labels):
+            raise ValueError(f"{self.name} expects the labels {self.labels}")
+        return tuple(labels[name] for name in self.labels)
+
+    def _pairs(self, key):
+        return list(zip(self.labels, key))
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{_labels(self._pairs(key))} {_number(value)}"
+            for key, value in values
+        ]
+
+
+class Gauge(Metric):
+    """A value that goes up and down."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    samples = Counter.samples
+
+
+class Histogram(Metric):
+    """Counts of observed values by bucket, with their count and sum."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, help, labels, **kwargs)
+        self.buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count by bucket then the sum of the values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the block, even when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        counts = self._values.get(self._key(labels))
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        lines = []
+        for key, counts in values:
+            pairs = self._pairs(key)
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                labels = _labels(pairs + [("le", _number(bound))])
+                lines.append(f"{self.name}_bucket{labels} {total}")
+            lines.append(f"{self.name}_sum{_labels(pairs)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(pairs)} {total}")
+        return lines
+
+
+def exposition():
+    """The metrics of the default registry in the Prometheus text format."""
+    return REGISTRY.exposition()
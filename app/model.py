@@ -1,6 +1,13 @@
-"""The Domain model."""
+"""The Domain model.
 
-from pydantic import BaseModel
+The documents are validated against the models once, when indexed. The
+service builds the decisions from the backend with `model_construct`, which
+skips the validation of their paragraphes.
+"""
+
+from datetime import date
+
+from pydantic import BaseModel, Field
 
 
 class Decision(BaseModel):
@@ -12,7 +19,46 @@ class Decision(BaseModel):
     code_chambre: str
 
 
+class CompactParagraphesModel(BaseModel):
+    """The paragraphes as one text, see `app.compact`."""
+
+    text: str
+    lines: list[int]
+    paragraphs: list[int]
+
+
+class CompactDecision(BaseModel):
+    title: str
+    identifier: str
+    numero: str
+    paragraphes: CompactParagraphesModel
+    chambre: str
+    code_chambre: str
+
+
 class DecisionSummary(BaseModel):
     title: str
     identifier: str
     code_chambre: str
+
+
+class Citations(BaseModel):
+    identifier: str
+    cites: list[str]
+    cited_by_count: int
+
+
+class Related(BaseModel):
+    identifier: str
+    related: list[str]
+
+
+class SearchQuery(BaseModel):
+    query: str
+    since: date | None = None
+    until: date | None = None
+    size: int | None = Field(None, ge=1, le=100)
+
+
+class BatchSearch(BaseModel):
+    queries: list[SearchQuery]
@@ -0,0 +1,75 @@
+"""Statistical profiler sampling the stack of a running thread.
+
+A background thread takes the stack of the profiled thread (the event loop
+one for the api) at a regular interval and counts how many times each stack
+is seen. The result is given in the collapsed stacks format, one line by
+stack with its frames from the root separated by ";" then its count, which
+`flamegraph.pl` or speedscope turn into a flame graph.
+"""
+
+from collections import Counter
+import sys
+import threading
+import time
+
+
+# the shortest interval between two samples, in seconds
+MIN_INTERVAL = 0.001
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = None
+        self.started = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, interval=0.005, thread_id=None):
+        """Samples the thread `thread_id`, the calling one by default, every
+        `interval` seconds. Previous samples are dropped."""
+        if self.running:
+            raise RuntimeError("the profiler is already running")
+        if interval < MIN_INTERVAL:
+            # a shorter wait spins, holding the GIL from the sampled thread
+            raise ValueError(f"the interval must be at least {MIN_INTERVAL}s")
+        self.stacks = Counter()
+        self.samples = 0
+        self.interval = interval
+        self.started = time.time()
+        self._stop.clear()
+        target = thread_id or threading.get_ident()
+        self._thread = threading.Thread(
+            target=self._sample, args=(target,), name="profiler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops the sampling, the samples taken are kept."""
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _sample(self, target):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(target)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self):
+        """The samples in the collapsed stacks format."""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
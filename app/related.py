@@ -0,0 +1,131 @@
+"""Related decisions, computed once a loading is done.
+
+Each decision is given the `size` decisions closest to it, stored as a list
+of identifiers under `related` and served by `/decision/{id}/related`
+without any search. Two decisions are close when they share:
+- links, the targets of their `cites` (the articles and decisions they
+  refer to), a decision cited by another sharing a link with it too,
+- terms, the most frequent words of their paragraphes kept at the indexing
+  under `terms` (`document_terms`), a term vector of sorts.
+
+Each shared link or term adds its inverse document frequency, weighted by
+`LINK_WEIGHT` or `TERM_WEIGHT`, so that the rarest count most, and the
+score of the decisions of the same chambre is raised by `CHAMBRE_BOOST`.
+The links and terms shared by more than `max_df` of the decisions, or by
+more than `max_postings` of them, tell nothing and are left out, which also
+bounds the work by decision.
+
+The features of all the decisions are held in memory by `RelatedDecisions`
+as numbers, about a kilobyte by decision with the default `TERMS`.
+
+example:
+  >>> related = RelatedDecisions(size=5)
+  >>> for document in documents:
+  ...     related.add(**document)
+  >>> dict(related.compute())
+"""
+
+from collections import Counter, defaultdict
+import heapq
+import math
+import re
+
+
+# the terms kept by document at the indexing
+TERMS = 64
+LINK_WEIGHT = 2.0
+TERM_WEIGHT = 1.0
+CHAMBRE_BOOST = 0.2
+
+WORD = re.compile(r"[^\W\d_]{4,}")
+
+
+def document_terms(paragraphes, size=TERMS):
+    """The `size` most frequent words of 4 letters and more of the
+    paragraphes, lowercased."""
+    counts = Counter(
+        word.lower()
+        for paragraph in paragraphes
+        for line in paragraph
+        for word in WORD.findall(line)
+    )
+    return [term for term, _ in counts.most_common(size)]
+
+
+class RelatedDecisions:
+    """Computes the `size` related decisions of each decision added."""
+
+    def __init__(self, size=10, max_df=0.1, max_postings=2000):
+        self.size = size
+        self.max_df = max_df
+        self.max_postings = max_postings
+        self.identifiers = []
+        self.chambres = []
+        # features by decision, a feature being a link or a term as a number
+        self.features = []
+        self._features = {}
+        self._chambres = {}
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def _feature(self, key):
+        return self._features.setdefault(key, len(self._features))
+
+    def add(self, identifier, code_chambre=None, cites=(), terms=(), **kwargs):
+        """Adds a decision with its links `cites` and its `terms`."""
+        links = {("link", target) for target in cites or ()}
+        # shared with the decisions citing it
+        links.add(("link", identifier))
+        self.identifiers.append(identifier)
+        self.chambres.append(
+            self._chambres.setdefault(code_chambre, len(self._chambres))
+        )
+        self.features.append(
+            tuple(
+                self._feature(key)
+                for key in links | {("term", term) for term in terms or ()}
+            )
+        )
+
+    def _weights(self, postings):
+        """The weight of each feature worth comparing on, by feature."""
+        limit = min(self.max_postings, max(2, self.max_df * len(self)))
+        weights = {}
+        kinds = {number: key[0] for key, number in self._features.items()}
+        for feature, decisions in postings.items():
+            if 1 < len(decisions) <= limit:
+                weight = LINK_WEIGHT if kinds[feature] == "link" else TERM_WEIGHT
+                weights[feature] = weight * math.log(len(self) / len(decisions))
+        return weights
+
+    def compute(self):
+        """Yields each decision added with the identifiers of its related
+        decisions, the closest first."""
+        postings = defaultdict(list)
+        for position, features in enumerate(self.features):
+            for feature in features:
+                postings[feature].append(position)
+        weights = self._weights(postings)
+        for position, features in enumerate(self.features):
+            scores = defaultdict(float)
+            for feature in features:
+                weight = weights.get(feature)
+                if weight is None:
+                    continue
+                for other in postings[feature]:
+                    scores[other] += weight
+            scores.pop(position, None)
+            chambre = self.chambres[position]
+            closest = heapq.nsmallest(
+                self.size,
+                scores.items(),
+                key=lambda item: (
+                    -item[1]
+                    * (1 + CHAMBRE_BOOST * (self.chambres[item[0]] == chambre)),
+                    self.identifiers[item[0]],
+                ),
+            )
+            yield self.identifiers[position], [
+                self.identifiers[other] for other, _ in closest
+            ]
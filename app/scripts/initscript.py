@@ -1,8 +1,22 @@
 """This script takes an url to a data source fetch all tar file and indexes
-the documents under the index provided in Elastic Search.
+the documents under the index provided in Elastic Search, or in another
+backend chosen with the `--backend` option.
 Files are first extracted in a directory into the the given working_dir, then
 resulting folders are processed in chronological order.
-Each document is then indexed in ES.
+The documents are then indexed in ES by bulk requests whose size and
+concurrency adapt to the latency and the rejections of the cluster, the
+rejected documents being sent again after a backoff (see `app.bulk`).
+Once all are loaded each cited decision is given the count of decisions citing it, each decision its
+`--related` decisions (see `app.related`) and the documents are marked as a
+new generation, for the api workers to reload their summaries.
+With `--ledger` several workers, processes of this host (`--workers`) or of
+hosts sharing the working dir, split the archives through a lease ledger
+(see `app.ledger`): each one fetches, extracts and indexes the archives it
+claims, the documents of an archive only replacing those of older archives
+so that the order of the archives holds. Once all are done one of the
+workers merges the reports and runs the final steps.
+With `--summary-snapshot` the summaries are also written to a snapshot file
+the api workers map in memory instead of loading them from the backend.
 
 Usage (from project root, increase size limit if you got errors about that):
   $ ulimit -n 2048
@@ -15,17 +29,89 @@ the extracted tree removing. Answer 'y' if you want to.
 
 import asyncio
 import concurrent.futures
+import multiprocessing
 import os
 import re
 import shutil
+import socket
+import sys
 import tarfile
 
 import aiohttp
+from pydantic import ValidationError
 
-from app.es import get_client
+from app.backends import BACKENDS, get_backend
+from app.bulk import AdaptiveBulk
 from app.legifrance.parser import Parser
 from app.legifrance.files import get_files
 from app.indexer import Indexer
+from app.ledger import Ledger
+from app.metrics import Counter, Histogram, exposition
+from app.services.summaries import SummaryStore
+
+
+DOWNLOADED = Counter(
+    "cassapi_downloaded_bytes_total", "Bytes of the archives downloaded."
+)
+DOWNLOAD_LATENCY = Histogram(
+    "cassapi_download_duration_seconds",
+    "Duration of the download of an archive.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+EXTRACT_LATENCY = Histogram(
+    "cassapi_extract_duration_seconds",
+    "Duration of the extraction of an archive.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+PARSED = Counter(
+    "cassapi_parsed_documents_total",
+    "Documents parsed, by result (ok, invalid or error).",
+    ["result"],
+)
+PARSE_LATENCY = Histogram(
+    "cassapi_parse_duration_seconds", "Duration of the parsing of a document."
+)
+ARCHIVE_DATE = re.compile(r"(\d{8})-(\d{6})")
+
+
+def archive_version(target):
+    """The version of the documents of an archive, from the date and time in
+    its name, so that the documents of the later archives win."""
+    match = ARCHIVE_DATE.search(target)
+    return int(match.group(1) + match.group(2)) if match else None
+
+
+def summarize(results):
+    """Counts the results of the files of a directory."""
+    summary = dict.fromkeys(
+        ("processed", "created", "updated", "outdated", "error", "parsing_error"), 0
+    )
+    for result in results:
+        if result:
+            summary["processed"] += 1
+            if result["status"] == 201:
+                summary["created"] += 1
+            elif result.get("result") == "noop":
+                summary["outdated"] += 1
+            elif result["status"] == 200:
+                summary["updated"] += 1
+            elif result["status"] >= 400:
+                summary["error"] += 1
+        else:
+            summary["parsing_error"] += 1
+    return summary
+
+
+def run_worker(args, path, owner):
+    """Runs a worker process of the loading with `--ledger`."""
+    backend = get_backend(args.backend, args.index, args.sqlite_path)
+    bulk = AdaptiveBulk(backend, args.batch_size, args.concurrency)
+    loader = Loader(args.source_url, path, args.index, backend, bulk, args.compact)
+    ledger = Ledger(args.ledger)
+    asyncio.run(loader.work(ledger, owner, args.lease_ttl))
+    if args.metrics_file:
+        with open(f"{args.metrics_file}.{owner}", "w") as f:
+            f.write(exposition())
 
 
 class Loader:
@@ -33,10 +119,22 @@ class Loader:
     Elastic Search.
     """
 
-    def __init__(self, legifrance_url, working_dir, index):
+    def __init__(
+        self,
+        legifrance_url,
+        working_dir,
+        index,
+        backend=None,
+        bulk=None,
+        compact=False,
+    ):
         self.url = legifrance_url
         self.working_dir = working_dir
         self.index = index
+        self.backend = backend
+        self.bulk = bulk or AdaptiveBulk(backend)
+        # index the paragraphes compact, see `app.compact`
+        self.compact = compact
 
     @staticmethod
     def _write_file(fd, chunk):
@@ -45,8 +143,9 @@ class Loader:
     def extract(self, target):
         """Extract the tar under target."""
         path = os.path.join(self.working_dir, target)
-        with tarfile.open(path, mode="r:gz") as f:
-            f.extractall(path=self.working_dir)
+        with EXTRACT_LATENCY.time():
+            with tarfile.open(path, mode="r:gz") as f:
+                f.extractall(path=self.working_dir)
         os.remove(path)
 
     async def list_targets(self):
@@ -56,55 +155,160 @@ class Loader:
                 text = await resp.text()
         return re.findall(r'<a href="(CASS_\d{8}-\d{6}\.tar\.gz)">', text)
 
+    async def download(self, target):
+        """Fetch a tar file from source into the working dir."""
+        loop = asyncio.get_running_loop()
+        with DOWNLOAD_LATENCY.time():
+            async with aiohttp.ClientSession(raise_for_status=True) as session:
+                async with session.get(f"{self.url}/{target}") as resp:
+                    size = 0
+                    with open(os.path.join(self.working_dir, target), "wb") as fd:
+                        async for chunk in resp.content.iter_chunked(100):
+                            await loop.run_in_executor(
+                                None, Loader._write_file, fd, chunk
+                            )
+                            size += len(chunk)
+        DOWNLOADED.inc(size)
+
     async def process_target(self, target):
-        """Fetch a tar file from source."""
+        """Fetch a tar file from source and extract it."""
         print("fetch", target)
-        loop = asyncio.get_running_loop()
-        async with aiohttp.ClientSession(raise_for_status=True) as session:
-            async with session.get(f"{self.url}/{target}") as resp:
-                with open(os.path.join(self.working_dir, target), "wb") as fd:
-                    async for chunk in resp.content.iter_chunked(100):
-                        await loop.run_in_executor(None, Loader._write_file, fd, chunk)
+        await self.download(target)
         print("extract", target)
+        loop = asyncio.get_running_loop()
         await loop.run_in_executor(None, self.extract, target)
         print(target, "done")
 
     async def process_targets(self, targets):
         """Fetch all available files from source."""
-        await asyncio.gather(*(loader.process_target(target) for target in targets))
+        await asyncio.gather(*(self.process_target(target) for target in targets))
 
-    async def index_file(self, indexer, fpath):
-        """Parse xml under `path` found, and indexes it in ES."""
+    @staticmethod
+    def _parse(fpath):
+        with PARSE_LATENCY.time():
+            return Parser.from_file(fpath)
+
+    @staticmethod
+    def prepare_file(fpath, compact=False):
+        """Parse xml under `fpath` into the document to index, its paragraphes
+        `compact` if asked, None when it fails."""
+        try:
+            parser = Loader._parse(fpath)
+        except Exception as e:
+            PARSED.inc(result="error")
+            exc = e.__class__
+            print(
+                f"⚠ ERROR: {fpath}: {exc.__module__} {exc.__name__} {e}",
+                file=sys.stderr,
+            )
+            return None
+        try:
+            document = Indexer.prepare_document(parser, compact)
+        except ValidationError as e:
+            PARSED.inc(result="invalid")
+            print(f"⚠ INVALID: {fpath}: {e}", file=sys.stderr)
+            return None
+        PARSED.inc(result="ok")
+        return document
+
+    async def index_directory(self, indexer, pool, directory, version=None):
+        """Parse the xml files of `directory` and indexes them, returns a
+        result by file, None for those that couldn't be parsed. See
+        `Backend.bulk_index` for the `version`."""
         loop = asyncio.get_running_loop()
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            try:
-                parser = await loop.run_in_executor(pool, Parser.from_file, fpath)
-            except Exception as e:
-                exc = e.__class__
-                print(
-                    f"⚠ ERROR: {fpath}: {exc.__module__} {exc.__name__} {e}",
-                    file=sys.stderr,
-                )
-            else:
-                return await indexer.index_doc(parser)
+        documents = await asyncio.gather(
+            *(
+                loop.run_in_executor(pool, Loader.prepare_file, f, self.compact)
+                for f in get_files(directory)
+            )
+        )
+        results = await indexer.index_documents(
+            [document for document in documents if document is not None],
+            self.bulk,
+            version,
+        )
+        results = iter(results)
+        return [None if document is None else next(results) for document in documents]
 
     def bulk_index(self):
         """Walks into the directory, parse each xml found, and indexes it."""
         loop = asyncio.get_event_loop()
-        indexer = Indexer(self.index)
+        indexer = Indexer(self.index, self.backend)
         results = {}
-        for d in sorted(os.listdir(self.working_dir)):
-            print("process", d)
-            results[d] = loop.run_until_complete(
-                asyncio.gather(
-                    *(
-                        self.index_file(indexer, f)
-                        for f in get_files(os.path.join(self.working_dir, d))
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            for d in sorted(os.listdir(self.working_dir)):
+                print("process", d)
+                results[d] = loop.run_until_complete(
+                    self.index_directory(
+                        indexer, pool, os.path.join(self.working_dir, d)
                     )
                 )
-            )
         return results
 
+    def extract_archive(self, target):
+        """Extract the tar of `target` under its own directory, named after
+        it, returns the directory."""
+        directory = os.path.join(self.working_dir, target.split(".")[0])
+        path = os.path.join(self.working_dir, target)
+        with EXTRACT_LATENCY.time():
+            with tarfile.open(path, mode="r:gz") as f:
+                f.extractall(path=directory)
+        os.remove(path)
+        return directory
+
+    async def process_archive(self, indexer, target):
+        """Fetch, extract and index the archive `target`, its documents only
+        replacing those of older archives. Returns its report by
+        directory."""
+        loop = asyncio.get_running_loop()
+        print("fetch", target)
+        await self.download(target)
+        directory = await loop.run_in_executor(None, self.extract_archive, target)
+        version = archive_version(target)
+        report = {}
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            for d in sorted(os.listdir(directory)):
+                print("process", target, d)
+                results = await self.index_directory(
+                    indexer, pool, os.path.join(directory, d), version
+                )
+                report[d] = summarize(results)
+        print(target, "done")
+        return report
+
+    async def _heartbeat(self, ledger, target, owner, ttl):
+        while True:
+            await asyncio.sleep(ttl / 3)
+            if not ledger.renew(target, owner, ttl):
+                print(f"⚠ LEASE LOST: {target}", file=sys.stderr)
+                return
+
+    async def work(self, ledger, owner, ttl=60.0):
+        """Processes the archives claimed in `ledger` as `owner` until all
+        are done, see `app.ledger`."""
+        indexer = Indexer(self.index, self.backend)
+        while True:
+            target = ledger.claim(owner, ttl)
+            if target is None:
+                if not ledger.remaining():
+                    return
+                # the archives left are leased by other workers, to be
+                # claimed again if their leases expire
+                await asyncio.sleep(ttl / 3)
+                continue
+            heartbeat = asyncio.create_task(self._heartbeat(ledger, target, owner, ttl))
+            try:
+                report = await self.process_archive(indexer, target)
+            except Exception as e:
+                exc = e.__class__
+                error = f"{exc.__module__} {exc.__name__} {e}"
+                print(f"⚠ ERROR: {target}: {error}", file=sys.stderr)
+                ledger.release(target, owner, error)
+            else:
+                ledger.complete(target, owner, report)
+            finally:
+                heartbeat.cancel()
+
     def clean(self):
         shutil.rmtree(self.working_dir)
 
@@ -138,38 +342,137 @@ if __name__ == "__main__":
         type=str,
         help="the index under which documents will be indexed",
     )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="elasticsearch",
+        help="the backend where documents are indexed",
+    )
+    parser.add_argument(
+        "--sqlite-path",
+        help="the SQLite database file used by the sqlite backend",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=500,
+        help="the documents of the first bulk requests, adapted then to the "
+        "latency and the rejections of the backend",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=2,
+        help="the bulk requests in flight at first, adapted as the batch size",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="index the paragraphes as one text with the offsets of their "
+        "lines, see app.compact",
+    )
+    parser.add_argument(
+        "--related",
+        type=int,
+        default=10,
+        help="the related decisions computed for each decision once loaded, "
+        "none with 0, see app.related",
+    )
+    parser.add_argument(
+        "--ledger",
+        help="the SQLite ledger through which several workers, on this host "
+        "or on hosts sharing the working dir, split the archives",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="the worker processes to run on this host with --ledger",
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=float,
+        default=60.0,
+        help="the seconds after which the archive of a worker that stopped "
+        "renewing its lease is claimed by another",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="where to write the metrics of the loading at the end, in the "
+        "Prometheus text format",
+    )
+    parser.add_argument(
+        "--summary-snapshot",
+        help="where to write the snapshot of the summaries for the api workers",
+    )
 
     args = parser.parse_args()
     path = f'work-{date.today().strftime("%y%m%d")}'
-    os.mkdir(os.path.join(args.wdir, path))
+    # the workers sharing a ledger share the working dir
+    os.makedirs(os.path.join(args.wdir, path), exist_ok=bool(args.ledger))
     loop = asyncio.get_event_loop()
 
-    loader = Loader(args.source_url, path, args.index)
+    backend = get_backend(args.backend, args.index, args.sqlite_path)
+    bulk = AdaptiveBulk(backend, args.batch_size, args.concurrency)
+    loader = Loader(args.source_url, path, args.index, backend, bulk, args.compact)
+    indexer = Indexer(args.index, backend)
+    loop.run_until_complete(indexer.setup())
     targets = loop.run_until_complete(loader.list_targets())
-    loop.run_until_complete(loader.process_targets(targets))
-    results = loader.bulk_index()
-    for k, v in results.items():
-        processed = 0
-        created = 0
-        updated = 0
-        error = 0
-        parsing_error = 0
-        for result in v:
-            if result:
-                processed += 1
-                if result.meta.status == 201:
-                    created += 1
-                elif result.meta.status == 200:
-                    updated += 1
-                elif result.meta.status >= 400:
-                    error += 1
-            else:
-                parsing_error += 1
+    if args.ledger:
+        ledger = Ledger(args.ledger)
+        ledger.add(targets)
+        owner = f"{socket.gethostname()}-{os.getpid()}"
+        if args.workers > 1:
+            workers = [
+                multiprocessing.Process(
+                    target=run_worker, args=(args, path, f"{owner}-{number}")
+                )
+                for number in range(args.workers)
+            ]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        else:
+            loop.run_until_complete(loader.work(ledger, owner, args.lease_ttl))
+        if not ledger.finish(owner):
+            print("the loading is ended by another worker")
+            sys.exit(0)
+        summaries = {}
+        for target, report in ledger.reports().items():
+            if "error" in report:
+                print(f"⚠ FAILED: {target}: {report['error']}", file=sys.stderr)
+            for d, summary in report.items():
+                if d != "error":
+                    summaries[f"{target} {d}"] = summary
+    else:
+        loop.run_until_complete(loader.process_targets(targets))
+        summaries = {d: summarize(v) for d, v in loader.bulk_index().items()}
+    for k, summary in summaries.items():
         print(
-            f"{k:3} {processed:3} processed, {created:3} created, "
-            f"{updated:3} updated, {error:3} on error and "
-            f"{parsing_error:3} errors on parsing"
+            f"{k:3} {summary['processed']:3} processed, {summary['created']:3} "
+            f"created, {summary['updated']:3} updated, {summary['outdated']:3} "
+            f"outdated, {summary['error']:3} on error and "
+            f"{summary['parsing_error']:3} errors on parsing"
+        )
+    counts = loop.run_until_complete(indexer.update_citation_counts())
+    print(f"{len(counts)} cited decisions")
+    if args.related:
+        related = loop.run_until_complete(indexer.update_related(args.related))
+        print(f"{related} decisions given their related decisions")
+    # the snapshot is written before the workers see the new generation
+    generation = Indexer.next_generation()
+    if args.summary_snapshot:
+        store = loop.run_until_complete(
+            SummaryStore.load(backend, generation=generation)
         )
+        store.write(args.summary_snapshot)
+        print(f"{len(store)} summaries written to {args.summary_snapshot}")
+    loop.run_until_complete(indexer.new_generation(generation))
+    print("generation", generation)
+    if args.metrics_file:
+        with open(args.metrics_file, "w") as f:
+            f.write(exposition())
     r = input("clean? ")
     if r == "y":
         loader.clean()
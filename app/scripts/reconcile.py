@@ -0,0 +1,393 @@
+"""This script reconciles an index with the extracted xml files the loading
+read, for the documents lost or left behind by a loading that failed midway
+or by archives removed since.
+
+The identifiers of the files under the given directories, named after them,
+are sorted on disk by runs of `--run-size` merged afterwards, the one of the
+latest archive kept when a decision is in several. The identifiers indexed
+are read from the backend sorted the same way, `batch_size` at a time with
+their content hash only (a point in time and `search_after` in Elastic
+Search, `_source` off). Both are walked side by side so that the memory
+used doesn't grow with the count of documents:
+- the documents indexed without a file are orphans, only counted unless
+  `--delete-orphans` is given: their identifiers are then written to a
+  temporary file and, once the walk is done and their count printed,
+  deleted by bulk requests,
+- the files without a document are parsed and indexed,
+- the documents indexed several times, copies left in the index of their
+  former year by the yearly indices when their date changed, are indexed
+  again, which deletes the copies,
+- with `--verify` the files of the documents indexed are parsed too, and
+  indexed again when their content hash differs from the one stored.
+
+Once done each cited decision is given its count of citing decisions again,
+each decision its related decisions and the documents are marked as a new
+generation, when anything changed.
+
+Usage (from project root):
+  $ PYTHONPATH=. python app/scripts/reconcile.py work-240101 'test-xxx'
+  $ PYTHONPATH=. python app/scripts/reconcile.py work-240101 'test-xxx' \\
+    --dry-run --verify
+  $ PYTHONPATH=. python app/scripts/reconcile.py work-240101 'test-xxx' \\
+    --delete-orphans
+"""
+
+import asyncio
+import concurrent.futures
+import heapq
+import itertools
+import os
+import sys
+import tempfile
+
+from app.bulk import AdaptiveBulk
+from app.indexer import Indexer
+from app.legifrance.files import get_files
+from app.legifrance.parser import DECISION_ID
+from app.scripts.initscript import Loader, archive_version
+
+
+def _entry(line):
+    identifier, version, path = line.rstrip("\n").split("\t", 2)
+    return identifier, int(version) if version else -1, path
+
+
+def _sorted_runs(entries, run_size, directory):
+    """Writes `entries` sorted by runs of `run_size` in files of `directory`.
+    Returns the files."""
+    runs = []
+    entries = iter(entries)
+    while True:
+        run = sorted(itertools.islice(entries, run_size))
+        if not run:
+            return runs
+        fd, path = tempfile.mkstemp(suffix=".tsv", dir=directory)
+        with os.fdopen(fd, "w") as f:
+            f.writelines(
+                f"{identifier}\t{'' if version < 0 else version}\t{path}\n"
+                for identifier, version, path in run
+            )
+        runs.append(path)
+
+
+def source_entries(directories):
+    """The (identifier, version, path) of the xml files of decisions under
+    `directories`, the version -1 outside an archive."""
+    for directory in directories:
+        for path in get_files(directory):
+            identifier = os.path.basename(path)[: -len(".xml")]
+            if DECISION_ID.match(identifier):
+                version = archive_version(path)
+                yield identifier, -1 if version is None else version, path
+
+
+def sorted_entries(entries, run_size=100000, directory=None):
+    """Yields `entries` sorted by identifier, only the latest version of
+    each one, holding `run_size` of them in memory at most."""
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        files = [open(path) for path in _sorted_runs(entries, run_size, tmp)]
+        try:
+            merged = heapq.merge(*(map(_entry, f) for f in files))
+            for _, group in itertools.groupby(merged, key=lambda entry: entry[0]):
+                *_, latest = group
+                yield latest
+        finally:
+            for f in files:
+                f.close()
+
+
+async def _collapsed(fingerprints):
+    """Yields each fingerprint of the sorted `fingerprints` with the count of
+    the consecutive ones of its identifier, the copies of a document left in
+    several indices."""
+    previous, copies = None, 0
+    async for fingerprint in fingerprints:
+        if previous is not None and fingerprint[0] == previous[0]:
+            copies += 1
+            continue
+        if previous is not None:
+            yield previous, copies
+        previous, copies = fingerprint, 1
+    if previous is not None:
+        yield previous, copies
+
+
+async def diff(entries, fingerprints):
+    """Walks the sorted `entries` of the files and `fingerprints` of the
+    index side by side. Yields (entry, None, 0) for the files not indexed,
+    (None, fingerprint, copies) for the documents without a file, (entry,
+    fingerprint, copies) for those in both, `copies` being the count of the
+    documents of the identifier, more than one when copies of a document
+    whose date changed are left in several yearly indices."""
+    entry = next(entries, None)
+    async for fingerprint, copies in _collapsed(fingerprints):
+        while entry is not None and entry[0] < fingerprint[0]:
+            yield entry, None, 0
+            entry = next(entries, None)
+        if entry is not None and entry[0] == fingerprint[0]:
+            yield entry, fingerprint, copies
+            entry = next(entries, None)
+        else:
+            yield None, fingerprint, copies
+    while entry is not None:
+        yield entry, None, 0
+        entry = next(entries, None)
+
+
+class Reconciler:
+    """Reconciles the documents of `backend` with the xml files under
+    directories, see the module documentation."""
+
+    def __init__(
+        self,
+        index,
+        backend,
+        bulk=None,
+        compact=False,
+        batch_size=1000,
+        run_size=100000,
+        pool=None,
+        workdir=None,
+    ):
+        self.indexer = Indexer(index, backend)
+        self.backend = backend
+        self.bulk = bulk or AdaptiveBulk(backend)
+        self.compact = compact
+        self.batch_size = batch_size
+        self.run_size = run_size
+        self.pool = pool
+        # where the sorted runs of the files are written
+        self.workdir = workdir
+        self.report = dict.fromkeys(
+            (
+                "source",
+                "indexed",
+                "orphans",
+                "missing",
+                "duplicates",
+                "changed",
+                "deleted",
+                "reindexed",
+                "errors",
+            ),
+            0,
+        )
+
+    async def delete(self, identifiers):
+        results = await self.backend.bulk_delete(identifiers)
+        for result in results:
+            if result["status"] < 400:
+                self.report["deleted"] += 1
+            else:
+                self.report["errors"] += 1
+
+    async def reindex(self, pending, dry_run=False):
+        """Parses the files of `pending` (entry, fingerprint) and indexes
+        those whose content hash differs from the fingerprint, only counts
+        them when `dry_run`."""
+        loop = asyncio.get_running_loop()
+        documents = await asyncio.gather(
+            *(
+                loop.run_in_executor(
+                    self.pool, Loader.prepare_file, entry[2], self.compact
+                )
+                for entry, _ in pending
+            )
+        )
+        by_version = {}
+        for (entry, fingerprint), document in zip(pending, documents):
+            if document is None:
+                self.report["errors"] += 1
+                continue
+            if fingerprint is not None:
+                if document["content_hash"] == fingerprint:
+                    continue
+                self.report["changed"] += 1
+            if dry_run:
+                continue
+            version = None if entry[1] < 0 else entry[1]
+            by_version.setdefault(version, []).append(document)
+        for version, documents in by_version.items():
+            results = await self.indexer.index_documents(documents, self.bulk, version)
+            for result in results:
+                if result["status"] < 400:
+                    self.report["reindexed"] += 1
+                else:
+                    self.report["errors"] += 1
+
+    async def delete_orphans(self, orphans):
+        """Deletes with all their copies the orphans whose identifiers are
+        written one per line in the file `orphans`."""
+        orphans.seek(0)
+        lines = (line.rstrip("\n") for line in orphans)
+        while batch := list(itertools.islice(lines, self.batch_size)):
+            await self.delete(batch)
+
+    async def reconcile(
+        self, directories, dry_run=False, verify=False, delete_orphans=False
+    ):
+        """Reconciles the index with the files under `directories`. Returns
+        the report, nothing being changed when `dry_run` and the orphans
+        deleted only when `delete_orphans`."""
+        entries = sorted_entries(
+            source_entries(directories), self.run_size, self.workdir
+        )
+        with tempfile.TemporaryFile("w+", dir=self.workdir) as orphans:
+            await self._reconcile(entries, orphans, dry_run, verify, delete_orphans)
+            if self.report["orphans"] and delete_orphans and not dry_run:
+                print(f"deleting {self.report['orphans']} orphans")
+                await self.delete_orphans(orphans)
+        return self.report
+
+    async def _reconcile(self, entries, orphans, dry_run, verify, delete_orphans):
+        pending = []
+        fingerprints = self.backend.walk_fingerprints(self.batch_size)
+        async for entry, fingerprint, copies in diff(entries, fingerprints):
+            if entry is not None:
+                self.report["source"] += 1
+            self.report["indexed"] += copies
+            if entry is None:
+                self.report["orphans"] += 1
+                if delete_orphans and not dry_run:
+                    orphans.write(fingerprint[0] + "\n")
+            elif fingerprint is None:
+                self.report["missing"] += 1
+                if not dry_run:
+                    pending.append((entry, None))
+            elif copies > 1:
+                self.report["duplicates"] += copies - 1
+                if not dry_run:
+                    # indexed again, its copies in other indices are deleted
+                    pending.append((entry, None))
+            elif verify:
+                # an empty fingerprint is never equal to a content hash
+                pending.append((entry, fingerprint[1] or ""))
+            if len(pending) >= self.batch_size:
+                await self.reindex(pending, dry_run)
+                pending = []
+        if pending:
+            await self.reindex(pending, dry_run)
+
+    async def finish(self, related=10):
+        """Updates the citation counts, the `related` decisions of each one
+        if any and the generation once documents were deleted or indexed.
+        Returns the generation."""
+        await self.indexer.update_citation_counts()
+        if related:
+            await self.indexer.update_related(related)
+        return await self.indexer.new_generation()
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    from app.backends import BACKENDS, get_backend
+
+    parser = ArgumentParser(
+        description="Reconcile the documents of an index with the xml files "
+        "the loading read"
+    )
+    parser.add_argument(
+        "directories",
+        metavar="dir",
+        nargs="+",
+        help="the directories of the extracted xml files",
+    )
+    parser.add_argument(
+        "index",
+        metavar="index",
+        type=str,
+        help="the index of the documents",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="elasticsearch",
+        help="the backend where documents are indexed",
+    )
+    parser.add_argument(
+        "--sqlite-path",
+        help="the SQLite database file used by the sqlite backend",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1000,
+        help="the identifiers read from the index, deleted or indexed at once",
+    )
+    parser.add_argument(
+        "--run-size",
+        type=int,
+        default=100000,
+        help="the identifiers of the files sorted in memory at once",
+    )
+    parser.add_argument(
+        "--work-dir",
+        help="where the sorted runs of the files are written, the temporary "
+        "directory by default",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the differences",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="parse the files of the documents indexed too and index again "
+        "those whose content changed",
+    )
+    parser.add_argument(
+        "--delete-orphans",
+        action="store_true",
+        help="delete the documents without a file, only counted otherwise",
+    )
+    parser.add_argument(
+        "--related",
+        type=int,
+        default=10,
+        help="the related decisions computed again for each decision, none "
+        "with 0, see app.related",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="index the paragraphes as one text with the offsets of their "
+        "lines, see app.compact",
+    )
+
+    args = parser.parse_args()
+    if not any(
+        next(source_entries([directory]), None) for directory in args.directories
+    ):
+        # every document would be an orphan
+        print("⚠ no decision found under", *args.directories, file=sys.stderr)
+        sys.exit(1)
+    loop = asyncio.get_event_loop()
+    backend = get_backend(args.backend, args.index, args.sqlite_path)
+    with concurrent.futures.ThreadPoolExecutor() as pool:
+        reconciler = Reconciler(
+            args.index,
+            backend,
+            compact=args.compact,
+            batch_size=args.batch_size,
+            run_size=args.run_size,
+            pool=pool,
+            workdir=args.work_dir,
+        )
+        loop.run_until_complete(reconciler.indexer.setup())
+        report = loop.run_until_complete(
+            reconciler.reconcile(
+                args.directories, args.dry_run, args.verify, args.delete_orphans
+            )
+        )
+    print(
+        f"{report['indexed']} in the index, {report['source']} files, "
+        f"{report['orphans']} orphans, {report['missing']} missing, "
+        f"{report['duplicates']} duplicates, "
+        f"{report['changed']} changed, {report['deleted']} deleted, "
+        f"{report['reindexed']} indexed and {report['errors']} errors"
+    )
+    if report["deleted"] or report["reindexed"]:
+        generation = loop.run_until_complete(reconciler.finish(args.related))
+        print("generation", generation)
@@ -1,126 +1,432 @@
+import asyncio
 from datetime import datetime, timedelta
-from functools import lru_cache
+import logging
+import os
+import time
 
-import elasticsearch
+from app.backends.es import ElasticsearchBackend
+from app.cache import LocalCache
+from app.compact import OFFSETS_FIELD, TEXT_FIELD, paragraphes
+from app.indexer import DECISION_FIELDS, content_hash
+from app.metrics import Counter, Histogram
+from app.model import (
+    Citations,
+    CompactDecision,
+    Decision,
+    DecisionSummary,
+    Related,
+)
+from app.services.summaries import SummaryStore
+from app.tracing import span
 
-from app.es import async_client
-from app.model import Decision, DecisionSummary
+
+logger = logging.getLogger(__name__)
+
+BACKEND_LATENCY = Histogram(
+    "cassapi_backend_request_duration_seconds",
+    "Duration of the calls to the storage backend.",
+    ["operation"],
+)
+BACKEND_ERRORS = Counter(
+    "cassapi_backend_errors_total",
+    "Calls to the storage backend which raised an error.",
+    ["operation"],
+)
+CACHE_LOOKUPS = Counter(
+    "cassapi_cache_lookups_total",
+    "Lookups of the cached counts and decisions, by result (hit, stale or miss).",
+    ["cache", "result"],
+)
 
 
 class DecisionService:
-    """Manages data fetch from the Elastic Search backend."""
+    """Manages data fetch from the storage backend, Elastic Search unless
+    another backend is given. Counts are kept in `cache` for `KEEP`, a local
+    one unless another is given, the decisions too when the cache is shared
+    by the workers (see `app.cache`).
+
+    The documents were validated when indexed (see `Indexer.prepare_document`)
+    so the decisions are built from them without validation. The summaries
+    are still validated: for such small models the validation, done by
+    pydantic-core, is faster than `model_construct` (see
+    `app.benchmarks.models`)."""
 
     KEEP = timedelta(minutes=5)
+    # how long an expired count is still served while it is fetched again
+    STALE = timedelta(minutes=5)
+    # share of KEEP after which `refresh_counts` fetches a count again
+    REFRESH_AHEAD = 0.8
+    # how long the generation of the documents is kept without a store
+    GENERATION_KEEP = timedelta(seconds=30)
 
-    def __init__(self, index):
+    def __init__(self, index, backend=None, cache=None, breaker=None):
         self.index = index
-        self._count = None
-        self.count_last_refresh = None
-        self._count_court = {}
+        self.backend = backend or ElasticsearchBackend(index)
+        self.cache = cache or LocalCache()
+        # refuses the calls to a backend timing out, see `app.admission`
+        self.breaker = breaker
+        # the courts whose count was asked for, None for the total
+        self._courts = set()
+        # the running fetches of the counts by court
+        self._fetching = {}
+        self.summary_store = None
+        self.summary_snapshot = None
+        # the running load of the summaries
+        self._loading = None
+
+    async def _call(self, operation, *args, **kwargs):
+        """Calls `operation` on the backend, recording its duration and its
+        failures. Raises `Overloaded` while the circuit breaker is open."""
+        if self.breaker is not None:
+            self.breaker.check()
+        start = time.perf_counter()
+        try:
+            with span("backend"):
+                result = await getattr(self.backend, operation)(*args, **kwargs)
+        except Exception as error:
+            BACKEND_ERRORS.inc(operation=operation)
+            if self.breaker is not None:
+                self.breaker.record(error)
+            raise
+        finally:
+            BACKEND_LATENCY.observe(time.perf_counter() - start, operation=operation)
+        if self.breaker is not None:
+            self.breaker.record()
+        return result
+
+    async def load_summaries(self, snapshot=None):
+        """Loads the summaries of all the documents in memory, counts and
+        summaries are then served from them, see `SummaryStore`. They are
+        read from the `snapshot` file when given and it exists."""
+        self.summary_snapshot = snapshot
+        await self._load_summaries()
+
+    def _load_summaries(self, generation=None):
+        """The task loading the summaries of `generation` in the store, one
+        at a time."""
+        if self._loading is None:
+            self._loading = asyncio.create_task(self._store_summaries(generation))
+            self._loading.add_done_callback(self._summaries_loaded)
+        return self._loading
+
+    def _summaries_loaded(self, task):
+        self._loading = None
+
+    async def _store_summaries(self, generation):
+        self.summary_store = await self._load_store(generation)
+
+    async def _load_store(self, generation=None):
+        """A store of the summaries, opened from the snapshot when it is of
+        `generation`, any generation when not given, loaded from the backend
+        otherwise."""
+        if self.summary_snapshot and os.path.exists(self.summary_snapshot):
+            store = SummaryStore.open(self.summary_snapshot)
+            if generation is None or store.generation == generation:
+                return store
+        return await SummaryStore.load(self.backend)
+
+    async def generation(self):
+        """The generation of the documents served, see
+        `Backend.set_generation`."""
+        if self.summary_store is not None:
+            return self.summary_store.generation
+        key = f"{self.index}:generation"
+        entry = await self.cache.get(key)
+        if entry is None:
+            entry = {"generation": await self._call("generation")}
+            await self.cache.set(key, entry, self.GENERATION_KEEP.total_seconds())
+        return entry["generation"]
+
+    async def refresh_summaries(self):
+        """Loads the summaries again if the generation of the documents
+        changed since they were loaded, the new store replacing the previous
+        one once complete, or if they are not loaded, their first load having
+        failed. Returns True if they were loaded, False when they are being
+        loaded already."""
+        if self._loading is not None:
+            return False
+        generation = None
+        if self.summary_store is not None:
+            generation = await self._call("generation")
+            if generation == self.summary_store.generation:
+                return False
+        await self._load_summaries(generation)
+        return True
+
+    def _count_key(self, court):
+        return f"{self.index}:count:{court or ''}"
+
+    async def _cached_count(self, court=None):
+        """The cached count of `court`. A missing count is fetched once for
+        all the requests asking for it, an expired one is served while it is
+        fetched again in the background."""
+        court = court.lower() if court else None
+        self._courts.add(court)
+        cache = "count" if court is None else "count_court"
+        entry = await self.cache.get(self._count_key(court))
+        if entry is None:
+            CACHE_LOOKUPS.inc(cache=cache, result="miss")
+            return await asyncio.shield(self._fetch_count(court))
+        if time.time() - entry["refreshed"] < self.KEEP.total_seconds():
+            CACHE_LOOKUPS.inc(cache=cache, result="hit")
+        else:
+            CACHE_LOOKUPS.inc(cache=cache, result="stale")
+            await self._revalidate(court)
+        return entry["count"]
+
+    def _fetch_count(self, court):
+        """The task fetching the count of `court`, one at a time."""
+        task = self._fetching.get(court)
+        if task is None:
+            task = asyncio.create_task(self._store_count(court))
+            self._fetching[court] = task
+            task.add_done_callback(lambda task: self._fetched(court, task))
+        return task
+
+    def _fetched(self, court, task):
+        del self._fetching[court]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("count of %s failed", court, exc_info=task.exception())
+
+    async def _store_count(self, court, count=None):
+        if count is None:
+            count = await self._call("count", *(() if court is None else (court,)))
+        await self.cache.set(
+            self._count_key(court),
+            {"count": count, "refreshed": time.time()},
+            (self.KEEP + self.STALE).total_seconds(),
+        )
+        return count
+
+    async def _revalidate(self, court):
+        """Starts fetching the count of `court` again unless it is already
+        being fetched, by this worker or another one sharing the cache.
+        Returns the task fetching it, if started."""
+        if court in self._fetching:
+            return None
+        lock = (self.KEEP * (1 - self.REFRESH_AHEAD)).total_seconds()
+        key = f"{self._count_key(court)}:refresh"
+        if not await self.cache.add(key, os.getpid(), lock):
+            return None
+        return self._fetch_count(court)
+
+    async def refresh_counts(self):
+        """Fetches again the counts asked for which are close to expire, so
+        that no request waits for them. With a shared cache each count is
+        fetched by one worker only. Returns the courts whose count was
+        fetched, None standing for the total."""
+        ahead = self.KEEP.total_seconds() * self.REFRESH_AHEAD
+        tasks = {}
+        for court in list(self._courts):
+            entry = await self.cache.get(self._count_key(court))
+            if entry is not None and time.time() - entry["refreshed"] < ahead:
+                continue
+            task = await self._revalidate(court)
+            if task is not None:
+                tasks[court] = task
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        return list(tasks)
+
+    async def warm_counts(self):
+        """Fetches the total and the counts of all the courts, the latter in
+        one request, for the first requests not to wait for them."""
+        counts = await self._call("count_by_court")
+        self._courts.add(None)
+        await self._store_count(None)
+        for court, count in counts.items():
+            self._courts.add(court.lower())
+            await self._store_count(court.lower(), count)
+        return counts
 
     @property
     async def count(self):
         """Count of document indexed on the backend."""
-        if self._count is None or self.count_last_refresh + self.KEEP < datetime.now():
-            self.count_last_refresh = datetime.now()
-            async with async_client() as client:
-                resp = await client.count(
-                    index=self.index,
-                    query={"match_all": {}},
-                )
-            self._count = resp["count"]
-        return self._count
+        if self.summary_store is not None:
+            return self.summary_store.count()
+        return await self._cached_count()
 
     async def count_court(self, court):
         """Count of document indexed on the backend for a specific court."""
-        if (
-            court not in self._count_court
-            or self._count_court[court]["last_refresh"] + self.KEEP < datetime.now()
-        ):
-
-            async with async_client() as client:
-                resp = await client.count(
-                    index=self.index,
-                    query={"match": {"code_chambre": court.lower()}},
-                )
-            self._count_court[court] = {
-                "_last_refresh": datetime.now(),
-                "count": resp["count"],
-            }
-        return self._count_court[court]["count"]
+        if self.summary_store is not None:
+            return self.summary_store.count(court)
+        return await self._cached_count(court)
 
     async def get_summary_for_court(self, court, cursor=0, size=None):
         """Retrieves a summary of indexed documents for a specific court."""
-
-        async with async_client() as client:
-            resp = await client.search(
-                index=self.index,
-                fields=["title", "identifier", "code_chambre"],
-                query={"match": {"code_chambre": court.lower()}},
-                sort=[{"date": {"order": "asc", "format": "strict_date"}}],
-                size=size,
-                from_=cursor,
-                _source=False,
-            )
-        for item in resp["hits"]["hits"]:
-            yield DecisionSummary(
-                identifier=item["fields"]["identifier"][0],
-                title=item["fields"]["title"][0],
-                code_chambre=item["fields"]["code_chambre"][0],
-            )
+        if self.summary_store is not None:
+            items = self.summary_store.summaries(court, cursor, size)
+        else:
+            items = await self._call("summaries", court, cursor, size)
+        for item in items:
+            with span("model"):
+                summary = DecisionSummary(**item)
+            yield summary
 
     async def get_summary(self, cursor=0, size=None):
         """Retrieves a summary of indexed documents for all courts."""
-        async with async_client() as client:
-            resp = await client.search(
-                index=self.index,
-                fields=["title", "identifier", "code_chambre"],
-                query={"match_all": {}},
-                sort=[{"date": {"order": "asc", "format": "strict_date"}}],
-                size=size,
-                from_=cursor,
-                _source=False,
-            )
-        for item in resp["hits"]["hits"]:
-            yield DecisionSummary(
-                identifier=item["fields"]["identifier"][0],
-                title=item["fields"]["title"][0],
-                code_chambre=item["fields"]["code_chambre"][0],
-            )
+        if self.summary_store is not None:
+            items = self.summary_store.summaries(None, cursor, size)
+        else:
+            items = await self._call("summaries", None, cursor, size)
+        for item in items:
+            with span("model"):
+                summary = DecisionSummary(**item)
+            yield summary
 
     async def get_decision(self, identifier):
         """Get the detail of a decision with its identifier."""
-        async with async_client() as client:
-            try:
-                resp = await client.get(index=self.index, id=identifier)
-            except elasticsearch.NotFoundError:
-                return None
-        payload = resp["_source"]
-        return Decision(
-            title=payload["title"],
-            identifier=payload["identifier"],
-            numero=payload["numero"],
-            paragraphes=payload["paragraphes"],
-            chambre=payload["chambre"],
-            code_chambre=payload["code_chambre"],
+        decision, _ = await self.get_decision_version(identifier)
+        return decision
+
+    async def get_version(self, identifier):
+        """The hash of the content of a decision, without fetching it. None
+        when the decision doesn't exist or was indexed without its hash."""
+        payload = await self._call("get", identifier, fields=["content_hash"])
+        return payload and payload.get("content_hash")
+
+    async def get_decision_version(self, identifier, compact=False):
+        """The detail of a decision with the hash of its content, (None, None)
+        when it doesn't exist. Its paragraphes are lists of lines, or a
+        `CompactDecision` is returned if `compact`, see `app.compact`."""
+        payload = await self._get_decision(identifier)
+        if payload is None:
+            return None, None
+        version = payload.get("content_hash") or content_hash(payload)
+        payload = dict(payload)
+        with span("model"):
+            model = CompactDecision if compact else Decision
+            payload["paragraphes"] = paragraphes(payload, compact=compact)
+            decision = model.model_construct(
+                title=payload["title"],
+                identifier=payload["identifier"],
+                numero=payload["numero"],
+                paragraphes=payload["paragraphes"],
+                chambre=payload["chambre"],
+                code_chambre=payload["code_chambre"],
+            )
+        return decision, version
+
+    async def get_decision_part(
+        self, identifier, fields=None, paragraphs=None, compact=False
+    ):
+        """The `fields` of a decision, all of them if not given, with only the
+        `paragraphs` range (a `slice`) of its paragraphes, `compact` if asked,
+        and the hash of its whole content. Only what is asked is fetched from
+        the backend. Returns (None, None) when it doesn't exist."""
+        fields = list(fields or DECISION_FIELDS)
+        wanted = [*fields, "content_hash"]
+        if "paragraphes" in fields:
+            wanted += [TEXT_FIELD, OFFSETS_FIELD]
+        payload = await self._call(
+            "get", identifier, fields=wanted, paragraphs=paragraphs
         )
+        if payload is None:
+            return None, None
+        version = payload.pop("content_hash", None)
+        if "paragraphes" in fields:
+            part = paragraphes(payload, paragraphs, compact)
+            payload["paragraphes"] = part.model_dump() if compact else part
+        return {field: payload[field] for field in fields if field in payload}, version
+
+    def _decision_key(self, identifier):
+        return f"{self.index}:decision:{identifier}"
+
+    async def _get_decision(self, identifier):
+        # a local cache only holds the decisions prefetched
+        payload = await self.cache.get(self._decision_key(identifier))
+        if payload is not None:
+            CACHE_LOOKUPS.inc(cache="decision", result="hit")
+            return payload
+        CACHE_LOOKUPS.inc(cache="decision", result="miss")
+        payload = await self._call("get", identifier)
+        if payload is not None and self.cache.shared:
+            await self.cache.set(
+                self._decision_key(identifier), payload, self.KEEP.total_seconds()
+            )
+        return payload
+
+    async def prefetch(self, identifiers, concurrency=8):
+        """Fetches the decisions `identifiers` into the cache, local or
+        shared, for their first requests not to wait for the backend. They
+        are kept for `KEEP`. Returns the count of those found."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(identifier):
+            async with semaphore:
+                payload = await self._call("get", identifier)
+            if payload is not None:
+                await self.cache.set(
+                    self._decision_key(identifier),
+                    payload,
+                    self.KEEP.total_seconds(),
+                )
+            return payload is not None
+
+        return sum(await asyncio.gather(*(fetch(id) for id in identifiers)))
+
+    async def count_citing(self, identifier):
+        """Count of indexed documents citing `identifier`."""
+        return await self._call("count_citing", identifier)
 
-    async def fulltext_search(self, query):
-        """Performs a fulltext search on the indexed documents."""
+    async def get_citing(self, identifier, cursor=0, size=None):
+        """Retrieves a summary of indexed documents citing `identifier`."""
+        items = await self._call("citing", identifier, cursor, size)
+        for item in items:
+            with span("model"):
+                summary = DecisionSummary(**item)
+            yield summary
 
-        async with async_client() as client:
-            resp = await client.search(
-                index=self.index,
-                fields=["title", "identifier", "code_chambre"],
-                query={"match": {"paragraphes": {"query": query}}},
-                _source=False,
+    async def get_citations(self, identifier):
+        """Get the references cited by a decision with its identifier."""
+        payload = await self._call(
+            "get", identifier, fields=["identifier", "cites", "cited_by_count"]
+        )
+        if payload is None:
+            return None
+        with span("model"):
+            return Citations(
+                identifier=payload["identifier"],
+                cites=payload.get("cites", []),
+                cited_by_count=payload.get("cited_by_count", 0),
             )
-        for item in resp["hits"]["hits"]:
-            yield (
-                item["_score"],
-                DecisionSummary(
-                    identifier=item["fields"]["identifier"][0],
-                    title=item["fields"]["title"][0],
-                    code_chambre=item["fields"]["code_chambre"][0],
-                ),
+
+    async def get_related(self, identifier):
+        """Get the identifiers of the decisions related to a decision, as
+        computed at the loading, see `app.related`."""
+        payload = await self._call("get", identifier, fields=["identifier", "related"])
+        if payload is None:
+            return None
+        with span("model"):
+            return Related(
+                identifier=payload["identifier"], related=payload.get("related", [])
             )
+
+    async def search_batch(self, queries, concurrency=8):
+        """Runs the fulltext searches `queries`, `SearchQuery` models, at
+        once, see `Backend.search_batch`. Returns for each one in order its
+        duration in milliseconds under `took` with its `results`, (score,
+        summary) pairs, or its `error`."""
+        items = await self._call(
+            "search_batch", [query.model_dump() for query in queries], concurrency
+        )
+        results = []
+        for item in items:
+            if "error" in item:
+                results.append({"took": item["took"], "error": item["error"]})
+                continue
+            with span("model"):
+                summaries = [
+                    (score, DecisionSummary(**summary))
+                    for score, summary in item["hits"]
+                ]
+            results.append({"took": item["took"], "results": summaries})
+        return results
+
+    async def fulltext_search(self, query, since=None, until=None):
+        """Performs a fulltext search on the indexed documents, dated between
+        `since` and `until` when given."""
+        items = await self._call("search", query, since=since, until=until)
+        for score, item in items:
+            with span("model"):
+                summary = DecisionSummary(**item)
+            yield score, summary
@@ -0,0 +1,214 @@
+"""In process store of the summaries of all the decisions.
+
+The listing endpoints only need the three short fields of the summaries and
+the corpus only changes when it is loaded, so the summaries can be served
+from memory instead of querying the backend for each page. The store keeps
+them sorted by date in a few flat arrays rather than one object by summary:
+    - the identifiers and titles encoded in one string table, a blob of
+      utf-8 with the offsets of each string, the identifier of the decision i
+      being the string 2i and its title the string 2i+1,
+    - the date of each decision as a day ordinal,
+    - the chambre of each decision as an index in the list of the chambres,
+    - for each chambre, the positions of its decisions.
+
+A store is tied to the generation of the documents it was loaded from (see
+`Backend.set_generation`), the service loads a new one when the generation
+of the backend changes.
+
+A store can be written to a snapshot file holding the same arrays, which
+the workers open with `mmap`: the file is read lazily and all the workers
+share the same copy of it in the page cache. The file starts with a header
+(see `HEADER`) followed by sections aligned on 8 bytes, in this order: the
+generation, the names of the chambres separated by new lines, the offsets
+of the string table, the dates, the chambre ids, the positions of the
+decisions grouped by chambre, the offsets of each chambre group and the
+string table itself. Integers are in the byte order of the machine which
+wrote the file, the loading script is meant to run on the api host.
+"""
+
+from array import array
+from datetime import date
+import mmap
+import os
+import struct
+import sys
+
+from app.backends.base import DEFAULT_SIZE
+
+
+MAGIC = b"CASSSUM1"
+# magic, byte order, number of decisions, number of chambres and the lengths
+# in bytes of the generation, the chambre names and the string table
+HEADER = struct.Struct("=8s8sIIIIQ")
+
+
+def _padding(length):
+    return -length % 8
+
+
+class SummaryStore:
+    def __init__(
+        self, generation, blob, offsets, dates, chambres, chambre_ids, groups=None
+    ):
+        self.generation = generation
+        self._blob = blob
+        self._offsets = offsets
+        self._dates = dates
+        self.chambres = chambres
+        self._chambre_ids = chambre_ids
+        if groups is None:
+            groups = self._group(chambre_ids, len(chambres))
+        positions, bounds = groups
+        self._groups = groups
+        self._by_court = {
+            chambre.lower(): positions[bounds[number] : bounds[number + 1]]
+            for number, chambre in enumerate(chambres)
+        }
+
+    @staticmethod
+    def _group(chambre_ids, count):
+        """The positions of the decisions grouped by chambre with the bounds
+        of each group."""
+        grouped = [array("I") for _ in range(count)]
+        for position, chambre_id in enumerate(chambre_ids):
+            grouped[chambre_id].append(position)
+        positions = array("I")
+        bounds = array("I", [0])
+        for group in grouped:
+            positions += group
+            bounds.append(len(positions))
+        return positions, bounds
+
+    @classmethod
+    def build(cls, summaries, generation=None):
+        """Builds a store from summaries with their date, given sorted by
+        date."""
+        blob = bytearray()
+        offsets = array("I", [0])
+        dates = array("i")
+        chambres = {}
+        chambre_ids = array("H")
+        for summary in summaries:
+            for value in (summary["identifier"], summary["title"]):
+                blob += value.encode("utf-8")
+                offsets.append(len(blob))
+            dates.append(date.fromisoformat(summary["date"][:10]).toordinal())
+            chambre = summary["code_chambre"]
+            chambre_ids.append(chambres.setdefault(chambre, len(chambres)))
+        return cls(generation, bytes(blob), offsets, dates, list(chambres), chambre_ids)
+
+    @classmethod
+    async def load(cls, backend, batch_size=1000, generation=None):
+        """Loads the summaries of all the documents of `backend`, as of
+        `generation` when given, to be set once the store is written, as of
+        the generation of the backend otherwise."""
+        if generation is None:
+            generation = await backend.generation()
+        summaries = [item async for item in backend.walk_summaries(batch_size)]
+        return cls.build(summaries, generation)
+
+    def write(self, path):
+        """Writes the store into a snapshot file at `path`. The file is
+        replaced at once, the workers which opened the previous one keep
+        reading it until they open the new one."""
+        generation = (self.generation or "").encode("utf-8")
+        chambres = "\n".join(self.chambres).encode("utf-8")
+        sections = [
+            generation,
+            chambres,
+            self._offsets,
+            self._dates,
+            self._chambre_ids,
+            *self._groups,
+            self._blob,
+        ]
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    MAGIC,
+                    sys.byteorder.encode(),
+                    len(self),
+                    len(self.chambres),
+                    len(generation),
+                    len(chambres),
+                    len(self._blob),
+                )
+            )
+            for section in sections:
+                data = bytes(section)
+                f.write(data)
+                f.write(b"\0" * _padding(len(data)))
+        os.replace(tmp, path)
+
+    @classmethod
+    def open(cls, path):
+        """Opens a snapshot file written by `write`, its arrays are read
+        from the mapped file."""
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        magic, byteorder, count, chambres, generation, names, blob = HEADER.unpack_from(
+            view
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a summary snapshot")
+        if byteorder.rstrip(b"\0").decode() != sys.byteorder:
+            raise ValueError(f"{path} was written with another byte order")
+        position = HEADER.size
+
+        def section(length, fmt=None):
+            nonlocal position
+            if fmt:
+                length *= array(fmt).itemsize
+            data = view[position : position + length]
+            position += length + _padding(length)
+            return data.cast(fmt) if fmt else data
+
+        generation = str(section(generation), "utf-8") or None
+        names = str(section(names), "utf-8")
+        return cls(
+            generation,
+            offsets=section(2 * count + 1, "I"),
+            dates=section(count, "i"),
+            chambres=names.split("\n") if chambres else [],
+            chambre_ids=section(count, "H"),
+            groups=(section(count, "I"), section(chambres + 1, "I")),
+            blob=section(blob),
+        )
+
+    def __len__(self):
+        return len(self._dates)
+
+    def _string(self, number):
+        start, end = self._offsets[number], self._offsets[number + 1]
+        return str(self._blob[start:end], "utf-8")
+
+    def summary(self, position):
+        """The summary of the decision at `position`."""
+        return {
+            "identifier": self._string(2 * position),
+            "title": self._string(2 * position + 1),
+            "code_chambre": self.chambres[self._chambre_ids[position]],
+        }
+
+    def date(self, position):
+        return date.fromordinal(self._dates[position])
+
+    def count(self, court=None):
+        """Count of decisions, for a specific court if given."""
+        if court is None:
+            return len(self)
+        return len(self._by_court.get(court.lower(), ()))
+
+    def summaries(self, court=None, cursor=0, size=None):
+        """Summaries sorted by date, for a specific court if given, as the
+        backends return them."""
+        size = DEFAULT_SIZE if size is None else size
+        # a negative cursor would count from the end
+        cursor = max(cursor, 0)
+        if court is None:
+            positions = range(cursor, min(cursor + size, len(self)))
+        else:
+            positions = self._by_court.get(court.lower(), ())[cursor : cursor + size]
+        return [self.summary(position) for position in positions]
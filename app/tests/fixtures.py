@@ -1,14 +1,26 @@
 import os
+from random import randint
 
 from pytest import fixture
 
+from app.backends import BACKENDS, get_backend
 from app.es import get_client
 from app.legifrance.parser import Parser
 
 
+# without a cluster configured the tests run against the in memory stand-in
+os.environ.setdefault("ELASTIC_URL", "memory://tests")
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "test_data")
 
 
+def new_backend(name, path):
+    """Returns a backend called `name` on a new index with a random name.
+    Backends storing files put them under the directory `path`."""
+    index = "test-" + "".join(chr(randint(97, 122)) for _ in range(10))
+    return get_backend(name, index, sqlite_path=os.path.join(path, f"{index}.db"))
+
+
 @fixture(scope="session")
 def parser():
     yield Parser.from_file(os.path.join(DATA_DIR, "test.xml"))
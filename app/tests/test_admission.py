@@ -0,0 +1,109 @@
+import asyncio
+
+from elastic_transport import ConnectionTimeout
+import pytest
+
+from app.admission import Admission, CircuitBreaker, Overloaded
+from app.services.decision import DecisionService
+
+
+def test_lookups_first():
+    admission = Admission(2, {"lookup": (2, 4), "search": (2, 4)}, timeout=1.0)
+    order = []
+
+    async def request(lane, name, duration=0.01):
+        async with admission.admit(lane):
+            order.append(name)
+            await asyncio.sleep(duration)
+
+    async def run():
+        running = [
+            asyncio.create_task(request("search", "s1")),
+            asyncio.create_task(request("search", "s2")),
+        ]
+        await asyncio.sleep(0)
+        # the capacity is taken, the lookup queued last goes in first
+        queued = [
+            asyncio.create_task(request("search", "s3")),
+            asyncio.create_task(request("lookup", "l1")),
+        ]
+        await asyncio.gather(*running, *queued)
+
+    asyncio.get_event_loop().run_until_complete(run())
+    assert order == ["s1", "s2", "l1", "s3"]
+    assert admission.active == 0
+
+
+def test_overloaded():
+    admission = Admission(8, {"search": (1, 1)}, timeout=0.05, retry_after=3)
+
+    async def run():
+        await admission.acquire("search")
+        waiting = asyncio.create_task(admission.acquire("search"))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as full:
+            await admission.acquire("search")
+        with pytest.raises(Overloaded) as late:
+            await waiting
+        admission.release("search")
+        return full.value, late.value
+
+    full, late = asyncio.get_event_loop().run_until_complete(run())
+    assert (full.reason, full.retry_after) == ("queue_full", 3)
+    assert late.reason == "timeout"
+    assert admission.active == 0
+    assert not admission.lanes["search"].waiters
+
+
+class TimingOut:
+    """A backend whose calls time out while `down`."""
+
+    def __init__(self):
+        self.down = True
+        self.calls = 0
+
+    async def count(self):
+        self.calls += 1
+        if self.down:
+            raise ConnectionTimeout("timed out")
+        return 12
+
+
+def test_circuit_breaker():
+    backend = TimingOut()
+    breaker = CircuitBreaker(threshold=3, reset_seconds=60)
+    service = DecisionService("tests", backend, breaker=breaker)
+    loop = asyncio.get_event_loop()
+    for _ in range(3):
+        with pytest.raises(ConnectionTimeout):
+            loop.run_until_complete(service._call("count"))
+    with pytest.raises(Overloaded) as refused:
+        loop.run_until_complete(service._call("count"))
+    assert refused.value.reason == "circuit_open"
+    assert 0 < refused.value.retry_after <= 60
+    assert backend.calls == 3
+    # once reset_seconds passed, a single call is tried
+    breaker.opened -= 60
+    backend.down = False
+    assert loop.run_until_complete(service._call("count")) == 12
+    assert not breaker.open
+
+
+def test_circuit_breaker_other_errors():
+    breaker = CircuitBreaker(threshold=2, reset_seconds=60)
+    breaker.record(ConnectionTimeout("timed out"))
+    # a missing document doesn't reset the timeouts in a row
+    breaker.record(KeyError("JURITEXT000000000001"))
+    breaker.record(ConnectionTimeout("timed out"))
+    assert breaker.open
+    # nor closes the breaker when it is the call tried after reset_seconds
+    breaker.opened -= 60
+    breaker.check()
+    breaker.record(KeyError("JURITEXT000000000001"))
+    assert breaker.open
+    with pytest.raises(Overloaded):
+        breaker.check()
+    breaker.opened -= 60
+    breaker.check()
+    breaker.record()
+    assert not breaker.open
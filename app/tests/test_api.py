@@ -0,0 +1,178 @@
+import asyncio
+import os
+from random import randint
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+from pytest import fixture
+
+from app.indexer import Indexer
+from app.legifrance.files import get_files
+from app.legifrance.parser import Parser
+
+from .fixtures import DATA_DIR
+
+
+# the settings are read when the application is imported
+os.environ.setdefault("ADMIN_USER", "test")
+os.environ.setdefault("ADMIN_PASSWORD", "test")
+os.environ["ELASTIC_INDEX"] = "test-" + "".join(
+    chr(randint(97, 122)) for _ in range(10)
+)
+
+
+@fixture(scope="module")
+def main():
+    from app.api import main
+
+    backend = main.decision_service.backend
+    indexer = Indexer(backend.index, backend)
+    parsers = [
+        Parser.from_file(path)
+        for path in get_files(os.path.join(DATA_DIR, "full_tree"))
+    ]
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(indexer.setup())
+    loop.run_until_complete(indexer.bulk_index(parsers))
+    loop.run_until_complete(backend.refresh())
+    loop.run_until_complete(indexer.new_generation())
+    yield main
+    loop.run_until_complete(backend.drop())
+
+
+@fixture
+def client(main):
+    client = TestClient(main.app, raise_server_exceptions=False)
+    client.auth = (main.settings.admin_user, main.settings.admin_password)
+    return client
+
+
+def test_summary_pages(client):
+    resp = client.get("/summary")
+    assert resp.status_code == 200
+    assert "etag" in resp.headers
+    body = resp.json()
+    stats = body["stats"]
+    assert (stats["page"], stats["count"], stats["total"]) == (1, 92, 92)
+    assert len(body["decisions"]) == 92
+    resp = client.get("/CHAMBRE_SOCIALE/summary")
+    assert resp.json()["stats"]["count"] == len(resp.json()["decisions"]) > 0
+    # beyond the result window of Elastic Search the backend fails, before
+    # the response starts
+    resp = client.get("/summary?page=999")
+    assert resp.status_code == 500
+    assert "etag" not in resp.headers
+    for page in (0, -1):
+        assert client.get(f"/summary?page={page}").status_code == 422
+        assert client.get(f"/CHAMBRE_SOCIALE/summary?page={page}").status_code == 422
+
+
+def test_summary_streamed(client, main, monkeypatch):
+    service = main.decision_service
+    summaries = asyncio.get_event_loop().run_until_complete(
+        _collect(service.get_summary())
+    )
+    # more than a chunk of the stream
+    count = main.STREAM_CHUNK // len(summaries[0].model_dump_json()) + 1
+
+    async def failing(cursor=0, size=None):
+        raise RuntimeError("backend down")
+        yield
+
+    monkeypatch.setattr(service, "get_summary", failing)
+    resp = client.get("/summary")
+    assert resp.status_code == 500
+    assert "etag" not in resp.headers
+
+    async def failing_midway(cursor=0, size=None):
+        for _ in range(count):
+            yield summaries[0]
+        raise RuntimeError("backend down")
+
+    # the summaries are sent as they come, the response was started when
+    # the failure occurs
+    monkeypatch.setattr(service, "get_summary", failing_midway)
+    assert client.get("/summary").status_code == 200
+
+
+def test_decision_encodings(client):
+    identifier = "JURITEXT000048211087"
+    plain = client.get(f"/decision/{identifier}", headers={"Accept-Encoding": ""})
+    assert plain.status_code == 200
+    assert "content-encoding" not in plain.headers
+    assert plain.headers["vary"] == "Accept-Encoding"
+    gzipped = client.get(f"/decision/{identifier}", headers={"Accept-Encoding": "gzip"})
+    assert gzipped.headers["content-encoding"] == "gzip"
+    assert gzipped.headers["vary"] == "Accept-Encoding"
+    assert gzipped.headers["etag"] == "W/" + plain.headers["etag"]
+    # too small to be compressed
+    small = client.get(
+        f"/decision/{identifier}?fields=title", headers={"Accept-Encoding": "gzip"}
+    )
+    assert "content-encoding" not in small.headers
+    assert small.headers["vary"] == "Accept-Encoding"
+    # an empty projection is the whole decision
+    empty = client.get(
+        f"/decision/{identifier}?fields=", headers={"Accept-Encoding": ""}
+    )
+    assert empty.json() == plain.json()
+    assert empty.headers["etag"] == plain.headers["etag"]
+
+
+def test_search(client, main, monkeypatch):
+    resp = client.get("/search?query=cassation")
+    assert resp.status_code == 200
+    assert resp.json()["result"]
+
+    async def failing(*args, **kwargs):
+        raise RuntimeError("backend down")
+
+    monkeypatch.setattr(main.decision_service.backend, "search", failing)
+    assert client.get("/search?query=cassation").status_code == 500
+
+    summaries = asyncio.get_event_loop().run_until_complete(
+        _collect(main.decision_service.get_summary())
+    )
+
+    async def found(query, since=None, until=None):
+        for summary in summaries:
+            yield 1.0, summary
+
+    monkeypatch.setattr(main.decision_service, "fulltext_search", found)
+    resp = client.get("/search?query=cassation")
+    assert [item["decision"] for item in resp.json()["result"]] == [
+        summary.model_dump() for summary in summaries
+    ]
+
+
+def test_warm_up(main, monkeypatch):
+    loaded = []
+
+    async def load_summaries(snapshot=None):
+        await asyncio.sleep(0.2)
+        loaded.append(snapshot)
+
+    monkeypatch.setattr(main.settings, "summary_store", True)
+    monkeypatch.setattr(main.settings, "warmup_timeout", 0.05)
+
+    async def connect(connections):
+        # the pool opened would be kept by the other tests
+        pass
+
+    monkeypatch.setattr(main.decision_service.backend, "connect", connect)
+    monkeypatch.setattr(main.decision_service, "load_summaries", load_summaries)
+    app = SimpleNamespace(state=SimpleNamespace(ready=False))
+
+    async def run():
+        warming = asyncio.create_task(main.warm_up(app))
+        await asyncio.sleep(0.1)
+        # ready after the timeout, the summaries still being loaded
+        assert app.state.ready and not loaded
+        await warming
+        assert loaded
+
+    asyncio.get_event_loop().run_until_complete(run())
+
+
+async def _collect(items):
+    return [item async for item in items]
@@ -0,0 +1,88 @@
+from argparse import ArgumentParser
+import asyncio
+import os
+import tarfile
+
+import pytest
+
+from app.backends import BACKENDS
+from app.benchmarks import (
+    add_baseline_arguments,
+    check_baseline,
+    compare,
+    models,
+    percentile,
+)
+from app.benchmarks.api import index_exists
+from app.benchmarks.corpus import build_corpus
+from app.legifrance.files import get_files
+from app.legifrance.parser import Parser
+
+from .fixtures import new_backend
+
+
+def test_build_corpus(tmp_path):
+    names, size = build_corpus(str(tmp_path), 200, archives=3)
+    assert names == sorted(names)
+    assert len(names) == 3
+    for name in names:
+        with tarfile.open(tmp_path / name, mode="r:gz") as f:
+            f.extractall(path=tmp_path / "tree")
+    files = list(get_files(str(tmp_path / "tree")))
+    assert len(files) == 200
+    assert sum(os.path.getsize(fpath) for fpath in files) == size
+    parsers = [Parser.from_file(fpath) for fpath in files]
+    assert len({parser.identifier for parser in parsers}) == 200
+    for parser, fpath in zip(parsers, files):
+        assert fpath.endswith(f"{parser.identifier}.xml")
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3], 95) == 3
+    assert percentile([], 50) is None
+
+
+def test_compare():
+    baseline = {"parse": {"docs_per_sec": 100, "p95_ms": 10}}
+    report = {"parse": {"docs_per_sec": 95, "p95_ms": 12}, "index": {"p95_ms": 1}}
+    assert compare(report, baseline, ["docs_per_sec", "p95_ms"], 0.1) == [
+        ("parse", "p95_ms", 10, 12)
+    ]
+
+
+def test_check_baseline(tmp_path, capsys):
+    parser = ArgumentParser()
+    add_baseline_arguments(parser)
+    path = str(tmp_path / "baseline.json")
+    report = {"parse": {"docs_per_sec": 100, "p95_ms": 10}}
+    check_baseline(parser.parse_args(["--save-baseline", path]), report, ["p95_ms"])
+    args = parser.parse_args(["--baseline", path, "--tolerance", "0.5"])
+    check_baseline(args, {"parse": {"p95_ms": 14}}, ["p95_ms"])
+    with pytest.raises(SystemExit) as exit:
+        check_baseline(args, {"parse": {"p95_ms": 16}}, ["p95_ms"])
+    assert exit.value.code == 1
+    assert "⚠ REGRESSION: parse p95_ms 16 (baseline 10)" in capsys.readouterr().out
+
+
+def test_models():
+    page, decision = models.documents(10, 50)
+    assert len(page) == 10
+    assert len(decision["paragraphes"]) == 50
+    report = models.run(page, decision, repeat=2)
+    assert report["page constructed"]["docs"] == 20
+    assert report["decision model_dump_json"]["docs"] == 2
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_index_exists(name, tmp_path):
+    backend = new_backend(name, str(tmp_path))
+    assert not index_exists(backend)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backend.setup())
+    try:
+        assert index_exists(backend)
+    finally:
+        loop.run_until_complete(backend.drop())
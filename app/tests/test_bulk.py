@@ -0,0 +1,123 @@
+import asyncio
+
+from app.benchmarks.corpus import synthetic_parsers
+from app.bulk import AdaptiveBulk
+from app.indexer import Indexer
+
+from .fixtures import new_backend
+
+
+def documents(size):
+    return [Indexer.prepare_document(parser) for parser in synthetic_parsers(size)]
+
+
+def test_rejected_items_retried(monkeypatch, tmp_path):
+    # a stand-in rejecting a third of the bulk items as an overloaded cluster
+    monkeypatch.setenv("ELASTIC_URL", "memory://tests?reject=0.3")
+    loop = asyncio.get_event_loop()
+    backend = new_backend("elasticsearch", str(tmp_path))
+    loop.run_until_complete(backend.setup())
+    bulk = AdaptiveBulk(
+        backend,
+        batch_size=100,
+        concurrency=1,
+        min_batch_size=5,
+        max_attempts=50,
+        base_delay=0.001,
+        max_delay=0.01,
+    )
+    sizes = []
+    bulk_index = backend.bulk_index
+
+    async def recorded(documents, version=None):
+        sizes.append(len(documents))
+        return await bulk_index(documents, version)
+
+    monkeypatch.setattr(backend, "bulk_index", recorded)
+    docs = documents(300)
+    try:
+        results = loop.run_until_complete(bulk.index(docs))
+        loop.run_until_complete(backend.refresh())
+        count = loop.run_until_complete(backend.count())
+    finally:
+        loop.run_until_complete(backend.drop())
+    assert [result["_id"] for result in results] == [doc["identifier"] for doc in docs]
+    assert {result["status"] for result in results} == {201}
+    assert count == 300
+    assert bulk.retries > 0
+    # halved after the rejections of the first request
+    assert sizes[:2] == [100, 50]
+
+
+class FlakyBackend:
+    """Fails its first requests with `error`."""
+
+    def __init__(self, error, failures=1):
+        self.error = error
+        self.failures = failures
+        self.requests = []
+
+    async def bulk_index(self, documents, version=None):
+        self.requests.append(len(documents))
+        if len(self.requests) <= self.failures:
+            raise self.error
+        return [
+            {"_id": doc["identifier"], "result": "created", "status": 201}
+            for doc in documents
+        ]
+
+
+def test_failed_request_retried():
+    backend = FlakyBackend(TimeoutError("timed out"), failures=2)
+    bulk = AdaptiveBulk(backend, batch_size=40, concurrency=1, base_delay=0.001)
+    docs = documents(40)
+    results = asyncio.get_event_loop().run_until_complete(bulk.index(docs))
+    assert {result["status"] for result in results} == {201}
+    # halved on each failure
+    assert backend.requests[:3] == [40, 20, 10]
+    assert sum(backend.requests[2:]) == 40
+
+
+def test_retries_wait_for_a_slot(monkeypatch):
+    class SlowBackend(FlakyBackend):
+        async def bulk_index(self, documents, version=None):
+            if len(self.requests) >= self.failures:
+                await asyncio.sleep(0.1)
+            return await super().bulk_index(documents, version)
+
+    backend = SlowBackend(TimeoutError("timed out"))
+    bulk = AdaptiveBulk(
+        backend, batch_size=20, concurrency=1, min_batch_size=5, base_delay=0.001
+    )
+    wait = asyncio.wait
+    wakeups = []
+
+    async def counted(*args, **kwargs):
+        wakeups.append(kwargs.get("timeout"))
+        return await wait(*args, **kwargs)
+
+    monkeypatch.setattr(asyncio, "wait", counted)
+    results = asyncio.get_event_loop().run_until_complete(bulk.index(documents(20)))
+    assert {result["status"] for result in results} == {201}
+    # the retries due while the only slot is taken don't wake the loop up
+    assert len(wakeups) <= 2 * len(backend.requests)
+
+
+def test_failed_request_not_retryable():
+    error = ValueError("bad request")
+    error.status_code = 400
+    backend = FlakyBackend(error)
+    bulk = AdaptiveBulk(backend, batch_size=10)
+    results = asyncio.get_event_loop().run_until_complete(bulk.index(documents(10)))
+    assert backend.requests == [10]
+    assert {result["status"] for result in results} == {400}
+    assert results[0]["error"] == "ValueError: bad request"
+
+
+def test_attempts_exhausted():
+    backend = FlakyBackend(TimeoutError("timed out"), failures=10)
+    bulk = AdaptiveBulk(backend, batch_size=10, max_attempts=3, base_delay=0.001)
+    results = asyncio.get_event_loop().run_until_complete(bulk.index(documents(10)))
+    # each document sent 3 times, in batches split by the jitter
+    assert sum(backend.requests) == 30
+    assert {result["status"] for result in results} == {500}
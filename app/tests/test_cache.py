@@ -0,0 +1,88 @@
+import asyncio
+import time
+
+from app.cache import LocalCache, SocketCache, get_cache, serve
+
+
+def test_local_cache():
+    loop = asyncio.get_event_loop()
+    cache = LocalCache(max_entries=2)
+    loop.run_until_complete(cache.set("a", 1, 10))
+    loop.run_until_complete(cache.set("b", {"count": 2}, 10))
+    assert loop.run_until_complete(cache.get("a")) == 1
+    loop.run_until_complete(cache.set("c", 3, 10))
+    # b was the least recently used
+    assert loop.run_until_complete(cache.get("b")) is None
+    assert not loop.run_until_complete(cache.add("a", 4, 10))
+    assert loop.run_until_complete(cache.add("d", 4, 0.01))
+    time.sleep(0.02)
+    assert loop.run_until_complete(cache.get("d")) is None
+    assert loop.run_until_complete(cache.get("a")) == 1
+
+
+def test_socket_cache(tmp_path):
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / "cache.sock")
+    server = loop.run_until_complete(serve(path))
+    first = get_cache(f"unix://{path}")
+    second = SocketCache(path)
+    assert first.shared
+    try:
+        assert loop.run_until_complete(first.set("count", {"count": 3}, 10))
+        assert loop.run_until_complete(second.get("count")) == {"count": 3}
+        assert loop.run_until_complete(first.add("lock", 1, 10))
+        assert not loop.run_until_complete(second.add("lock", 2, 10))
+    finally:
+        loop.run_until_complete(first.close())
+        loop.run_until_complete(second.close())
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+    # without server the entries are missing
+    assert loop.run_until_complete(second.get("count")) is None
+
+
+def test_socket_cache_cancelled(tmp_path):
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / "cache.sock")
+    server = loop.run_until_complete(serve(path))
+    cache = SocketCache(path)
+
+    async def run():
+        await cache.set("decision:A", {"id": "A"}, 10)
+        await cache.set("decision:B", {"id": "B"}, 10)
+        pending = asyncio.create_task(cache.get("decision:A"))
+        # cancelled once its request is written, waiting for its response
+        await asyncio.sleep(0)
+        pending.cancel()
+        try:
+            await pending
+        except asyncio.CancelledError:
+            pass
+        return await cache.get("decision:B")
+
+    try:
+        assert loop.run_until_complete(run()) == {"id": "B"}
+    finally:
+        loop.run_until_complete(cache.close())
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+
+def test_socket_cache_large_values(tmp_path):
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / "cache.sock")
+    server = loop.run_until_complete(serve(path))
+    cache = SocketCache(path, max_value_size=2**20)
+    # beyond the default limit of the lines read by asyncio
+    large = {"paragraphes": ["x" * 1000] * 100}
+    try:
+        assert loop.run_until_complete(cache.set("decision:A", large, 10))
+        assert loop.run_until_complete(cache.get("decision:A")) == large
+        larger = {"paragraphes": ["x" * 1000] * 2000}
+        assert not loop.run_until_complete(cache.set("decision:B", larger, 10))
+        assert loop.run_until_complete(cache.get("decision:B")) is None
+        assert loop.run_until_complete(cache.get("decision:A")) == large
+    finally:
+        loop.run_until_complete(cache.close())
+        server.close()
+        loop.run_until_complete(server.wait_closed())
@@ -0,0 +1,103 @@
+import asyncio
+import os
+
+import pytest
+
+from app.backends import BACKENDS
+from app.compact import CompactParagraphs
+from app.indexer import Indexer
+from app.legifrance.files import get_files
+from app.legifrance.parser import Parser
+from app.model import CompactDecision
+from app.services.decision import DecisionService
+
+from .fixtures import new_backend, parser, DATA_DIR
+
+
+def test_compact_paragraphs():
+    nested = [["a", "bc"], [], ["", "d\ne"], ["fgh"]]
+    compact = CompactParagraphs.from_nested(nested)
+    assert compact.text == "a\nbc\n\nd\ne\nfgh"
+    assert compact.paragraphs == [2, 2, 4, 5]
+    assert compact.nested() == nested
+    assert len(compact) == 4
+    for part in (
+        slice(0, 2),
+        slice(1, None),
+        slice(None, 1),
+        slice(2, 3),
+        slice(3, 1),
+        slice(50, 60),
+        slice(-2, None),
+    ):
+        assert compact.nested(part) == nested[part]
+        assert compact.part(part).nested() == nested[part]
+    assert CompactParagraphs.from_nested([]).nested() == []
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_compact_decisions(name, tmp_path, parser):
+    loop = asyncio.get_event_loop()
+    backend = new_backend(name, str(tmp_path))
+    loop.run_until_complete(backend.setup())
+    parsers = [
+        Parser.from_file(path)
+        for path in get_files(os.path.join(DATA_DIR, "full_tree"))
+    ][:10]
+    service = DecisionService(backend.index, backend)
+    try:
+        loop.run_until_complete(
+            Indexer(backend.index, backend, compact=True).bulk_index(parsers)
+        )
+        # the layouts can be mixed in an index
+        loop.run_until_complete(Indexer(backend.index, backend).index_doc(parser))
+        loop.run_until_complete(backend.refresh())
+        for source in (parsers[0], parser):
+            prepared = Indexer.prepare_document(source)
+            decision, version = loop.run_until_complete(
+                service.get_decision_version(source.identifier)
+            )
+            assert decision.paragraphes == source.paragraphes
+            assert version == prepared["content_hash"]
+            compact, compact_version = loop.run_until_complete(
+                service.get_decision_version(source.identifier, compact=True)
+            )
+            assert isinstance(compact, CompactDecision)
+            assert compact_version == version
+            paragraphes = compact.paragraphes
+            assert (
+                CompactParagraphs(
+                    paragraphes.text, paragraphes.lines, paragraphes.paragraphs
+                ).nested()
+                == source.paragraphes
+            )
+            for paragraphs in (slice(0, 2), slice(1, None), slice(50, 60)):
+                part, _ = loop.run_until_complete(
+                    service.get_decision_part(
+                        source.identifier, ["paragraphes"], paragraphs
+                    )
+                )
+                assert part == {"paragraphes": source.paragraphes[paragraphs]}
+                part, _ = loop.run_until_complete(
+                    service.get_decision_part(
+                        source.identifier, ["paragraphes"], paragraphs, compact=True
+                    )
+                )
+                expected = CompactParagraphs.from_nested(source.paragraphes[paragraphs])
+                assert part["paragraphes"] == {
+                    "text": expected.text,
+                    "lines": expected.lines,
+                    "paragraphs": expected.paragraphs,
+                }
+
+        async def search(query):
+            return [
+                summary.identifier
+                async for _, summary in service.fulltext_search(query)
+            ]
+
+        found = loop.run_until_complete(search("cassation"))
+        assert parsers[0].identifier in found
+        assert parser.identifier in found
+    finally:
+        loop.run_until_complete(backend.drop())
@@ -1,36 +1,40 @@
 import asyncio
+from datetime import date, timedelta
 import os
 from pprint import pprint
-from random import randint
 
 import pytest
 from pytest import fixture
 
-from app.es import get_client
+from app.backends import BACKENDS
 from app.legifrance.parser import Parser
 from app.legifrance.files import get_files
 from app.indexer import Indexer
 
-from app.services.decision import DecisionService
+from app.cache import SocketCache, serve
+from app.indexer import content_hash
+from app.model import SearchQuery
+from app.services.decision import BACKEND_LATENCY, CACHE_LOOKUPS, DecisionService
+from app.services.summaries import SummaryStore
 
-from .fixtures import client, parser, DATA_DIR
+from .fixtures import new_backend, parser, DATA_DIR
 
 
-@fixture(scope="session")
-def indexer(client):
-    index = "test-" + "".join(chr(randint(97, 122)) for _ in range(10))
-    print(f"create {index} index")
-    # create a dummy document to have something to delete when test went wrong
-    client.index(index=index, document={"test": "index"}, id=1)
-    print(f"{index} created")
-    yield Indexer(index)
-    print(f"delete {index} index")
-    client.indices.delete(index=index)
-    print(f"{index} deleted")
+@fixture(scope="session", params=BACKENDS)
+def indexer(request, tmp_path_factory):
+    backend = new_backend(request.param, str(tmp_path_factory.mktemp("data")))
+    loop = asyncio.get_event_loop()
+    print(f"create {backend.index} index")
+    loop.run_until_complete(backend.setup())
+    print(f"{backend.index} created")
+    yield Indexer(backend.index, backend)
+    print(f"delete {backend.index} index")
+    loop.run_until_complete(backend.drop())
+    print(f"{backend.index} deleted")
 
 
 @fixture(scope="module")
-def with_data(indexer, parser, client):
+def with_data(indexer, parser):
     parsers = [
         Parser.from_file(path)
         for path in get_files(os.path.join(DATA_DIR, "full_tree"))
@@ -39,13 +43,12 @@ def with_data(indexer, parser, client):
     assert len(jobs) == 92
     loop = asyncio.get_event_loop()
     results = loop.run_until_complete(asyncio.gather(*jobs))
-    client.delete(index=indexer.index, id=1)
-    client.indices.refresh(index=indexer.index)
+    loop.run_until_complete(indexer.backend.refresh())
 
 
 @fixture(scope="session")
 def service(indexer):
-    yield DecisionService(indexer.index)
+    yield DecisionService(indexer.index, indexer.backend)
 
 
 @pytest.mark.usefixtures("with_data")
@@ -322,3 +325,337 @@ def test_fulltext_search(service):
     assert "accident" in content
     assert "gendarmerie" in content
     assert "audi" in content
+
+
+@pytest.mark.usefixtures("with_data")
+def test_get_citing(service):
+    loop = asyncio.get_event_loop()
+    target = "article 2224 du code civil"
+    assert loop.run_until_complete(service.count_citing(target)) == 2
+    gen = service.get_citing(target)
+    res = []
+    while True:
+        try:
+            res.append(loop.run_until_complete(gen.__anext__()))
+        except StopAsyncIteration:
+            break
+    assert len(res) == 2
+    for dec in res:
+        citations = loop.run_until_complete(service.get_citations(dec.identifier))
+        assert target in citations.cites
+
+
+@pytest.mark.usefixtures("with_data")
+def test_get_citations(service):
+    loop = asyncio.get_event_loop()
+    citations = loop.run_until_complete(service.get_citations("JURITEXT000048211087"))
+    assert citations.identifier == "JURITEXT000048211087"
+    assert citations.cites == [
+        "article l. 113-1 du code des assurances",
+        "article 1131 du code civil",
+    ]
+    assert citations.cited_by_count == 0
+    assert (
+        loop.run_until_complete(service.get_citations("JURITEXT000042430356")) is None
+    )
+
+
+@pytest.mark.usefixtures("with_data")
+def test_walk_summary_pages(service):
+    loop = asyncio.get_event_loop()
+
+    def get_page(cursor, size):
+        gen = service.get_summary(cursor, size)
+        res = []
+        while True:
+            try:
+                res.append(loop.run_until_complete(gen.__anext__()).identifier)
+            except StopAsyncIteration:
+                return res
+
+    expected = get_page(0, 92)
+    pages = []
+    for cursor in range(0, 92, 7):
+        pages += get_page(cursor, 7)
+    assert pages == expected
+    # going back to a page already served
+    assert get_page(14, 7) == expected[14:21]
+
+
+@pytest.mark.usefixtures("with_data")
+def test_summary_store(indexer, service):
+    loop = asyncio.get_event_loop()
+
+    def get_all(service, court=None):
+        if court:
+            gen = service.get_summary_for_court(court, 0, 100)
+        else:
+            gen = service.get_summary(0, 100)
+        res = []
+        while True:
+            try:
+                res.append(loop.run_until_complete(gen.__anext__()))
+            except StopAsyncIteration:
+                return res
+
+    stored = DecisionService(indexer.index, indexer.backend)
+    loop.run_until_complete(stored.load_summaries())
+    store = stored.summary_store
+    assert len(store) == 92
+    dates = [store.date(position) for position in range(len(store))]
+    assert dates == sorted(dates)
+    assert loop.run_until_complete(stored.count) == 92
+    assert store.summaries(None, -10, 5) == store.summaries(None, 0, 5)
+    summaries = get_all(stored)
+    assert sorted(s.identifier for s in summaries) == sorted(
+        s.identifier for s in get_all(service)
+    )
+    for court in ("CHAMBRE_SOCIALE", "chambre_civile_2"):
+        expected = loop.run_until_complete(service.count_court(court))
+        assert loop.run_until_complete(stored.count_court(court)) == expected
+        assert len(get_all(stored, court)) == expected
+        assert sorted(get_all(stored, court), key=lambda s: s.identifier) == sorted(
+            get_all(service, court), key=lambda s: s.identifier
+        )
+
+    assert not loop.run_until_complete(stored.refresh_summaries())
+    generation = loop.run_until_complete(indexer.new_generation())
+    assert loop.run_until_complete(stored.refresh_summaries())
+    assert stored.summary_store is not store
+    assert stored.summary_store.generation == generation
+    # loaded by the refresh when their first load failed
+    unloaded = DecisionService(indexer.index, indexer.backend)
+    assert loop.run_until_complete(unloaded.refresh_summaries())
+    assert unloaded.summary_store.generation == generation
+    assert not loop.run_until_complete(unloaded.refresh_summaries())
+
+
+@pytest.mark.usefixtures("with_data")
+def test_summary_snapshot(indexer, tmp_path):
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / "summaries.bin")
+    store = loop.run_until_complete(SummaryStore.load(indexer.backend))
+    store.write(path)
+    snapshot = SummaryStore.open(path)
+    assert snapshot.generation == store.generation
+    assert len(snapshot) == len(store) == 92
+    assert snapshot.chambres == store.chambres
+    assert snapshot.summaries(size=100) == store.summaries(size=100)
+    for court in store.chambres:
+        assert snapshot.count(court) == store.count(court)
+        assert snapshot.summaries(court, 2, 5) == store.summaries(court, 2, 5)
+    assert snapshot.date(91) == store.date(91)
+
+    stored = DecisionService(indexer.index, indexer.backend)
+    loop.run_until_complete(stored.load_summaries(path))
+    assert stored.summary_store.generation == store.generation
+    assert not loop.run_until_complete(stored.refresh_summaries())
+    # the snapshot is not written yet for the new generation
+    generation = loop.run_until_complete(indexer.new_generation())
+    assert loop.run_until_complete(stored.refresh_summaries())
+    assert stored.summary_store.generation == generation
+    # the snapshot of the next generation is written before it is set
+    generation = Indexer.next_generation()
+    loop.run_until_complete(
+        SummaryStore.load(indexer.backend, generation=generation)
+    ).write(path)
+    assert not loop.run_until_complete(stored.refresh_summaries())
+    loop.run_until_complete(indexer.new_generation(generation))
+    assert loop.run_until_complete(stored.refresh_summaries())
+    assert stored.summary_store.generation == generation
+    assert stored.summary_store.summaries(size=100) == store.summaries(size=100)
+    with open(path, "r+b") as f:
+        f.write(b"NOTASNAP")
+    with pytest.raises(ValueError):
+        SummaryStore.open(path)
+
+
+@pytest.mark.usefixtures("with_data")
+def test_shared_counts(indexer, tmp_path):
+    loop = asyncio.get_event_loop()
+    path = str(tmp_path / "cache.sock")
+    server = loop.run_until_complete(serve(path))
+    workers = [
+        DecisionService(indexer.index, indexer.backend, SocketCache(path))
+        for _ in range(2)
+    ]
+    first, second = workers
+    try:
+        assert loop.run_until_complete(first.count) == 92
+        assert loop.run_until_complete(first.count_court("CHAMBRE_SOCIALE")) > 0
+        hits = CACHE_LOOKUPS.value(cache="count", result="hit")
+        assert loop.run_until_complete(second.count) == 92
+        assert CACHE_LOOKUPS.value(cache="count", result="hit") == hits + 1
+        # nothing close to expire
+        assert loop.run_until_complete(first.refresh_counts()) == []
+        for worker in workers:
+            worker.REFRESH_AHEAD = 0
+        refreshed = loop.run_until_complete(first.refresh_counts())
+        assert sorted(refreshed, key=str) == [None, "chambre_sociale"]
+        # the other worker leaves them to the first one
+        loop.run_until_complete(second.count_court("CHAMBRE_SOCIALE"))
+        assert loop.run_until_complete(second.refresh_counts()) == []
+
+        decision = loop.run_until_complete(first.get_decision("JURITEXT000048430356"))
+        misses = CACHE_LOOKUPS.value(cache="decision", result="miss")
+        assert loop.run_until_complete(second.get_decision(decision.identifier)) == (
+            decision
+        )
+        assert CACHE_LOOKUPS.value(cache="decision", result="miss") == misses
+    finally:
+        for worker in workers:
+            loop.run_until_complete(worker.cache.close())
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+
+@pytest.mark.usefixtures("with_data")
+def test_stale_counts(indexer):
+    loop = asyncio.get_event_loop()
+    service = DecisionService(indexer.index, indexer.backend)
+
+    def fetched():
+        return BACKEND_LATENCY.count(operation="count")
+
+    before = fetched()
+    counts = loop.run_until_complete(
+        asyncio.gather(*(service.count_court("chambre_sociale") for _ in range(10)))
+    )
+    assert len(set(counts)) == 1
+    # the concurrent misses waited for the same request
+    assert fetched() == before + 1
+
+    service.KEEP = timedelta(0)
+    stale = CACHE_LOOKUPS.value(cache="count_court", result="stale")
+    counts = loop.run_until_complete(
+        asyncio.gather(*(service.count_court("CHAMBRE_SOCIALE") for _ in range(10)))
+    )
+    assert set(counts) == {counts[0]}
+    assert CACHE_LOOKUPS.value(cache="count_court", result="stale") == stale + 10
+    loop.run_until_complete(asyncio.gather(*service._fetching.values()))
+    assert fetched() == before + 2
+
+    warmed = DecisionService(indexer.index, indexer.backend)
+    by_court = loop.run_until_complete(warmed.warm_counts())
+    assert sum(by_court.values()) == 92
+    hits = CACHE_LOOKUPS.value(cache="count_court", result="hit")
+    for court, count in by_court.items():
+        assert loop.run_until_complete(warmed.count_court(court)) == count
+    assert loop.run_until_complete(warmed.count) == 92
+    assert CACHE_LOOKUPS.value(cache="count_court", result="hit") == hits + len(
+        by_court
+    )
+
+
+@pytest.mark.usefixtures("with_data")
+def test_decision_version(indexer):
+    loop = asyncio.get_event_loop()
+    service = DecisionService(indexer.index, indexer.backend)
+    identifier = "JURITEXT000048430356"
+    decision, version = loop.run_until_complete(
+        service.get_decision_version(identifier)
+    )
+    assert decision.identifier == identifier
+    assert version == loop.run_until_complete(service.get_version(identifier))
+    assert version == content_hash(dict(decision))
+    assert loop.run_until_complete(service.get_version("JURITEXT000042430356")) is None
+    assert loop.run_until_complete(
+        service.get_decision_version("JURITEXT000042430356")
+    ) == (None, None)
+
+    generation = loop.run_until_complete(indexer.new_generation())
+    assert loop.run_until_complete(service.generation()) == generation
+
+
+@pytest.mark.usefixtures("with_data")
+def test_decision_part(service):
+    loop = asyncio.get_event_loop()
+    identifier = "JURITEXT000048430356"
+    decision, version = loop.run_until_complete(
+        service.get_decision_version(identifier)
+    )
+    part, part_version = loop.run_until_complete(
+        service.get_decision_part(identifier, ["title", "numero"])
+    )
+    assert part == {"title": decision.title, "numero": decision.numero}
+    assert part_version == version
+    for paragraphs in (slice(0, 2), slice(1, None), slice(None, 1), slice(50, 60)):
+        part, _ = loop.run_until_complete(
+            service.get_decision_part(identifier, paragraphs=paragraphs)
+        )
+        assert part["paragraphes"] == decision.paragraphes[paragraphs]
+        assert part["title"] == decision.title
+    assert loop.run_until_complete(
+        service.get_decision_part("JURITEXT000042430356", ["title"])
+    ) == (None, None)
+
+
+@pytest.mark.usefixtures("with_data")
+def test_fulltext_search_dates(indexer, service):
+    loop = asyncio.get_event_loop()
+
+    def search(**dates):
+        async def collect():
+            return [
+                summary.identifier
+                async for _, summary in service.fulltext_search("cassation", **dates)
+            ]
+
+        found = loop.run_until_complete(collect())
+        return {
+            identifier: date.fromisoformat(
+                loop.run_until_complete(indexer.backend.get(identifier))["date"][:10]
+            )
+            for identifier in found
+        }
+
+    found = search()
+    middle = sorted(found.values())[len(found) // 2]
+    since = search(since=middle)
+    assert since and all(value >= middle for value in since.values())
+    until = search(until=middle - timedelta(days=1))
+    assert until and all(value < middle for value in until.values())
+    assert search(since=date(2024, 1, 1)) == {}
+    assert search(since=middle, until=middle - timedelta(days=1)) == {}
+
+
+@pytest.mark.usefixtures("with_data")
+def test_search_batch(service):
+    loop = asyncio.get_event_loop()
+    queries = [
+        SearchQuery(query="accident gendarmerie audi"),
+        SearchQuery(query="cassation", size=3),
+        SearchQuery(query="cassation", since=date(2024, 1, 1)),
+    ]
+    results = loop.run_until_complete(service.search_batch(queries, concurrency=2))
+    assert [len(result["results"]) for result in results] == [6, 3, 0]
+    assert all(result["took"] is not None for result in results)
+
+    async def search(query):
+        return [
+            summary.identifier
+            async for _, summary in service.fulltext_search(query.query)
+        ]
+
+    # as many results as the separate searches, in the same order
+    for query, result in list(zip(queries, results))[:2]:
+        expected = loop.run_until_complete(search(query))[: query.size]
+        assert [summary.identifier for _, summary in result["results"]] == expected
+
+
+@pytest.mark.usefixtures("with_data")
+def test_prefetch(indexer):
+    loop = asyncio.get_event_loop()
+    service = DecisionService(indexer.index, indexer.backend)
+    loop.run_until_complete(indexer.backend.connect(2))
+    try:
+        identifiers = ["JURITEXT000048430356", "JURITEXT000042430356"]
+        assert loop.run_until_complete(service.prefetch(identifiers)) == 1
+        hits = CACHE_LOOKUPS.value(cache="decision", result="hit")
+        fetched = BACKEND_LATENCY.count(operation="get")
+        decision = loop.run_until_complete(service.get_decision(identifiers[0]))
+        assert decision.identifier == identifiers[0]
+        assert CACHE_LOOKUPS.value(cache="decision", result="hit") == hits + 1
+        assert BACKEND_LATENCY.count(operation="get") == fetched
+    finally:
+        loop.run_until_complete(indexer.backend.close())
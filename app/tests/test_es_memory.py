@@ -0,0 +1,154 @@
+import asyncio
+from datetime import date
+import subprocess
+import sys
+import time
+
+import elasticsearch
+import pytest
+from pytest import fixture
+
+from app.es_memory import AsyncMemoryElasticsearch, MemoryElasticsearch
+
+
+DOCS = [
+    {"identifier": "a", "date": date(2023, 3, 1), "text": "L'arrêt est cassé"},
+    {"identifier": "b", "date": date(2021, 1, 5), "text": "rejet du pourvoi"},
+    {"identifier": "c", "date": date(2022, 7, 9), "text": "cassation, arrêt cassé"},
+]
+
+
+@fixture
+def es():
+    client = MemoryElasticsearch("memory://test-es-memory")
+    client.indices.create(
+        index="docs", mappings={"properties": {"tag": {"type": "keyword"}}}
+    )
+    client.bulk(
+        operations=[
+            op
+            for doc in DOCS
+            for op in ({"index": {"_index": "docs", "_id": doc["identifier"]}}, doc)
+        ]
+    )
+    yield client
+    client.indices.delete(index="docs")
+
+
+def test_index_and_get(es):
+    resp = es.index(index="docs", id="a", document=DOCS[0])
+    assert resp.meta.status == 200
+    assert resp["result"] == "updated"
+    source = es.get(index="docs", id="a")["_source"]
+    assert source["date"] == "2023-03-01"
+    assert es.get(index="docs", id="a", source_includes=["date"])["_source"] == {
+        "date": "2023-03-01"
+    }
+    with pytest.raises(elasticsearch.NotFoundError):
+        es.get(index="docs", id="z")
+    docs = es.mget(index="docs", ids=["b", "z"])["docs"]
+    assert [doc["found"] for doc in docs] == [True, False]
+
+
+def test_bulk_errors(es):
+    resp = es.bulk(
+        operations=[
+            {"update": {"_index": "docs", "_id": "z"}},
+            {"doc": {"tag": "x"}},
+            {"update": {"_index": "docs", "_id": "a"}},
+            {"doc": {"tag": "x"}},
+        ]
+    )
+    assert resp["errors"]
+    assert [item["update"]["status"] for item in resp["items"]] == [404, 200]
+    assert es.count(index="docs", query={"term": {"tag": "x"}})["count"] == 1
+
+
+def test_match(es):
+    resp = es.search(index="docs", query={"match": {"text": "arrêt cassé"}})
+    hits = resp["hits"]["hits"]
+    assert resp["hits"]["total"]["value"] == 2
+    assert [hit["_id"] for hit in hits] == ["c", "a"]
+    assert hits[0]["_score"] > hits[1]["_score"] > 0
+    # apostrophes are kept in the tokens as the standard analyzer does
+    assert es.count(index="docs", query={"match": {"text": "arrêt"}})["count"] == 1
+
+
+def test_sort_and_pages(es):
+    sort = [{"date": {"order": "asc", "format": "strict_date"}}]
+    resp = es.search(
+        index="docs", sort=sort, size=2, fields=["identifier"], _source=False
+    )
+    hits = resp["hits"]["hits"]
+    assert [hit["fields"]["identifier"] for hit in hits] == [["b"], ["c"]]
+    assert hits[-1]["sort"] == ["2022-07-09"]
+    assert "_source" not in hits[0]
+    after = es.search(index="docs", sort=sort, size=2, search_after=hits[-1]["sort"])
+    assert [hit["_id"] for hit in after["hits"]["hits"]] == ["a"]
+    resp = es.search(index="docs", sort=sort, from_=1, size=1)
+    assert [hit["_id"] for hit in resp["hits"]["hits"]] == ["c"]
+
+
+def test_range(es):
+    query = {"range": {"date": {"gte": "2022-01-01"}}}
+    assert es.count(index="docs", query=query)["count"] == 2
+
+
+def test_msearch(es):
+    resp = es.msearch(
+        searches=[
+            {"index": "docs"},
+            {"query": {"match": {"text": "cassé"}}, "_source": False},
+            {"index": "missing"},
+            {"query": {"match_all": {}}},
+            {"index": "missing", "ignore_unavailable": True},
+            {"query": {"match_all": {}}},
+        ]
+    )
+    first, missing, ignored = resp["responses"]
+    assert [hit["_id"] for hit in first["hits"]["hits"]] == ["a", "c"]
+    assert missing["status"] == 404
+    assert missing["error"]["type"] == "index_not_found_exception"
+    assert ignored["hits"]["hits"] == []
+
+
+def test_latency():
+    client = AsyncMemoryElasticsearch("memory://test-es-memory?latency=0.02&jitter=0")
+    loop = asyncio.get_event_loop()
+    start = time.perf_counter()
+    resp = loop.run_until_complete(client.count(index="*"))
+    assert time.perf_counter() - start >= 0.02
+    assert resp.meta.duration >= 0.02
+
+
+def test_bulk_rejections():
+    client = AsyncMemoryElasticsearch("memory://test-es-memory?latency=0.02&capacity=3")
+    loop = asyncio.get_event_loop()
+    operations = []
+    for id in "abcd":
+        operations += [{"index": {"_index": "rejected", "_id": id}}, {"tag": id}]
+
+    async def concurrent_bulks():
+        return await asyncio.gather(
+            client.bulk(operations=operations[:4]),
+            client.bulk(operations=operations[4:]),
+        )
+
+    first, second = loop.run_until_complete(concurrent_bulks())
+    statuses = [item["index"]["status"] for item in first["items"] + second["items"]]
+    # the second request comes while the first holds 2 of the 3 slots
+    assert statuses == [201, 201, 201, 429]
+    assert second["errors"]
+    assert client.store.bulk_items == 0
+    resp = loop.run_until_complete(client.bulk(operations=operations[6:]))
+    assert resp["items"][0]["index"]["status"] == 201
+    loop.run_until_complete(client.indices.delete(index="rejected"))
+
+
+def test_loaded_when_used():
+    # the pool module of production doesn't load the stand-in
+    code = "import sys, app.es; print('app.es_memory' in sys.modules)"
+    result = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert result.stdout.strip() == "False"
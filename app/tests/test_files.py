@@ -0,0 +1,30 @@
+import os
+import shutil
+
+from app.legifrance.files import get_files, validate
+
+from .fixtures import DATA_DIR
+
+
+def test_get_files():
+    files = list(get_files(os.path.join(DATA_DIR, "full_tree")))
+    assert len(files) == 92
+    assert all(fpath.endswith(".xml") for fpath in files)
+
+
+def test_validate(tmp_path):
+    tree = tmp_path / "tree"
+    shutil.copytree(os.path.join(DATA_DIR, "full_tree"), tree)
+    (tree / "broken.xml").write_text("<TEXTE_JURI_JUDI><META>")
+    (tree / "empty.xml").write_text("")
+    (tree / "notes.txt").write_text("not a document")
+    report, failed = validate([str(tree)], workers=2, samples=1)
+    assert report["processed"] == 94
+    assert report["valid"] == 92
+    assert report["invalid"] == 2
+    assert sorted(failed) == [str(tree / "broken.xml"), str(tree / "empty.xml")]
+    assert list(report["errors"]) == ["xml.parsers.expat.ExpatError"]
+    error = report["errors"]["xml.parsers.expat.ExpatError"]
+    assert error["count"] == 2
+    assert len(error["samples"]) == 1
+    assert report["parse_ms"]["p50"] <= report["parse_ms"]["p100"]
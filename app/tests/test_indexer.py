@@ -1,29 +1,32 @@
 import asyncio
+from datetime import date, datetime
 import os
 from pprint import pprint
-from random import randint
 
+from pydantic import ValidationError
+import pytest
 from pytest import fixture
 
+from app.backends import BACKENDS
 from app.es import get_client
 from app.legifrance.files import get_files
 from app.legifrance.parser import Parser
-from app.indexer import Indexer
+from app.indexer import Indexer, content_hash
 
-from .fixtures import client, parser, DATA_DIR
+from .fixtures import new_backend, parser, DATA_DIR
 
 
-@fixture(scope="function")
-def indexer(client):
-    index = "test-" + "".join(chr(randint(97, 122)) for _ in range(10))
-    print(f"create {index} index")
-    # create a dummy document to have something to delete when test went wrong
-    client.index(index=index, document={"test": "index"})
-    print(f"{index} created")
-    yield Indexer(index)
-    print(f"delete {index} index")
-    client.indices.delete(index=index)
-    print(f"{index} deleted")
+@fixture(scope="function", params=BACKENDS)
+def indexer(request, tmp_path):
+    backend = new_backend(request.param, str(tmp_path))
+    loop = asyncio.get_event_loop()
+    print(f"create {backend.index} index")
+    loop.run_until_complete(backend.setup())
+    print(f"{backend.index} created")
+    yield Indexer(backend.index, backend)
+    print(f"delete {backend.index} index")
+    loop.run_until_complete(backend.drop())
+    print(f"{backend.index} deleted")
 
 
 def test_data_dir():
@@ -49,18 +52,35 @@ def test_prepare_doc(parser):
     assert doc["paragraphes"] == parser.paragraphes
     assert "paragraphes" in doc
     assert doc["code_chambre"] == parser.code_chambre
+    assert "cites" in doc
+    assert doc["cites"] == Indexer.citation_targets(parser)
+    assert doc["content_hash"] == content_hash({**doc, "cites": []})
+    assert doc["content_hash"] != content_hash({**doc, "title": "other"})
+
+
+def test_validate_document(parser):
+    doc = Indexer.prepare_document(parser)
+    Indexer.validate_document(doc)
+    with pytest.raises(ValidationError):
+        Indexer.validate_document({**doc, "paragraphes": [None]})
+
+
+def test_citation_targets(parser):
+    assert Indexer.citation_targets(parser) == [
+        "article l. 113-1 du code des assurances",
+        "article 1131 du code civil",
+    ]
 
 
-def test_index_doc(indexer, parser, client):
+def test_index_doc(indexer, parser):
     loop = asyncio.get_event_loop()
     resp = loop.run_until_complete(indexer.index_doc(parser))
-    pprint(dict(resp))
-    assert resp.meta.status == 201
+    pprint(resp)
+    assert resp["status"] == 201
     assert resp["result"] == "created"
-    resp = client.get(index=indexer.index, id=parser.identifier)
-    assert resp.meta.status == 200
-    pprint(dict(resp.body))
-    doc = resp.body["_source"]
+    doc = loop.run_until_complete(indexer.backend.get(parser.identifier))
+    assert doc is not None
+    pprint(doc)
     assert "identifier" in doc
     assert doc["identifier"] == parser.identifier
     assert "numero" in doc
@@ -79,21 +99,11 @@ def test_index_doc(indexer, parser, client):
     assert doc["paragraphes"] == parser.paragraphes
 
 
-def test_bulk_index(indexer, client):
-    parsers = [
-        Parser.from_file(path)
-        for path in get_files(os.path.join(DATA_DIR, "full_tree"))
-    ]
-    jobs = [indexer.index_doc(parser) for parser in parsers]
-    assert len(jobs) == 92
+def check_indexed(indexer, parsers):
     loop = asyncio.get_event_loop()
-    results = loop.run_until_complete(asyncio.gather(*jobs))
-    for result in results:
-        assert result.meta.status == 201
     for parser in parsers:
-        resp = client.get(index=indexer.index, id=parser.identifier)
-        assert resp.meta.status == 200
-        doc = resp.body["_source"]
+        doc = loop.run_until_complete(indexer.backend.get(parser.identifier))
+        assert doc is not None
         assert "identifier" in doc
         assert doc["identifier"] == parser.identifier
         assert "numero" in doc
@@ -111,9 +121,155 @@ def test_bulk_index(indexer, client):
         assert "paragraphes" in doc
         assert doc["paragraphes"] == parser.paragraphes
 
-    client.indices.refresh(index=indexer.index)
-    resp = client.count(
-        index=indexer.index, query={"prefix": {"identifier": {"value": "juritext"}}}
+    loop.run_until_complete(indexer.backend.refresh())
+    count = loop.run_until_complete(indexer.backend.count())
+    assert count == len(parsers)
+
+
+def test_bulk_index(indexer):
+    parsers = [
+        Parser.from_file(path)
+        for path in get_files(os.path.join(DATA_DIR, "full_tree"))
+    ]
+    jobs = [indexer.index_doc(parser) for parser in parsers]
+    assert len(jobs) == 92
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(asyncio.gather(*jobs))
+    for result in results:
+        assert result["status"] == 201
+    check_indexed(indexer, parsers)
+
+
+def test_bulk_index_at_once(indexer):
+    parsers = [
+        Parser.from_file(path)
+        for path in get_files(os.path.join(DATA_DIR, "full_tree"))
+    ]
+    loop = asyncio.get_event_loop()
+    results = loop.run_until_complete(indexer.bulk_index(parsers))
+    assert len(results) == 92
+    for result in results:
+        assert result["status"] == 201
+    results = loop.run_until_complete(indexer.bulk_index(parsers[:10]))
+    for result in results:
+        assert result["status"] == 200
+        assert result["result"] == "updated"
+    check_indexed(indexer, parsers)
+
+
+def test_index_versions(indexer, parser):
+    loop = asyncio.get_event_loop()
+    later = Indexer.prepare_document(parser)
+    older = {**later, "title": "older title"}
+    results = loop.run_until_complete(indexer.index_documents([later], version=2))
+    assert results[0]["status"] == 201
+    # an older archive loaded afterwards doesn't replace the document
+    results = loop.run_until_complete(indexer.index_documents([older], version=1))
+    assert results[0]["result"] == "noop"
+    loop.run_until_complete(indexer.backend.refresh())
+    stored = loop.run_until_complete(indexer.backend.get(parser.identifier))
+    assert stored["title"] == later["title"]
+    results = loop.run_until_complete(indexer.index_documents([older], version=3))
+    assert results[0]["result"] == "updated"
+
+
+def test_yearly_indices(tmp_path, parser):
+    backend = new_backend("elasticsearch-yearly", str(tmp_path))
+    name = backend.index
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backend.setup())
+    document = Indexer.prepare_document(parser)
+    older = {**document, "identifier": "JURITEXT000000000002"}
+    older["date"] = datetime(2019, 5, 2)
+    loop.run_until_complete(backend.bulk_index([document, older]))
+    client = get_client()
+    try:
+        indices = set(client.indices.get_alias(name=name).body)
+        assert indices == {
+            f"{name}-2019",
+            f"{name}-{parser.date.year}",
+            f"{name}-{date.today().year}",
+        }
+        assert loop.run_until_complete(backend.count()) == 2
+        assert loop.run_until_complete(backend.get(older["identifier"]))
+        assert backend._search_indices(date(2018, 3, 1), date(2019, 12, 31)) == (
+            f"{name}-2018,{name}-2019"
+        )
+        found = loop.run_until_complete(
+            backend.search("cassation", since=date(2018, 3, 1), until=date(2019, 1, 1))
+        )
+        assert found == []
+        found = loop.run_until_complete(
+            backend.search("cassation", since=date(2018, 3, 1), until=date(2019, 12, 1))
+        )
+        assert [summary["identifier"] for _, summary in found] == [older["identifier"]]
+    finally:
+        loop.run_until_complete(backend.drop())
+    assert not client.indices.exists(index=f"{name}-*")
+    client.close()
+
+
+def test_yearly_versions(tmp_path, parser):
+    backend = new_backend("elasticsearch-yearly", str(tmp_path))
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(backend.setup())
+    later = Indexer.prepare_document(parser)
+    # the older archive dates the decision in another year
+    older = {**later, "title": "older title", "date": datetime(2019, 5, 2)}
+    try:
+        loop.run_until_complete(backend.bulk_index([later], version=2))
+        results = loop.run_until_complete(backend.bulk_index([older], version=1))
+        assert results[0]["result"] == "noop"
+        loop.run_until_complete(backend.refresh())
+        assert loop.run_until_complete(backend.count()) == 1
+        stored = loop.run_until_complete(backend.get(parser.identifier))
+        assert stored["title"] == later["title"]
+        # a later archive moves it to the index of its year
+        loop.run_until_complete(backend.bulk_index([older], version=3))
+        loop.run_until_complete(backend.refresh())
+        assert loop.run_until_complete(backend.count()) == 1
+        stored = loop.run_until_complete(backend.get(parser.identifier))
+        assert stored["title"] == older["title"]
+    finally:
+        loop.run_until_complete(backend.drop())
+
+
+def test_update_citation_counts(indexer, parser):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(indexer.index_doc(parser))
+    loop.run_until_complete(
+        indexer.backend.put(
+            "JURITEXT000000000001",
+            {"identifier": "JURITEXT000000000001", "cites": [parser.identifier]},
+        )
+    )
+    counts = loop.run_until_complete(indexer.update_citation_counts())
+    assert counts == {parser.identifier: 1}
+    doc = loop.run_until_complete(indexer.backend.get(parser.identifier))
+    assert doc["cited_by_count"] == 1
+    # no longer cited
+    loop.run_until_complete(
+        indexer.backend.put(
+            "JURITEXT000000000001", {"identifier": "JURITEXT000000000001", "cites": []}
+        )
     )
-    pprint(dict(resp))
-    assert resp["count"] == 92
+    loop.run_until_complete(indexer.backend.refresh())
+    assert loop.run_until_complete(indexer.update_citation_counts()) == {}
+    doc = loop.run_until_complete(indexer.backend.get(parser.identifier))
+    assert doc.get("cited_by_count", 0) == 0
+
+
+def test_search_apostrophe(indexer, parser):
+    loop = asyncio.get_event_loop()
+    document = Indexer.prepare_document(parser)
+    documents = [
+        {**document, "identifier": identifier, "paragraphes": [[line]]}
+        for identifier, line in (
+            ("JURITEXT000000000001", "la Cour casse l'arrêt attaqué"),
+            ("JURITEXT000000000002", "un arrêt de la cour d'appel"),
+        )
+    ]
+    loop.run_until_complete(indexer.index_documents(documents))
+    loop.run_until_complete(indexer.backend.refresh())
+    found = loop.run_until_complete(indexer.backend.search("l'arrêt"))
+    assert [summary["identifier"] for _, summary in found] == ["JURITEXT000000000001"]
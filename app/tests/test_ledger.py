@@ -0,0 +1,72 @@
+from app.ledger import Ledger
+
+
+def test_claim_and_complete(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    ledger = Ledger(path)
+    other = Ledger(path)
+    ledger.add(["CASS_20240108.tar.gz", "CASS_20240101.tar.gz"])
+    other.add(["CASS_20240101.tar.gz"])
+    # the oldest archive first
+    assert ledger.claim("a", ttl=60) == "CASS_20240101.tar.gz"
+    assert other.claim("b", ttl=60) == "CASS_20240108.tar.gz"
+    assert other.claim("b", ttl=60) is None
+    assert ledger.renew("CASS_20240101.tar.gz", "a", ttl=60)
+    assert not ledger.renew("CASS_20240101.tar.gz", "b", ttl=60)
+    assert ledger.complete("CASS_20240101.tar.gz", "a", {"20240101": {"created": 3}})
+    assert not ledger.finish("a")
+    assert other.complete("CASS_20240108.tar.gz", "b", {})
+    assert ledger.remaining() == 0
+    assert ledger.finish("a")
+    assert not other.finish("b")
+    assert other.reports() == {
+        "CASS_20240101.tar.gz": {"20240101": {"created": 3}},
+        "CASS_20240108.tar.gz": {},
+    }
+
+
+def test_finish_reused(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.db"))
+    ledger.add(["CASS_20240101.tar.gz"])
+    assert ledger.complete(ledger.claim("a", ttl=60), "a", {})
+    assert ledger.finish("a")
+    # the archives known already don't start another loading
+    ledger.add(["CASS_20240101.tar.gz"])
+    assert not ledger.finish("a")
+    ledger.add(["CASS_20240108.tar.gz"])
+    assert not ledger.finish("a")
+    assert ledger.complete(ledger.claim("b", ttl=60), "b", {})
+    assert ledger.finish("b")
+
+
+def test_expired_lease_reclaimed(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.db"))
+    ledger.add(["CASS_20240101.tar.gz"])
+    # a worker crashing after its claim
+    assert ledger.claim("a", ttl=-1) == "CASS_20240101.tar.gz"
+    assert ledger.claim("b", ttl=60) == "CASS_20240101.tar.gz"
+    assert not ledger.renew("CASS_20240101.tar.gz", "a", ttl=60)
+    assert not ledger.complete("CASS_20240101.tar.gz", "a", {})
+    assert ledger.complete("CASS_20240101.tar.gz", "b", {})
+
+
+def test_failed_attempts(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.db"), max_attempts=2)
+    ledger.add(["CASS_20240101.tar.gz"])
+    for _ in range(2):
+        target = ledger.claim("a", ttl=60)
+        assert ledger.release(target, "a", "OSError boom")
+    assert ledger.claim("a", ttl=60) is None
+    assert ledger.remaining() == 0
+    assert ledger.reports() == {"CASS_20240101.tar.gz": {"error": "OSError boom"}}
+
+
+def test_expired_attempts(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.db"), max_attempts=2)
+    ledger.add(["CASS_20240101.tar.gz"])
+    # an archive crashing every worker claiming it
+    assert ledger.claim("a", ttl=-1) == "CASS_20240101.tar.gz"
+    assert ledger.claim("b", ttl=-1) == "CASS_20240101.tar.gz"
+    assert ledger.claim("c", ttl=60) is None
+    assert ledger.remaining() == 0
+    assert ledger.reports() == {"CASS_20240101.tar.gz": {"error": "lease expired"}}
@@ -0,0 +1,60 @@
+import pytest
+
+from app.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_counter():
+    registry = Registry()
+    counter = Counter("docs_total", "Documents.", ["result"], registry=registry)
+    counter.inc(result="created")
+    counter.inc(2, result="created")
+    counter.inc(result="error")
+    assert counter.value(result="created") == 3
+    assert registry.exposition().splitlines() == [
+        "# HELP docs_total Documents.",
+        "# TYPE docs_total counter",
+        'docs_total{result="created"} 3',
+        'docs_total{result="error"} 1',
+    ]
+    with pytest.raises(ValueError):
+        counter.inc(status="created")
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = Histogram(
+        "latency_seconds", "Latency.", buckets=(0.1, 1), registry=registry
+    )
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.count() == 4
+    assert registry.exposition().splitlines()[2:] == [
+        'latency_seconds_bucket{le="0.1"} 2',
+        'latency_seconds_bucket{le="1"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 3.65",
+        "latency_seconds_count 4",
+    ]
+    with histogram.time():
+        pass
+    assert histogram.count() == 5
+
+
+def test_registered_once():
+    registry = Registry()
+    Counter("docs_total", "Documents.", registry=registry)
+    with pytest.raises(ValueError):
+        Counter("docs_total", "Documents.", registry=registry)
+
+
+def test_gauge():
+    registry = Registry()
+    gauge = Gauge("batch_size", "Batch size.", registry=registry)
+    gauge.set(500)
+    gauge.set(250)
+    assert gauge.value() == 250
+    assert registry.exposition().splitlines() == [
+        "# HELP batch_size Batch size.",
+        "# TYPE batch_size gauge",
+        "batch_size 250",
+    ]
@@ -0,0 +1,160 @@
+import asyncio
+import os
+
+import pytest
+
+from app.backends import BACKENDS
+from app.backends.es import ElasticsearchBackend
+from app.indexer import Indexer
+from app.legifrance.parser import Parser
+from app.scripts.reconcile import Reconciler, sorted_entries, source_entries
+
+from .fixtures import new_backend, parser, DATA_DIR
+
+
+FULL_TREE = os.path.join(DATA_DIR, "full_tree")
+
+
+def test_sorted_entries(tmp_path):
+    entries = list(source_entries([FULL_TREE]))
+    # the same decisions in a later archive
+    later = [
+        (identifier, 20240101120000, f"CASS_20240101-120000/{identifier}.xml")
+        for identifier, _, _ in entries[:5]
+    ]
+    merged = list(sorted_entries(entries + later, run_size=10, directory=tmp_path))
+    assert [entry[0] for entry in merged] == sorted(entry[0] for entry in entries)
+    assert sorted(merged) == sorted(later + entries[5:])
+    assert not os.listdir(tmp_path)
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_reconcile(name, tmp_path, parser):
+    loop = asyncio.get_event_loop()
+    backend = new_backend(name, str(tmp_path))
+    loop.run_until_complete(backend.setup())
+    entries = sorted(source_entries([FULL_TREE]))
+    indexer = Indexer(backend.index, backend)
+    documents = [
+        Indexer.prepare_document(Parser.from_file(path)) for _, _, path in entries
+    ]
+    documents[0]["content_hash"] = "stale"
+    orphan = Indexer.prepare_document(parser)
+    orphan["identifier"] = "JURITEXT000000000001"
+    # the first 60 decisions and one without a file
+    indexed = documents[:60] + [orphan]
+
+    async def fingerprints():
+        return [
+            fingerprint async for fingerprint in backend.walk_fingerprints(batch_size=7)
+        ]
+
+    try:
+        loop.run_until_complete(indexer.index_documents(indexed))
+        loop.run_until_complete(backend.refresh())
+        walked = loop.run_until_complete(fingerprints())
+        assert walked == sorted(
+            (document["identifier"], document["content_hash"]) for document in indexed
+        )
+
+        report = loop.run_until_complete(
+            Reconciler(backend.index, backend, batch_size=7).reconcile(
+                [FULL_TREE], dry_run=True, verify=True
+            )
+        )
+        assert report["indexed"] == 61
+        assert report["source"] == len(entries)
+        assert report["orphans"] == 1
+        assert report["missing"] == len(entries) - 60
+        assert report["changed"] == 1
+        assert report["deleted"] == report["reindexed"] == 0
+        assert len(loop.run_until_complete(fingerprints())) == 61
+
+        report = loop.run_until_complete(
+            Reconciler(backend.index, backend, batch_size=7).reconcile(
+                [FULL_TREE], verify=True
+            )
+        )
+        # the orphans are only deleted when asked
+        assert report["orphans"] == 1
+        assert report["deleted"] == 0
+        assert report["reindexed"] == len(entries) - 60 + 1
+        assert report["errors"] == 0
+        loop.run_until_complete(backend.refresh())
+        assert loop.run_until_complete(backend.count()) == len(entries) + 1
+
+        report = loop.run_until_complete(
+            Reconciler(backend.index, backend, batch_size=7).reconcile(
+                [FULL_TREE], delete_orphans=True
+            )
+        )
+        assert report["orphans"] == report["deleted"] == 1
+        assert report["reindexed"] == report["errors"] == 0
+        loop.run_until_complete(backend.refresh())
+        assert loop.run_until_complete(fingerprints()) == sorted(
+            (
+                document["identifier"],
+                Indexer.prepare_document(Parser.from_file(path))["content_hash"],
+            )
+            for document, (_, _, path) in zip(documents, entries)
+        )
+        assert loop.run_until_complete(backend.count()) == len(entries)
+    finally:
+        loop.run_until_complete(backend.drop())
+
+
+def test_reconcile_date_changed(tmp_path):
+    loop = asyncio.get_event_loop()
+    backend = new_backend("elasticsearch-yearly", str(tmp_path))
+    loop.run_until_complete(backend.setup())
+    entries = sorted(source_entries([FULL_TREE]))
+    indexer = Indexer(backend.index, backend)
+    documents = [
+        Indexer.prepare_document(Parser.from_file(path)) for _, _, path in entries
+    ]
+    identifier = documents[0]["identifier"]
+    moved = dict(documents[0], date=documents[0]["date"].replace(year=1999))
+
+    async def fingerprints():
+        return [
+            fingerprint async for fingerprint in backend.walk_fingerprints(batch_size=7)
+        ]
+
+    try:
+        loop.run_until_complete(indexer.index_documents(documents))
+        # a copy left in the index of its former year, as before the writes
+        # deleted them
+        loop.run_until_complete(ElasticsearchBackend.bulk_index(backend, [moved]))
+        loop.run_until_complete(backend.refresh())
+        assert len(loop.run_until_complete(fingerprints())) == len(entries) + 1
+
+        reconciler = Reconciler(backend.index, backend, batch_size=7)
+        report = loop.run_until_complete(reconciler.reconcile([FULL_TREE]))
+        assert report["indexed"] == len(entries) + 1
+        assert report["duplicates"] == 1
+        assert report["orphans"] == report["deleted"] == 0
+        assert report["reindexed"] == 1
+        loop.run_until_complete(backend.refresh())
+        walked = loop.run_until_complete(fingerprints())
+        assert [fingerprint[0] for fingerprint in walked] == sorted(
+            document["identifier"] for document in documents
+        )
+        document = loop.run_until_complete(backend.get(identifier))
+        assert document["date"].startswith("2023")
+
+        # written in the index of its new year, the former copy is deleted
+        loop.run_until_complete(backend.bulk_index([moved]))
+        loop.run_until_complete(backend.refresh())
+        assert loop.run_until_complete(backend.count()) == len(entries)
+        document = loop.run_until_complete(backend.get(identifier))
+        assert document["date"].startswith("1999")
+
+        # all the copies of an orphan are deleted
+        loop.run_until_complete(ElasticsearchBackend.bulk_index(backend, documents[:1]))
+        loop.run_until_complete(backend.refresh())
+        results = loop.run_until_complete(backend.bulk_delete([identifier]))
+        assert [result["status"] for result in results] == [200, 200]
+        loop.run_until_complete(backend.refresh())
+        assert loop.run_until_complete(backend.count()) == len(entries) - 1
+    finally:
+        loop.run_until_complete(backend.drop())
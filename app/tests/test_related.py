@@ -0,0 +1,76 @@
+import asyncio
+import os
+
+import pytest
+
+from app.backends import BACKENDS
+from app.indexer import Indexer
+from app.legifrance.files import get_files
+from app.legifrance.parser import Parser
+from app.related import RelatedDecisions, document_terms
+from app.services.decision import DecisionService
+
+from .fixtures import new_backend, DATA_DIR
+
+
+def test_document_terms():
+    paragraphes = [["La Cour de cassation casse l'arrêt"], ["Casse et annule, 2024"]]
+    assert document_terms(paragraphes, size=3) == ["casse", "cour", "cassation"]
+
+
+def test_related_decisions():
+    related = RelatedDecisions(size=2, max_df=0.5)
+    related.add("A", "civ1", cites=["art 1", "art 2"], terms=["bail"])
+    related.add("B", "civ1", cites=["art 1", "art 2"])
+    related.add("C", "soc", cites=["art 1", "art 2"])
+    related.add("D", "soc", cites=["A"], terms=["bail"])
+    related.add("E", "soc", terms=["bail"])
+    for number in range(5):
+        related.add(f"Z{number}", "crim", terms=["vol"])
+    result = dict(related.compute())
+    # the same chambre first, then the one citing A
+    assert result["A"] == ["B", "C"]
+    assert result["D"] == ["A", "E"]
+    assert result["E"] == ["D", "A"]
+    assert len(result["Z0"]) == 2
+    assert result["Z0"][0] != "Z0"
+
+
+@pytest.mark.parametrize("name", BACKENDS)
+def test_update_related(name, tmp_path):
+    loop = asyncio.get_event_loop()
+    backend = new_backend(name, str(tmp_path))
+    loop.run_until_complete(backend.setup())
+    parsers = [
+        Parser.from_file(path)
+        for path in get_files(os.path.join(DATA_DIR, "full_tree"))
+    ]
+    identifiers = {parser.identifier for parser in parsers}
+    indexer = Indexer(backend.index, backend)
+    service = DecisionService(backend.index, backend)
+    try:
+        loop.run_until_complete(indexer.bulk_index(parsers))
+        loop.run_until_complete(backend.refresh())
+        features = loop.run_until_complete(
+            _collect(backend.walk_features(batch_size=7))
+        )
+        assert [feature["identifier"] for feature in features] == sorted(identifiers)
+        assert all(feature["terms"] for feature in features)
+        updated = loop.run_until_complete(indexer.update_related(size=5))
+        assert updated == len(parsers)
+        loop.run_until_complete(backend.refresh())
+        for parser in parsers[:10]:
+            related = loop.run_until_complete(service.get_related(parser.identifier))
+            assert related.identifier == parser.identifier
+            assert len(related.related) == 5
+            assert parser.identifier not in related.related
+            assert set(related.related) <= identifiers
+        assert (
+            loop.run_until_complete(service.get_related("JURITEXT000000000001")) is None
+        )
+    finally:
+        loop.run_until_complete(backend.drop())
+
+
+async def _collect(items):
+    return [item async for item in items]
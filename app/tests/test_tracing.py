@@ -0,0 +1,52 @@
+import threading
+import time
+
+import pytest
+
+from app import tracing
+from app.profiler import SamplingProfiler
+
+
+def test_spans():
+    with tracing.span("backend"):
+        pass
+    assert tracing.current() is None
+    with tracing.traced() as trace:
+        assert tracing.current() is trace
+        for _ in range(2):
+            with tracing.span("backend"):
+                time.sleep(0.01)
+        tracing.record_took(4)
+        tracing.record_took(3)
+    assert tracing.current() is None
+    assert trace.spans["backend"] >= 0.02
+    assert trace.took == 7
+    breakdown = trace.breakdown(0.05)
+    assert breakdown["backend"] >= 20
+    assert abs(breakdown["other"] + breakdown["backend"] - 50) < 0.01
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profiler():
+    stop = threading.Event()
+    thread = threading.Thread(target=busy_loop, args=(stop,))
+    thread.start()
+    profiler = SamplingProfiler()
+    profiler.start(interval=0.001, thread_id=thread.ident)
+    time.sleep(0.1)
+    profiler.stop()
+    stop.set()
+    thread.join()
+    assert not profiler.running
+    assert profiler.samples > 0
+    lines = profiler.collapsed().splitlines()
+    assert all("busy_loop" in line for line in lines)
+    assert sum(int(line.rsplit(" ", 1)[1]) for line in lines) == profiler.samples
+    # a null interval would spin
+    with pytest.raises(ValueError):
+        profiler.start(interval=0)
+    assert not profiler.running